@@ -5,7 +5,6 @@ import fnmatch
 import logging
 import os
 import re
-import shutil
 import signal
 import subprocess
 import sys
@@ -14,35 +13,91 @@ import time
 
 from dasbus.loop import EventLoop
 from dasbus.signal import Signal
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import (
+    EVENT_TYPE_CLOSED,
+    EVENT_TYPE_CREATED,
+    EVENT_TYPE_DELETED,
+    EVENT_TYPE_MODIFIED,
+    EVENT_TYPE_MOVED,
+    FileSystemEventHandler,
+)
 from watchdog.observers import Observer
+from watchdog.observers.api import ObservedWatch
 
+from nginx_config_reloader.check_cache import ConfigCheckCache
+from nginx_config_reloader.check_config import StagedConfigCheck
 from nginx_config_reloader.copy_files import safe_copy_files
+from nginx_config_reloader.dbus.client import request_rollback
 from nginx_config_reloader.dbus.common import NGINX_CONFIG_RELOADER, SYSTEM_BUS
 from nginx_config_reloader.dbus.server import NginxConfigReloaderInterface
+from nginx_config_reloader.generations import GenerationStore
+from nginx_config_reloader.include_graph import IncludeGraph
+from nginx_config_reloader.inotify import InotifyObserver
+from nginx_config_reloader.journal import Change, ChangeJournal
+from nginx_config_reloader.scanner import ScanCache, find_forbidden_config
+from nginx_config_reloader.scheduler import ReloadScheduler
 from nginx_config_reloader.settings import (
     BACKUP_CONFIG_DIR,
+    CONFIG_TEST_POLL_INTERVAL,
     CUSTOM_CONFIG_DIR,
     DIR_TO_WATCH,
     ERROR_FILE,
-    FORBIDDEN_CONFIG_REGEX,
+    GENERATION_STORE_DIR,
+    GENERATION_STORE_MAX_BYTES,
+    KEEP_GENERATIONS,
     MAGENTO1_CONF,
     MAGENTO2_CONF,
     MAGENTO_CONF,
     MAIN_CONFIG_DIR,
+    MAIN_CONFIG_FILE,
     NGINX,
     NGINX_PID_FILE,
+    RELOAD_MAX_LATENCY,
+    RELOAD_QUIET_PERIOD,
+    SCAN_CACHE_FILE,
+    SCAN_WORKERS,
     SYNC_IGNORE_FILES,
     UNPRIVILEGED_GID,
     UNPRIVILEGED_UID,
     WATCH_IGNORE_FILES,
+    WATCHERS,
+)
+from nginx_config_reloader.symlinks import SymlinkIndex, alias_path
+from nginx_config_reloader.syntax_check import find_syntax_errors
+from nginx_config_reloader.tree_digest import TreeDigest
+from nginx_config_reloader.utils import (
+    apply_chmod,
+    directory_is_unmounted,
+    exchange_paths,
 )
-from nginx_config_reloader.utils import apply_chmod, directory_is_unmounted
 
 logger = logging.getLogger(__name__)
 dbus_loop: EventLoop | None = None
 
-SymlinkTargets = dict[str, tuple[str, int | None, int | None, int | None]]
+# The events that may change the symlinks in the watched dir or their targets
+SYMLINK_EVENT_TYPES = (
+    EVENT_TYPE_CLOSED,
+    EVENT_TYPE_CREATED,
+    EVENT_TYPE_DELETED,
+    EVENT_TYPE_MODIFIED,
+    EVENT_TYPE_MOVED,
+)
+
+# The stages of applying the config, in the order they run
+SCAN_STAGE = "scan"
+MAGENTO_STAGE = "magento"
+CHMOD_STAGE = "chmod"
+SYNC_STAGE = "sync"
+TEST_STAGE = "test"
+RELOAD_STAGE = "reload"
+APPLY_STAGES = (
+    SCAN_STAGE,
+    MAGENTO_STAGE,
+    CHMOD_STAGE,
+    SYNC_STAGE,
+    TEST_STAGE,
+    RELOAD_STAGE,
+)
 
 
 class NginxConfigReloader(FileSystemEventHandler):
@@ -55,6 +110,15 @@ class NginxConfigReloader(FileSystemEventHandler):
         magento2_flag: str | None = None,
         use_systemd: bool = False,
         error_file: str = ERROR_FILE,
+        scan_workers: int = SCAN_WORKERS,
+        skip_unreferenced_reloads: bool = False,
+        keep_generations: int = KEEP_GENERATIONS,
+        generation_store_max_bytes: int = GENERATION_STORE_MAX_BYTES,
+        check_staged_config: bool = False,
+        quiet_period: float = RELOAD_QUIET_PERIOD,
+        max_latency: float = RELOAD_MAX_LATENCY,
+        watcher: str = WATCHERS[0],
+        scan_cache_file: str | None = SCAN_CACHE_FILE,
     ):
         """Constructor called by ProcessEvent
 
@@ -64,6 +128,23 @@ class NginxConfigReloader(FileSystemEventHandler):
         :param str dir_to_watch: The directory to watch
         :param str magento2_flag: Magento 2 flag location
         :param str error_file: File name for error output file
+        :param int scan_workers: Number of workers to scan large config trees with
+        :param bool skip_unreferenced_reloads: True if we should not test and reload
+        nginx when only files changed that nginx doesn't load
+        :param int keep_generations: Number of installed configs to keep to roll
+        back to
+        :param int generation_store_max_bytes: Most bytes of file contents to keep
+        of installed configs, 0 for no limit
+        :param bool check_staged_config: True if we should test the new custom
+        config before installing it, instead of restoring the old one if it fails
+        :param float quiet_period: Seconds without changes to wait for before
+        applying them
+        :param float max_latency: Most seconds to wait after the first change
+        before applying it
+        :param str watcher: The backend to watch the dir with, watchdog or the
+        built-in inotify one
+        :param str scan_cache_file: File to keep the scan results in over
+        restarts, None to not keep them
         """
         if not logger:
             self.logger = logging
@@ -78,11 +159,57 @@ class NginxConfigReloader(FileSystemEventHandler):
             self.magento2_flag = magento2_flag
         self.logger.info(self.dir_to_watch)
         self.use_systemd = use_systemd
-        self.dirty = False
+        self.changes = ChangeJournal()
         self.applying = False
-        self.watched_symlink_targets: SymlinkTargets = {}
+        # The change generation the running apply applies, it is cancelled
+        # when newer changes come in
+        self.apply_generation: int | None = None
+        # When the oldest change that wasn't applied came in, kept over
+        # cancelled applies so a writer that never stops can't cancel them all
+        self.pending_since: float | None = None
+        self.symlink_index = SymlinkIndex(dir_to_watch)
+        self.symlink_target_handler = SymlinkTargetHandler(self)
+        # Watches on the dirs outside the watched dir that contain symlink
+        # targets, by dir
+        self.watcher = watcher
+        self.target_watches: dict[str, ObservedWatch] = {}
+        # Recursive watches on the symlinked dirs, by symlink
+        self.link_watches: dict[str, ObservedWatch] = {}
+        # Set when the kernel dropped events, so the watches may be incomplete
+        self.events_lost = False
+        # The symlinks to dirs that changed, so the dirs below them have to be
+        # watched again
+        self.rearm_links: set[str] = set()
+        # Set when a symlink changed, so other dirs may contain targets
+        self.target_watches_stale = False
         self._on_config_reload = Signal()
         self.error_file = error_file
+        self.ignored_files = re.compile(
+            "|".join(
+                fnmatch.translate(pattern)
+                for pattern in list(WATCH_IGNORE_FILES) + [error_file]
+            )
+        )
+        self.scan_cache = ScanCache(scan_cache_file)
+        self.scan_workers = scan_workers
+        self.include_graph = IncludeGraph(
+            dir_to_watch, list(SYNC_IGNORE_FILES) + [error_file]
+        )
+        self.tree_digest = TreeDigest(list(SYNC_IGNORE_FILES) + [error_file])
+        self.applied_digest: str | None = None
+        self.skip_unreferenced_reloads = skip_unreferenced_reloads
+        self.installed_config_tested = False
+        # Whether the custom config dir was swapped with the backup dir since
+        # the last install, so restoring means swapping them back
+        self.custom_config_swapped = False
+        self.generation_store = GenerationStore(
+            GENERATION_STORE_DIR, keep_generations, generation_store_max_bytes
+        )
+        self.check_staged_config = check_staged_config
+        self.check_cache = ConfigCheckCache()
+        self.scheduler = ReloadScheduler(
+            quiet_period, max_latency, pending=self.has_pending_work
+        )
 
     def on_deleted(self, event):
         """Triggered by inotify on removal of file or removal of dir
@@ -91,10 +218,14 @@ class NginxConfigReloader(FileSystemEventHandler):
         trigger IN_IGNORED.
         """
         if not event.is_directory:
+            self.scheduler.release(os.fsdecode(event.src_path))
             self.handle_event(event)
 
     def on_moved(self, event):
-        """Triggered by inotify when a file is moved from or to the dir"""
+        """Triggered by inotify when a file is moved from or to the dir, like
+        when it is renamed into place after it was written"""
+        self.scheduler.release(os.fsdecode(event.src_path))
+        self.scheduler.release(os.fsdecode(event.dest_path))
         self.handle_event(event)
 
     def on_created(self, event):
@@ -103,11 +234,33 @@ class NginxConfigReloader(FileSystemEventHandler):
             self.handle_event(event)
 
     def on_modified(self, event):
-        """Triggered by inotify when a file is written in the dir"""
+        """Triggered by inotify on every write to a file in the dir, and when
+        its attributes change
+
+        The change of a file that is being written is applied when it is
+        closed, its writes only postpone the reload until then.
+        """
+        src_path = os.fsdecode(event.src_path)
+        if event.is_directory or self.is_ignored(src_path):
+            return
+        if self.scheduler.is_held(src_path):
+            return
+        if self.is_being_written(src_path):
+            self.changes.record(src_path, event.event_type)
+            self.scheduler.hold(src_path)
+        else:
+            self.handle_event(event)
+
+    def on_closed(self, event):
+        """Triggered by inotify when a file that was open for writing is
+        closed"""
+        self.scheduler.release(os.fsdecode(event.src_path))
         self.handle_event(event)
 
     def on_any_event(self, event):
-        """Triggered by inotify when watched dir is moved or deleted"""
+        """Triggered by inotify on every event, keeps the symlink index up to
+        date and stops when the watched dir is moved or deleted"""
+        self.handle_symlink_event(event)
         if event.is_directory and event.event_type in ["moved", "deleted"]:
             if event.src_path == self.dir_to_watch:
                 self.logger.warning(
@@ -116,16 +269,99 @@ class NginxConfigReloader(FileSystemEventHandler):
                 raise ListenTargetTerminated
 
     def handle_event(self, event):
-        if event.is_directory:
+        # Of the changes of dirs only new ones are applied by themselves, they
+        # get their permissions fixed
+        if event.is_directory and event.event_type != EVENT_TYPE_CREATED:
             return
 
-        basename = os.path.basename(event.src_path)
-        ignore_files = list(WATCH_IGNORE_FILES) + [self.error_file]
-        if not any(fnmatch.fnmatch(basename, pat) for pat in ignore_files):
+        if not self.is_ignored(event.src_path):
             self.logger.debug(
                 f"{event.event_type.upper()} detected on {event.src_path}"
             )
-            self.dirty = True
+            self.changes.record(event.src_path, event.event_type)
+            if event.dest_path:
+                self.changes.record(event.dest_path, event.event_type)
+            self.scheduler.notify()
+
+    def is_ignored(self, path: str) -> bool:
+        """Return True if changes of path don't need a reload"""
+        return self.ignored_files.match(os.path.basename(path)) is not None
+
+    @staticmethod
+    def is_being_written(path: str) -> bool:
+        """Return True if the last change of path was a write, not a change of
+        its attributes like its permissions
+
+        A write sets the modification and the change time of a file to the
+        same time, other changes set only the change time.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return st.st_mtime_ns == st.st_ctime_ns
+
+    def handle_symlink_event(self, event, outside: bool = False):
+        """Bring the symlink index up to date with an event
+
+        :param event: The watchdog event
+        :param bool outside: True if the event was reported for a dir outside
+        the watched dir that contains symlink targets
+        """
+        if event.event_type not in SYMLINK_EVENT_TYPES:
+            return
+        # The first write of a file was handled already, the others can't
+        # change a symlink
+        if (
+            event.event_type == EVENT_TYPE_MODIFIED
+            and not outside
+            and self.scheduler.is_held(event.src_path)
+        ):
+            return
+        # Only a created, deleted or moved dir changes the symlinks below it
+        recursive = event.event_type not in (EVENT_TYPE_MODIFIED, EVENT_TYPE_CLOSED)
+        # A removed target may be replaced by one with the same inode
+        replaced = event.event_type in (EVENT_TYPE_DELETED, EVENT_TYPE_MOVED)
+        changed = {}
+        for path in filter(None, (event.src_path, event.dest_path)):
+            if not outside:
+                changed.update(self.symlink_index.update(path, recursive))
+            changed.update(
+                self.symlink_index.refresh_targets(
+                    path, replaced and path == event.src_path
+                )
+            )
+        if not changed:
+            return
+
+        for link, is_directory_link in changed.items():
+            self.logger.debug(f"Symlink {link} changed")
+            self.changes.record(link, "symlink_changed")
+            if is_directory_link:
+                self.rearm_links.add(link)
+        self.target_watches_stale = True
+        self.scheduler.notify()
+
+    def on_events_lost(self):
+        """Triggered when inotify dropped events, everything may have changed"""
+        self.changes.record(self.dir_to_watch, "events_lost")
+        self.events_lost = True
+        self.scheduler.notify()
+
+    @property
+    def dirty(self) -> bool:
+        """True if there are changes that weren't applied yet"""
+        return self.changes.dirty
+
+    def has_pending_work(self) -> bool:
+        """Return True if there are changes that weren't applied yet, or
+        watches that have to be set up again"""
+        return (
+            self.dirty
+            or self.events_lost
+            or bool(self.rearm_links)
+            or self.target_watches_stale
+        )
 
     def install_magento_config(self):
         # Check if configs are present
@@ -155,8 +391,7 @@ class NginxConfigReloader(FileSystemEventHandler):
 
     def check_no_forbidden_config_directives_are_present(self):
         """
-        Loop over the :FORBIDDEN_CONFIG_REGEX: to check if nginx config directory contains forbidden configuration
-         options
+        Scan the watched directory for the directives in :FORBIDDEN_CONFIG_DIRECTIVES:
         :return bool:
                         True    if forbidden config directives are present
                         False   if check couldn't find any forbidden config flags
@@ -164,27 +399,55 @@ class NginxConfigReloader(FileSystemEventHandler):
         if not os.path.isdir(self.dir_to_watch):
             return False
 
-        for pattern, message in FORBIDDEN_CONFIG_REGEX:
-            try:
-                # error file may contain messages that match a forbidden config pattern
-                # then validation could fail while the actual config is correct.
-                # we'll exclude the error file from searching for patterns,
-                # NOTE: exclusion of error_file requires to ensure the
-                # file is removed before moving it to nginx conf dir
-                # @TODO: use Python to search for forbidden configs instead
-                # of spawning external procs. Will have better testing
-                # and even may consume less system resources
-                check_external_resources = "[ $(grep -r --exclude={} --exclude={} -P '{}' '{}' | wc -l) -lt 1 ]".format(
-                    ERROR_FILE, self.error_file, pattern, self.dir_to_watch
-                )
-                subprocess.check_output(check_external_resources, shell=True)
-            except subprocess.CalledProcessError:
-                error = f"Unable to load config: {message}"
-                self.logger.error(error)
-                self.write_error_file(error)
-                return True
+        # error file may contain messages that look like forbidden config
+        # then validation could fail while the actual config is correct.
+        # we'll exclude the error file from searching for patterns,
+        # NOTE: exclusion of error_file requires to ensure the
+        # file is removed before moving it to nginx conf dir
+        violation = find_forbidden_config(
+            self.dir_to_watch,
+            exclude_files=[ERROR_FILE, self.error_file],
+            cache=self.scan_cache,
+            workers=self.scan_workers,
+            reachable=self.include_graph.reachable,
+            reachable_inodes=self.include_graph.inodes,
+        )
+        self.scan_cache.save()
+        if not violation:
+            return False
 
-        return False
+        error = (
+            f"Unable to load config: {violation.message}"
+            f"{violation.path}:{violation.line}: {violation.text}\n"
+        )
+        self.logger.error(error)
+        self.write_error_file(error)
+        return True
+
+    def reload_skip_reason(
+        self, changed_paths: set[str], reachability_changed: set[str]
+    ) -> str | None:
+        """Return why nginx doesn't have to be tested and reloaded, or None
+
+        That is the case if none of the changed files is loaded by nginx, nor
+        was before the change. The installed config must have been tested, as
+        it is replaced by the new one, which then isn't tested.
+
+        :param set changed_paths: The paths that changed since the last apply
+        :param set reachability_changed: The paths nginx started or stopped
+        loading because of the changes
+        """
+        if not self.skip_unreferenced_reloads or not self.installed_config_tested:
+            return None
+        if not changed_paths or reachability_changed:
+            return None
+        if self.include_graph.reachable is None:
+            return None
+        if os.path.normpath(self.magento2_flag) in map(os.path.normpath, changed_paths):
+            return None
+        if self.include_graph.loads_any(changed_paths):
+            return None
+        return f"nginx does not load any of {', '.join(sorted(changed_paths))}"
 
     def remove_error_file(self):
         """Try removing the error file. Return True on success or False on errors
@@ -198,24 +461,204 @@ class NginxConfigReloader(FileSystemEventHandler):
             pass
         return removed
 
-    def apply_new_config(self):
+    def apply_new_config(self, full: bool = False):
+        """Apply the changes in the watched dir
+
+        :param bool full: True to run all stages, as if the config was never
+        applied before
+        :return bool: True if the config was applied, False if it wasn't, or
+        None if another apply was running and the changes were left pending
+        """
         # Wrapper function to prevent multiple config applications
         if self.applying:
             logger.debug("A config is already being applied. Skipping this one.")
-            return False
+            return None
 
         self.applying = True
         try:
-            res = self._apply()
+            res = self._apply(full)
+        except ApplyCancelled:
+            self.logger.info("Newer changes came in, not applying the older ones")
+            res = False
         except Exception as e:
             logger.exception(e)
             res = False
+            self.pending_since = None
+        else:
+            self.pending_since = None
+        self.apply_generation = None
         self.applying = False
         return res
 
-    def _apply(self):
-        logger.debug("Applying new config")
-        if self.check_no_forbidden_config_directives_are_present():
+    def apply_cancelled(self) -> bool:
+        """Return True if changes came in after the running apply started
+
+        Once the max latency passed since the oldest change it applies came
+        in, the apply isn't cancelled anymore.
+        """
+        return (
+            self.apply_generation is not None
+            and self.changes.generation != self.apply_generation
+            and not self.apply_overdue()
+        )
+
+    def apply_overdue(self) -> bool:
+        """Return True if the pending changes waited the max latency already"""
+        return (
+            self.pending_since is not None
+            and time.monotonic() - self.pending_since >= self.scheduler.max_latency
+        )
+
+    def run_config_test(self, args: list[str]):
+        """Run nginx -t with args
+
+        The test is killed when the running apply is cancelled, because its
+        outcome doesn't matter anymore.
+
+        :param list args: The nginx command line
+        :raises subprocess.CalledProcessError: If the config is invalid
+        :raises ApplyCancelled: If the test was killed
+        """
+        with subprocess.Popen(
+            args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        ) as process:
+            while True:
+                try:
+                    output, _ = process.communicate(timeout=CONFIG_TEST_POLL_INTERVAL)
+                    break
+                except subprocess.TimeoutExpired:
+                    if self.apply_cancelled():
+                        process.kill()
+                        process.communicate()
+                        raise ApplyCancelled
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, args, output)
+
+    def config_digest(self) -> str:
+        """Return a digest of everything a change of which needs a reload
+
+        That is the synced config and whether the magento 2 flag is set.
+        """
+        magento2 = os.path.isfile(self.magento2_flag)
+        return self.tree_digest.digest(
+            self.dir_to_watch, [b"magento2" if magento2 else b"magento1"]
+        )
+
+    def config_check_key(self, digest: str) -> str | None:
+        """Return the key of the config to apply in the check cache
+
+        :param str digest: The config digest of the watched dir
+        :return str: The key, or None if it isn't known which files nginx loads
+        """
+        if self.include_graph.reachable is None:
+            return None
+        return self.check_cache.key(
+            digest, self.include_graph.reachable, self.include_graph.is_watched
+        )
+
+    def check_changed_config_syntax(self, changed_paths: set[str]) -> str | None:
+        """Return the syntax errors in the changed files that nginx loads
+
+        :param set changed_paths: The paths that changed since the last apply
+        :return str: The errors in the format of nginx, with the paths the
+        files will be installed to, or None if there are none
+        """
+        errors = find_syntax_errors(self.include_graph.loaded_below(changed_paths))
+        if not errors:
+            return None
+        lines = []
+        for error in errors:
+            relative = os.path.relpath(error.file, self.dir_to_watch)
+            path = os.path.join(CUSTOM_CONFIG_DIR, relative)
+            lines.append(f"nginx: [emerg] {error.message} in {path}:{error.line}")
+        lines.append("nginx: syntax check of the changed files failed")
+        return "\n".join(lines) + "\n"
+
+    def plan_stages(self, changes: set[Change]) -> list[str]:
+        """Return the stages that are needed to apply changes
+
+        Toggling the magento 2 flag only switches the magento config, and a new
+        empty directory only needs its permissions fixed. All other changes, and
+        applies that aren't caused by changes or follow a failed apply, run all
+        stages.
+
+        :param set changes: The changes since the last apply
+        :return list: The stages, in the order they run
+        """
+        if not changes or not self.installed_config_tested:
+            return list(APPLY_STAGES)
+        magento2_flag = os.path.normpath(self.magento2_flag)
+        stages = set()
+        for change in changes:
+            path = os.path.normpath(change.path)
+            if path == magento2_flag:
+                stages.update((MAGENTO_STAGE, TEST_STAGE, RELOAD_STAGE))
+            elif change.event_type == EVENT_TYPE_CREATED and _is_empty_dir(path):
+                stages.add(CHMOD_STAGE)
+            else:
+                return list(APPLY_STAGES)
+        return [stage for stage in APPLY_STAGES if stage in stages]
+
+    def _apply(self, full: bool = False):
+        # Changes that come in from now on are applied by the next apply
+        generation, changes = self.changes.take()
+        self.apply_generation = generation
+        logger.debug(f"Applying new config, changes up to generation {generation}")
+        try:
+            return self._apply_changes(changes, full)
+        except ApplyCancelled:
+            self.restore_old_custom_config_dir()
+            # The newer changes are applied together with these
+            if full or not changes:
+                changes.add(Change(self.dir_to_watch, "full"))
+            for change in changes:
+                self.changes.record(change.path, change.event_type)
+            raise
+
+    def check_cancelled(self):
+        """Stop the running apply if changes came in after it started
+
+        :raises ApplyCancelled: If the apply is cancelled
+        """
+        if self.apply_cancelled():
+            raise ApplyCancelled
+
+    def _apply_changes(self, changes: set[Change], full: bool) -> bool:
+        changed_paths = {change.path for change in changes}
+        # Files nginx doesn't load can't do any harm. Reloads that are not
+        # caused by changes may follow changes that weren't reported, so the
+        # graph is built again for those.
+        reachability_changed = self.include_graph.update(
+            [self.dir_to_watch] if full or not changes else changed_paths
+        )
+        if full:
+            # Nothing is skipped, like when the config is applied at startup
+            changes, changed_paths = set(), set()
+
+        # Files are often written without changing them. Reloads that are not
+        # caused by changes (at startup or over DBus) are always done.
+        digest = self.config_digest()
+        if changed_paths and digest == self.applied_digest:
+            self.logger.info("Config is the same as the applied config, not applying")
+            self.remove_error_file()
+            return True
+
+        skip_reason = self.reload_skip_reason(changed_paths, reachability_changed)
+        plan = self.plan_stages(changes)
+        if skip_reason:
+            self.logger.info(f"Not testing and reloading nginx: {skip_reason}")
+            plan = [stage for stage in plan if stage not in (TEST_STAGE, RELOAD_STAGE)]
+        self.logger.debug(f"Applying config in stages: {', '.join(plan)}")
+        if SYNC_STAGE in plan or TEST_STAGE in plan:
+            self.installed_config_tested = False
+        # Until the new custom config is installed there is nothing to restore
+        self.custom_config_swapped = False
+
+        self.check_cancelled()
+        if (
+            SCAN_STAGE in plan
+            and self.check_no_forbidden_config_directives_are_present()
+        ):
             return False
 
         if not self.check_can_write_to_main_config_dir():
@@ -224,17 +667,49 @@ class NginxConfigReloader(FileSystemEventHandler):
             )
             return False
 
-        if not self.no_magento_config:
+        self.check_cancelled()
+        if MAGENTO_STAGE in plan and not self.no_magento_config:
             try:
                 self.install_magento_config()
             except OSError:
                 self.logger.error("Installation of magento config failed")
                 return False
 
+        # nginx -t is slow, so configs that were tested before aren't tested
+        # again, unless the reload wasn't caused by a change
+        check_key = None
+        if changed_paths and TEST_STAGE in plan:
+            check_key = self.config_check_key(digest)
+        checked = self.check_cache.get(check_key) if check_key else None
+        if checked is not None and not checked[0]:
+            self.logger.info("Config check failed before for the same config")
+            self.write_error_file(checked[1])
+            return False
+
+        # Typos are found in the changed files without running nginx -t
+        if TEST_STAGE in plan:
+            syntax_errors = self.check_changed_config_syntax(changed_paths)
+            if syntax_errors:
+                self.logger.info("Config syntax check failed")
+                self.write_error_file(syntax_errors)
+                return False
+
+        self.check_cancelled()
+        # The new custom config is only installed after it was tested
+        staged = (
+            self.check_staged_config
+            and SYNC_STAGE in plan
+            and not self.no_custom_config
+            and os.path.isfile(MAIN_CONFIG_FILE)
+        )
         if not self.no_custom_config:
             try:
-                self.fix_custom_config_dir_permissions()
-                self.install_new_custom_config_dir()
+                if CHMOD_STAGE in plan:
+                    self.fix_custom_config_dir_permissions()
+                if staged:
+                    self.stage_new_custom_config_dir()
+                elif SYNC_STAGE in plan:
+                    self.install_new_custom_config_dir()
             except (OSError, subprocess.CalledProcessError) as e:
                 error_output = str(e)
                 if hasattr(e, "output"):
@@ -247,23 +722,51 @@ class NginxConfigReloader(FileSystemEventHandler):
                 self.write_error_file(error_output)
                 return False
 
+        if TEST_STAGE not in plan and SYNC_STAGE not in plan:
+            return True
+
+        self.check_cancelled()
+        if TEST_STAGE not in plan:
+            if staged:
+                self.swap_in_staged_custom_config()
+            self.installed_config_tested = True
+            self.applied_digest = digest
+            self.store_generation()
+            return True
+
         try:
-            subprocess.check_output([NGINX, "-t"], stderr=subprocess.STDOUT)
+            if checked is not None:
+                self.logger.info("Config check passed before for the same config")
+            elif staged:
+                self.check_staged_custom_config()
+            else:
+                self.run_config_test([NGINX, "-t"])
         except subprocess.CalledProcessError as e:
             self.logger.info("Config check failed")
             if not self.no_custom_config:
                 self.restore_old_custom_config_dir()
 
-            if isinstance(e.output, bytes):
-                self.write_error_file(e.output.decode())
-            else:
-                self.write_error_file(e.output)
+            output = e.output
+            if isinstance(output, bytes):
+                output = output.decode()
+            if check_key:
+                self.check_cache.put(check_key, False, output)
+            self.write_error_file(output)
 
             return False
         else:
+            if check_key and checked is None:
+                self.check_cache.put(check_key, True, "")
+            # Only the newest config is installed and reloaded
+            self.check_cancelled()
+            if staged:
+                self.swap_in_staged_custom_config()
             self.remove_error_file()
+            self.installed_config_tested = True
 
         self.reload_nginx()
+        self.applied_digest = digest
+        self.store_generation()
 
         return True
 
@@ -280,18 +783,102 @@ class NginxConfigReloader(FileSystemEventHandler):
             self.logger.info("Failed fixing permissions on watched directory")
 
     def install_new_custom_config_dir(self):
+        """Install the watched config as the custom config
+
+        The new config is synced to the backup dir, which holds the config that
+        was installed before the current one, and is then swapped with the
+        custom config dir in one atomic rename. nginx never sees a partially
+        installed config, and the current config becomes the backup.
+        """
+        self.stage_new_custom_config_dir()
+        self.swap_in_staged_custom_config()
+
+    def stage_new_custom_config_dir(self):
+        """Sync the watched config to the backup dir, to install it from"""
         self.remove_error_file()
-        shutil.rmtree(BACKUP_CONFIG_DIR, ignore_errors=True)
-        if os.path.exists(CUSTOM_CONFIG_DIR):
-            shutil.move(CUSTOM_CONFIG_DIR, BACKUP_CONFIG_DIR)
-        os.mkdir(CUSTOM_CONFIG_DIR)
+        self.custom_config_swapped = False
         ignore_files = list(SYNC_IGNORE_FILES) + [self.error_file]
-        safe_copy_files(self.dir_to_watch, CUSTOM_CONFIG_DIR, ignore_files)
+        safe_copy_files(self.dir_to_watch, BACKUP_CONFIG_DIR, ignore_files)
+
+    def check_staged_custom_config(self):
+        """Test the nginx config with the staged instead of the installed
+        custom config
+
+        :raises subprocess.CalledProcessError: If the config is invalid, with
+        the paths in the output of nginx mapped to the installed config
+        """
+        with StagedConfigCheck(
+            BACKUP_CONFIG_DIR, MAIN_CONFIG_FILE, CUSTOM_CONFIG_DIR
+        ) as check:
+            try:
+                self.run_config_test([NGINX, "-t", "-c", check.path])
+            except subprocess.CalledProcessError as e:
+                e.output = check.translate(e.output)
+                raise
+
+    def swap_in_staged_custom_config(self):
+        """Swap the config in the backup dir with the installed config"""
+        if os.path.exists(CUSTOM_CONFIG_DIR):
+            exchange_paths(BACKUP_CONFIG_DIR, CUSTOM_CONFIG_DIR)
+        else:
+            os.rename(BACKUP_CONFIG_DIR, CUSTOM_CONFIG_DIR)
+        self.custom_config_swapped = True
 
     def restore_old_custom_config_dir(self):
-        shutil.rmtree(CUSTOM_CONFIG_DIR)
+        """Undo the last install of the custom config, if it was installed"""
+        if not self.custom_config_swapped:
+            return
         if os.path.exists(BACKUP_CONFIG_DIR):
-            shutil.move(BACKUP_CONFIG_DIR, CUSTOM_CONFIG_DIR)
+            exchange_paths(BACKUP_CONFIG_DIR, CUSTOM_CONFIG_DIR)
+        else:
+            os.rename(CUSTOM_CONFIG_DIR, BACKUP_CONFIG_DIR)
+        self.custom_config_swapped = False
+
+    def store_generation(self):
+        """Keep the custom config that was just installed to roll back to"""
+        if not self.custom_config_swapped:
+            return
+        try:
+            generation = self.generation_store.add(CUSTOM_CONFIG_DIR)
+        except OSError as e:
+            self.logger.warning(f"Failed to store the installed config: {e}")
+        else:
+            self.logger.debug(f"Installed config is stored as generation {generation}")
+
+    def rollback(self, generation: str) -> bool:
+        """Install a stored config generation and reload nginx
+
+        The watched dir isn't changed, so the next change there installs the
+        config in it again.
+
+        :param str generation: The name of the generation to install
+        :return bool: True if the generation was installed
+        """
+        if self.applying:
+            logger.debug("A config is being applied. Not rolling back.")
+            return False
+
+        self.applying = True
+        try:
+            self.generation_store.checkout(generation, BACKUP_CONFIG_DIR)
+            self.swap_in_staged_custom_config()
+            self.run_config_test([NGINX, "-t"])
+        except subprocess.CalledProcessError:
+            self.logger.error(f"Config check of generation {generation} failed")
+            self.restore_old_custom_config_dir()
+            return False
+        except OSError as e:
+            self.logger.error(f"Rolling back to generation {generation} failed: {e}")
+            return False
+        else:
+            self.logger.info(f"Rolled back to config generation {generation}")
+            self.reload_nginx()
+            self.installed_config_tested = True
+            # Any change in the watched dir installs it again
+            self.applied_digest = None
+            return True
+        finally:
+            self.applying = False
 
     def reload_nginx(self):
         if self.use_systemd:
@@ -320,78 +907,215 @@ class NginxConfigReloader(FileSystemEventHandler):
         """Signal for the reload event."""
         return self._on_config_reload
 
-    def reload(self, send_signal=True):
+    def reload(self, send_signal=True, full=False) -> bool:
+        """Apply the changes in the watched dir, unless it is unmounted
+
+        :return bool: True if the pending changes were taken up by the apply,
+        False if they are still pending
+        """
         if directory_is_unmounted(self.dir_to_watch):
             self.logger.warning(
                 f"Directory {self.dir_to_watch} is unmounted, not reloading!"
             )
-            return
+            return False
 
-        self.apply_new_config()
+        applied = self.apply_new_config(full=full)
         if send_signal:
             self._on_config_reload.emit()
+        return applied is not None
 
     def start_observer(self):
-        self.observer = Observer()
-        self.observer.schedule(
-            self, self.dir_to_watch, recursive=True, follow_symlink=True
-        )
+        """Watch the watched dir, and every dir reached through symlinks once"""
+        self.rearm_links = set()
+        self.target_watches_stale = False
+        self.events_lost = False
+        self.symlink_index.build()
+        if self.watcher == "inotify":
+            self.observer = InotifyObserver(on_overflow=self.on_events_lost)
+        else:
+            self.observer = Observer()
+        self.observer.schedule(self, self.dir_to_watch, recursive=True)
         self.observer.start()
-        self.watched_symlink_targets = self.get_symlink_targets()
+        # Symlinked dirs aren't followed by the watches, they get a watch of
+        # their own so a dir that is linked to more than once is watched once
+        self.link_watches = {}
+        for link in self.symlink_index.watch_roots:
+            self.watch_symlinked_dir(link)
+        self.target_watches = {}
+        self.sync_target_watches()
+        self.logger.info(
+            f"Watching {self.watch_count()} dirs, "
+            f"{len(self.link_watches)} symlinked trees"
+        )
+
+    def watch_count(self) -> int:
+        """Return the number of dirs that are watched"""
+        return self.symlink_index.watched_dirs + len(self.target_watches)
 
     def stop_observer(self):
         self.observer.stop()
         self.observer.join()
 
     def restart_observer(self):
+        """Watch the watched dir again, and apply all of it
+
+        Changes while no observer was running aren't reported.
+        """
         self.stop_observer()
         self.start_observer()
+        self.changes.record(self.dir_to_watch, "observer_restarted")
 
-    def get_symlink_targets(self):
-        targets: SymlinkTargets = {}
-        for root, dirnames, _ in os.walk(self.dir_to_watch, followlinks=True):
-            for dirname in dirnames:
-                path = os.path.join(root, dirname)
-                if not os.path.islink(path):
-                    continue
-                try:
-                    st = os.stat(path)
-                    targets[path] = (
-                        os.path.realpath(path),
-                        st.st_dev,
-                        st.st_ino,
-                        st.st_ctime_ns,
-                    )
-                except OSError:
-                    targets[path] = (os.path.realpath(path), None, None, None)
-        return targets
+    def watch_symlinked_dir(self, link: str):
+        """Watch the dir link resolves to, reporting its events below link"""
+        target = os.path.realpath(link)
+        try:
+            self.link_watches[link] = self.observer.schedule(
+                SymlinkedDirHandler(self, link, target), target, recursive=True
+            )
+        except OSError as e:
+            self.logger.warning(f"Could not watch symlinked dir {link}: {e}")
 
-    def symlink_targets_changed(self):
-        return self.get_symlink_targets() != self.watched_symlink_targets
+    def rearm_watches(self, links: set[str]):
+        """Watch the dirs below changed symlinks again, keeping the other
+        watches and the observer running
+
+        :param set links: The symlinks to dirs that changed
+        """
+        removed, added = self.symlink_index.rearm(links)
+        for link in removed:
+            watch = self.link_watches.pop(link, None)
+            if watch is not None:
+                self.observer.unschedule(watch)
+        for link in added:
+            self.watch_symlinked_dir(link)
+        self.target_watches_stale = False
+        self.sync_target_watches()
+
+    def sync_target_watches(self):
+        """Watch the dirs outside the watched dir that contain symlink targets
+
+        The watches are not recursive: a target itself being replaced, removed
+        or changed is reported by the dir that contains it.
+        """
+        wanted = self.symlink_index.target_parents()
+        for parent in self.target_watches.keys() - wanted:
+            self.observer.unschedule(self.target_watches.pop(parent))
+        for parent in wanted - self.target_watches.keys():
+            try:
+                self.target_watches[parent] = self.observer.schedule(
+                    self.symlink_target_handler, parent, recursive=False
+                )
+            except OSError as e:
+                self.logger.warning(f"Could not watch symlink targets in {parent}: {e}")
+
+
+def _is_empty_dir(path: str) -> bool:
+    """Return True if path is a dir without files, not a symlink to one
+
+    A dir that was moved in with files is reported as created as well, its
+    files have to be synced.
+    """
+    if os.path.islink(path) or not os.path.isdir(path):
+        return False
+    try:
+        return not os.listdir(path)
+    except OSError:
+        return False
+
+
+class SymlinkedDirHandler(FileSystemEventHandler):
+    """Handles the events of a symlinked dir as events below the symlink"""
+
+    def __init__(self, nginx_config_reloader: NginxConfigReloader, link, target):
+        """
+        :param NginxConfigReloader nginx_config_reloader: The handler of the
+        watched dir
+        :param str link: The symlink below the watched dir
+        :param str target: The dir the symlink resolves to
+        """
+        self.nginx_config_reloader = nginx_config_reloader
+        self.link = link
+        self.target = target
+
+    def dispatch(self, event):
+        if event.src_path == self.target:
+            # The symlinked dir itself was removed or changed
+            self.nginx_config_reloader.handle_symlink_event(event, outside=True)
+        src_path = alias_path(os.fsdecode(event.src_path), self.target, self.link)
+        if event.dest_path:
+            dest_path = alias_path(os.fsdecode(event.dest_path), self.target, self.link)
+            event = type(event)(src_path, dest_path)
+        else:
+            event = type(event)(src_path)
+        self.nginx_config_reloader.dispatch(event)
+
+
+class SymlinkTargetHandler(FileSystemEventHandler):
+    """Handles the events of the dirs that contain symlink targets"""
+
+    def __init__(self, nginx_config_reloader: NginxConfigReloader):
+        self.nginx_config_reloader = nginx_config_reloader
+
+    def on_any_event(self, event):
+        self.nginx_config_reloader.handle_symlink_event(event, outside=True)
 
 
 class ListenTargetTerminated(BaseException):
     pass
 
 
+class ApplyCancelled(Exception):
+    pass
+
+
 def after_loop(nginx_config_reloader: NginxConfigReloader) -> None:
-    if nginx_config_reloader.symlink_targets_changed():
+    if nginx_config_reloader.events_lost:
+        nginx_config_reloader.logger.info("Events were lost, restarting observer")
+        try:
+            nginx_config_reloader.restart_observer()
+        except Exception as e:
+            logger.exception(e)
+    elif nginx_config_reloader.rearm_links:
+        links = set(nginx_config_reloader.rearm_links)
+        nginx_config_reloader.rearm_links -= links
         nginx_config_reloader.logger.info(
-            "Symlink target changed under watched dir, restarting observer"
+            "Symlink target changed under watched dir, watching it again"
         )
         try:
-            nginx_config_reloader.restart_observer()
+            nginx_config_reloader.rearm_watches(links)
+        except Exception as e:
+            logger.exception(e)
+            nginx_config_reloader.logger.info("Restarting observer")
+            try:
+                nginx_config_reloader.restart_observer()
+            except Exception as e:
+                logger.exception(e)
+    elif nginx_config_reloader.target_watches_stale:
+        nginx_config_reloader.target_watches_stale = False
+        try:
+            nginx_config_reloader.sync_target_watches()
         except Exception as e:
             logger.exception(e)
-        nginx_config_reloader.dirty = True
 
-    if nginx_config_reloader.dirty:
+    if nginx_config_reloader.dirty and nginx_config_reloader.scheduler.due():
+        if nginx_config_reloader.pending_since is None:
+            nginx_config_reloader.pending_since = (
+                nginx_config_reloader.scheduler.first_change
+            )
+        nginx_config_reloader.scheduler.reset()
+        generation = nginx_config_reloader.changes.generation
         try:
-            nginx_config_reloader.reload()
+            consumed = nginx_config_reloader.reload()
         except Exception:
-            pass
-        nginx_config_reloader.dirty = False
-        nginx_config_reloader.applying = False
+            consumed = True
+        # Changes that came in during the reload get a reload of their own.
+        # Changes that weren't applied, because an apply over DBus was running
+        # or the dir is unmounted, are tried again after the quiet period.
+        if consumed:
+            nginx_config_reloader.changes.discard(generation)
+            nginx_config_reloader.applying = False
+        else:
+            nginx_config_reloader.scheduler.notify()
 
 
 def dbus_event_loop():
@@ -409,6 +1133,14 @@ def wait_loop(
     use_systemd=False,
     no_dbus=False,
     error_file: str = ERROR_FILE,
+    scan_workers: int = SCAN_WORKERS,
+    skip_unreferenced_reloads: bool = False,
+    keep_generations: int = KEEP_GENERATIONS,
+    generation_store_max_bytes: int = GENERATION_STORE_MAX_BYTES,
+    check_staged_config: bool = False,
+    quiet_period: float = RELOAD_QUIET_PERIOD,
+    max_latency: float = RELOAD_MAX_LATENCY,
+    watcher: str = WATCHERS[0],
 ):
     """Main event loop
 
@@ -426,6 +1158,20 @@ def wait_loop(
     :param use_systemd: True if we should reload nginx using systemd instead of process signal
     :param bool no_dbus: True if we should not use DBus
     :param str error_file: Error file to write error output to
+    :param int scan_workers: Number of workers to scan large config trees with
+    :param bool skip_unreferenced_reloads: True if we should not test and reload nginx
+    when only files changed that nginx doesn't load
+    :param int keep_generations: Number of installed configs to keep to roll back to
+    :param int generation_store_max_bytes: Most bytes of file contents to keep of
+    installed configs, 0 for no limit
+    :param bool check_staged_config: True if we should test the new custom config
+    before installing it
+    :param float quiet_period: Seconds without changes to wait for before applying
+    them
+    :param float max_latency: Most seconds to wait after the first change before
+    applying it
+    :param str watcher: The backend to watch the dir with, watchdog or the
+    built-in inotify one
     :return None:
     """
     dir_to_watch = os.path.abspath(dir_to_watch)
@@ -437,6 +1183,14 @@ def wait_loop(
         dir_to_watch=dir_to_watch,
         use_systemd=use_systemd,
         error_file=error_file,
+        scan_workers=scan_workers,
+        skip_unreferenced_reloads=skip_unreferenced_reloads,
+        keep_generations=keep_generations,
+        generation_store_max_bytes=generation_store_max_bytes,
+        check_staged_config=check_staged_config,
+        quiet_period=quiet_period,
+        max_latency=max_latency,
+        watcher=watcher,
     )
 
     if not no_dbus:
@@ -454,14 +1208,16 @@ def wait_loop(
 
     running = True
     while running:
-        # Install initial configuration
-        nginx_config_changed_handler.reload(send_signal=False)
+        # Install initial configuration, in full as the dir may have been
+        # replaced while it wasn't watched
+        nginx_config_changed_handler.reload(send_signal=False, full=True)
 
         try:
             logger.info(f"Listening for changes to {dir_to_watch}")
             nginx_config_changed_handler.start_observer()
             while True:
-                time.sleep(1)
+                # Wakes up as soon as changes are due to be applied
+                nginx_config_changed_handler.scheduler.wait()
                 after_loop(nginx_config_changed_handler)
         except ListenTargetTerminated:
             logger.warning("Configuration dir lost, waiting for it to reappear")
@@ -524,6 +1280,71 @@ def parse_nginx_config_reloader_arguments():
         help="File name for error output",
         default=ERROR_FILE,
     )
+    parser.add_argument(
+        "--scan-workers",
+        type=int,
+        help="Number of workers to scan large config trees for forbidden directives",
+        default=SCAN_WORKERS,
+    )
+    parser.add_argument(
+        "--skip-unreferenced-reloads",
+        action="store_true",
+        help="Only sync, but don't test and reload nginx, if none of the changed "
+        "files is loaded by nginx",
+        default=False,
+    )
+    parser.add_argument(
+        "--keep-generations",
+        type=int,
+        help="Number of installed custom configs to keep to roll back to",
+        default=KEEP_GENERATIONS,
+    )
+    parser.add_argument(
+        "--generation-store-max-bytes",
+        type=int,
+        help="Most bytes of file contents to keep of installed custom configs, "
+        "0 for no limit",
+        default=GENERATION_STORE_MAX_BYTES,
+    )
+    parser.add_argument(
+        "--check-staged-config",
+        action="store_true",
+        help="Test a new custom config before installing it, instead of "
+        "restoring the old one if it fails",
+        default=False,
+    )
+    parser.add_argument(
+        "--quiet-period",
+        type=float,
+        help="Seconds without changes to wait for before applying them",
+        default=RELOAD_QUIET_PERIOD,
+    )
+    parser.add_argument(
+        "--max-latency",
+        type=float,
+        help="Most seconds to wait after the first change before applying it, "
+        "even if changes keep coming in",
+        default=RELOAD_MAX_LATENCY,
+    )
+    parser.add_argument(
+        "--watcher",
+        choices=WATCHERS,
+        help="How to watch the dir for changes: with watchdog, or with the "
+        "built-in inotify backend that uses less memory and CPU per event",
+        default=WATCHERS[0],
+    )
+    parser.add_argument(
+        "--list-generations",
+        action="store_true",
+        help="List the installed custom configs that can be rolled back to",
+        default=False,
+    )
+    parser.add_argument(
+        "--rollback",
+        metavar="GENERATION",
+        help="Install a previously installed custom config and reload nginx",
+        default=None,
+    )
     return parser.parse_args()
 
 
@@ -546,6 +1367,11 @@ def main():
         log.error(f"Invalid error file name provided: {args.error_file}")
         return 1
 
+    if args.list_generations:
+        for generation in GenerationStore(GENERATION_STORE_DIR).generations():
+            print(generation)
+        return 0
+
     if args.monitor:
         # Track changed files in the nginx config dir and reload on change
         wait_loop(
@@ -557,19 +1383,44 @@ def main():
             use_systemd=args.use_systemd,
             no_dbus=args.no_dbus,
             error_file=args.error_file,
+            scan_workers=args.scan_workers,
+            skip_unreferenced_reloads=args.skip_unreferenced_reloads,
+            keep_generations=args.keep_generations,
+            generation_store_max_bytes=args.generation_store_max_bytes,
+            check_staged_config=args.check_staged_config,
+            quiet_period=args.quiet_period,
+            max_latency=args.max_latency,
+            watcher=args.watcher,
         )
         # should never return
         return 1
     else:
+        if args.rollback:
+            # The running reloader rolls back itself, a rollback by another
+            # process would leave it with a stale idea of the installed config
+            rolled_back = request_rollback(args.rollback)
+            if rolled_back is not None:
+                return 0 if rolled_back else 1
+            log.info("No nginx-config-reloader is running, rolling back here")
         # Reload the config once
-        NginxConfigReloader(
+        reloader = NginxConfigReloader(
             logger=log,
             no_magento_config=args.nomagentoconfig,
             no_custom_config=args.nocustomconfig,
             dir_to_watch=args.watchdir,
             use_systemd=args.use_systemd,
             error_file=args.error_file,
-        ).apply_new_config()
+            scan_workers=args.scan_workers,
+            skip_unreferenced_reloads=args.skip_unreferenced_reloads,
+            keep_generations=args.keep_generations,
+            generation_store_max_bytes=args.generation_store_max_bytes,
+            check_staged_config=args.check_staged_config,
+            # A rollback doesn't scan the config
+            scan_cache_file=None if args.rollback else SCAN_CACHE_FILE,
+        )
+        if args.rollback:
+            return 0 if reloader.rollback(args.rollback) else 1
+        reloader.apply_new_config()
         return 0
 
 
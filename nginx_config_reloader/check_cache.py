@@ -0,0 +1,142 @@
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+
+from nginx_config_reloader.scanner import read_directives
+from nginx_config_reloader.settings import (
+    CONFIG_CHECK_CACHE_MAX_ENTRIES,
+    CONFIG_CHECK_CACHE_TTL,
+    MAIN_CONFIG_DIR,
+    NGINX,
+)
+from nginx_config_reloader.utils import FileIdentity, path_identity
+
+logger = logging.getLogger(__name__)
+
+# Directives with files that nginx -t reads
+FILE_DIRECTIVES = frozenset(
+    (
+        "ssl_certificate",
+        "ssl_certificate_key",
+        "ssl_client_certificate",
+        "ssl_crl",
+        "ssl_dhparam",
+        "ssl_password_file",
+        "ssl_session_ticket_key",
+        "ssl_stapling_file",
+        "ssl_trusted_certificate",
+    )
+)
+
+
+def read_file_references(path: str) -> list[str]:
+    """Return the files that the directives in the file at path make nginx read
+
+    Arguments with variables are left out, those are read per request.
+    """
+    return [
+        os.path.join(MAIN_CONFIG_DIR, arg)
+        for directive in read_directives(path, FILE_DIRECTIVES, b"ssl_")
+        for arg in directive.args
+        if "$" not in arg and not arg.startswith(("data:", "engine:"))
+    ]
+
+
+class ConfigCheckCache:
+    """Outcomes of nginx -t by a digest of the config it tested
+
+    The digest covers the synced user config, the contents of the other files
+    nginx loads, the identities of the certificates and other files those
+    refer to, and the nginx binary. Only the max_entries most recently used
+    outcomes are kept, each for at most ttl seconds, so failures that were
+    caused by something outside the config (like DNS) aren't remembered long.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = CONFIG_CHECK_CACHE_MAX_ENTRIES,
+        ttl: float = CONFIG_CHECK_CACHE_TTL,
+    ):
+        """
+        :param int max_entries: The number of outcomes to keep
+        :param float ttl: Seconds after which an outcome is forgotten
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, bool, str]] = OrderedDict()
+        self.file_hashes: dict[str, tuple[FileIdentity, bytes]] = {}
+        self.file_references: dict[str, tuple[FileIdentity, list[str]]] = {}
+
+    def key(self, config_digest: str, loaded_files: Iterable[str], is_watched) -> str:
+        """Return the digest of the effective config
+
+        :param str config_digest: The digest of the synced user config
+        :param list loaded_files: All files nginx loads
+        :param callable is_watched: Returns True for the loaded files in the
+        watched dir, which config_digest covers
+        :return str: The hex digest
+        """
+        h = hashlib.sha256(config_digest.encode())
+        h.update(repr(path_identity(NGINX)).encode())
+        loaded_files = sorted(loaded_files)
+        seen = set(loaded_files)
+        references = set()
+        for path in loaded_files:
+            references.update(self._references(path))
+            if not is_watched(path):
+                h.update(b"\0F" + os.fsencode(path) + b"\0" + self._hash(path))
+        for path in sorted(references):
+            seen.add(path)
+            h.update(b"\0R" + os.fsencode(path) + repr(path_identity(path)).encode())
+
+        for cache in (self.file_hashes, self.file_references):
+            for path in cache.keys() - seen:
+                del cache[path]
+        return h.hexdigest()
+
+    def get(self, key: str) -> tuple[bool, str] | None:
+        """Return whether the config passed the check and the output of nginx,
+        or None if that is not known"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stored_at, passed, output = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return passed, output
+
+    def put(self, key: str, passed: bool, output: str):
+        self.entries[key] = (time.monotonic(), passed, output)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _hash(self, path: str) -> bytes:
+        identity = path_identity(path)
+        cached = self.file_hashes.get(path)
+        if cached and cached[0] == identity:
+            return cached[1]
+        try:
+            with open(path, "rb") as f:
+                file_hash = hashlib.file_digest(f, "sha256").digest()
+        except OSError:
+            return os.urandom(32)
+        # A file that was gone when its identity was read isn't known by it
+        if identity is not None:
+            self.file_hashes[path] = (identity, file_hash)
+        return file_hash
+
+    def _references(self, path: str) -> list[str]:
+        identity = path_identity(path)
+        cached = self.file_references.get(path)
+        if cached and cached[0] == identity:
+            return cached[1]
+        references = read_file_references(path)
+        if identity is not None:
+            self.file_references[path] = (identity, references)
+        return references
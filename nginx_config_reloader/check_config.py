@@ -0,0 +1,168 @@
+import glob
+import logging
+import os
+import shutil
+import tempfile
+
+from nginx_config_reloader.scanner import read_directives
+from nginx_config_reloader.settings import CUSTOM_CONFIG_DIR, MAIN_CONFIG_FILE
+from nginx_config_reloader.tokenizer import Directive
+from nginx_config_reloader.utils import expand_glob, is_below
+
+logger = logging.getLogger(__name__)
+
+
+def read_include_directives(path: str) -> list[Directive]:
+    """Return the include directives in the file at path, with their offsets
+
+    Reading stops at syntax errors, nginx -t reports those.
+    """
+    return [
+        directive
+        for directive in read_directives(path, ("include",), b"include")
+        if len(directive.args) == 1
+    ]
+
+
+def _quote(path: str) -> bytes:
+    escaped = path.replace("\\", "\\\\").replace('"', '\\"')
+    return os.fsencode(f'"{escaped}"')
+
+
+class StagedConfigCheck:
+    """nginx config to test a staged custom config with, before installing it
+
+    The files of the main config that include the custom config dir, directly
+    or through other files, are copied to a scratch dir with those includes
+    pointed at the staging dir instead. The copy of the main config is placed
+    next to it, so relative includes resolve to the same files when nginx is
+    run with -c path. Includes of globs that match both files that have to be
+    rewritten and files that don't are expanded into one include per file, in
+    the same sorted order nginx uses.
+
+    Other directives that read files, like ssl_certificate, still read them
+    from the installed custom config dir.
+    """
+
+    def __init__(
+        self,
+        staging_dir: str,
+        main_config: str = MAIN_CONFIG_FILE,
+        custom_dir: str = CUSTOM_CONFIG_DIR,
+    ):
+        """
+        :param str staging_dir: The dir with the custom config to test
+        :param str main_config: The nginx config file nginx normally loads
+        :param str custom_dir: The dir the custom config will be installed to
+        """
+        self.staging_dir = os.path.normpath(staging_dir)
+        self.main_config = os.path.normpath(main_config)
+        self.main_dir = os.path.dirname(self.main_config)
+        self.custom_dir = os.path.normpath(custom_dir)
+        self.path: str | None = None
+        self.scratch_dir: str | None = None
+        self.includes: dict[str, list[Directive]] = {}
+        self.needs_rewrite: dict[str, bool] = {}
+
+    def __enter__(self) -> "StagedConfigCheck":
+        self.scratch_dir = tempfile.mkdtemp(prefix="nginx-config-check-")
+        fd, self.path = tempfile.mkstemp(
+            prefix=".nginx-config-check-", suffix=".conf", dir=self.main_dir
+        )
+        os.close(fd)
+        try:
+            self._write(self.main_config, self.path)
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        if self.scratch_dir:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+    def translate(self, output: bytes) -> bytes:
+        """Replace the paths of the check config in nginx output by the
+        paths they stand for"""
+        replacements = [
+            (self.path, self.main_config),
+            (self.scratch_dir, ""),
+            (self.staging_dir + "/", self.custom_dir + "/"),
+        ]
+        for old, new in replacements:
+            output = output.replace(os.fsencode(old), os.fsencode(new))
+        return output
+
+    def _map(self, path: str) -> str:
+        if is_below(path, self.custom_dir):
+            return self.staging_dir + path[len(self.custom_dir) :]
+        return path
+
+    def _resolve(self, pattern: str) -> str:
+        return os.path.normpath(os.path.join(self.main_dir, pattern))
+
+    def _include_directives(self, path: str) -> list[Directive]:
+        if path not in self.includes:
+            self.includes[path] = read_include_directives(path)
+        return self.includes[path]
+
+    def _needs_rewrite(self, path: str) -> bool:
+        """Return True if the file at path includes the custom config dir"""
+        if path not in self.needs_rewrite:
+            # Include cycles are rejected by nginx
+            self.needs_rewrite[path] = False
+            self.needs_rewrite[path] = any(
+                self._map(self._resolve(directive.args[0]))
+                != self._resolve(directive.args[0])
+                or any(map(self._needs_rewrite, self._expand(directive.args[0])))
+                for directive in self._include_directives(path)
+            )
+        return self.needs_rewrite[path]
+
+    def _expand(self, pattern: str) -> list[str]:
+        path = self._map(self._resolve(pattern))
+        if glob.has_magic(path):
+            return expand_glob(path)
+        return [path] if os.path.isfile(path) else []
+
+    def _rewritten(self, path: str) -> str:
+        """Return the path of the file to include instead of path"""
+        if not self._needs_rewrite(path):
+            return path
+        # Files are only written in the with block, which makes the dir
+        assert self.scratch_dir is not None
+        rewritten = self.scratch_dir + path
+        if not os.path.exists(rewritten):
+            os.makedirs(os.path.dirname(rewritten), exist_ok=True)
+            # Create it first, so include cycles don't recurse forever
+            open(rewritten, "wb").close()
+            self._write(path, rewritten)
+        return rewritten
+
+    def _write(self, path: str, dest: str):
+        with open(path, "rb") as f:
+            data = f.read()
+        parts = []
+        offset = 0
+        for directive in self._include_directives(path):
+            pattern = self._map(self._resolve(directive.args[0]))
+            paths = self._expand(directive.args[0])
+            if any(map(self._needs_rewrite, paths)):
+                includes = [self._rewritten(match) for match in paths]
+            elif pattern != self._resolve(directive.args[0]):
+                includes = [pattern]
+            else:
+                continue
+            parts.append(data[offset : directive.start])
+            # The ; after the directive is kept, so a directive that isn't
+            # terminated still fails the check
+            parts.append(b"; ".join(b"include " + _quote(i) for i in includes))
+            offset = directive.end
+        parts.append(data[offset:])
+        with open(dest, "wb") as f:
+            f.write(b"".join(parts))
@@ -1,31 +1,210 @@
+import errno
+import fnmatch
 import logging
 import os
-from subprocess import STDOUT, check_output
+import shutil
+import stat
+import tempfile
 
 from nginx_config_reloader.settings import SYNC_IGNORE_FILES
 
 logger = logging.getLogger(__name__)
 
+# Dirs are readable for everyone, like rsync's --chmod=D755
+DIR_MODE = 0o755
+# Files lose their setuid, setgid and sticky bits and others can't write or execute
+# them, like rsync's --chmod=-s,Fo-wx
+FILE_MODE_MASK = 0o777 & ~(stat.S_IWOTH | stat.S_IXOTH)
+
+
+class SyncError(OSError):
+    """Raised if some files could not be synced, after syncing all other files"""
+
+    def __init__(self, errors: list[str]):
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
 
 def safe_copy_files(src, dest, ignore_files: list[str] | None = None):
+    """Make dest a copy of the contents of src
+
+    Only files that were added or changed since the last sync, by size and
+    mtime, or by a ctime later than that of the copy, are copied. Files in dest that aren't in src are removed. Symlinks
+    are followed and copied as the files or dirs they point to, and files with
+    a name that matches one of ignore_files are skipped. Everything in dest is
+    owned by root, dirs get mode 0755 and files lose their special bits and
+    write and execute permissions for others.
+
+    Changed files are written to a temporary file that is renamed over the old
+    one, so files in dest are never modified in place.
+
+    :param str src: The dir to copy from
+    :param str dest: The dir to copy to, created if it doesn't exist
+    :param list ignore_files: Glob patterns of file names that aren't copied
+    """
     if not ignore_files:
         ignore_files = list(SYNC_IGNORE_FILES)
+    _Sync(ignore_files).run(src, dest)
+
+
+class _Sync:
+    def __init__(self, ignore_files: list[str]):
+        self.ignore_files = ignore_files
+        self.as_root = os.geteuid() == 0
+        self.umask = os.umask(0)
+        os.umask(self.umask)
+        self.errors: list[str] = []
+        self.copied = 0
+
+    def run(self, src: str, dest: str):
+        try:
+            st = os.stat(src)
+        except OSError as e:
+            raise SyncError([f"Can't sync {src}: {e.strerror}"]) from e
+        self._sync_dir(src, dest, {(st.st_dev, st.st_ino)})
+        logger.debug(f"Synced {src} to {dest}, copied {self.copied} files")
+        if self.errors:
+            raise SyncError(self.errors)
+
+    def _is_ignored(self, name: str) -> bool:
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.ignore_files)
+
+    def _sync_dir(self, src: str, dest: str, parents: set[tuple[int, int]]):
+        self._make_dir(dest)
+        try:
+            with os.scandir(src) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            self.errors.append(f"Can't read dir {src}: {e.strerror}")
+            return
+
+        synced = set()
+        for entry in entries:
+            if self._is_ignored(entry.name):
+                continue
+            try:
+                st = entry.stat()
+            except OSError as e:
+                self.errors.append(
+                    f"Symlink {entry.path} has no referent: {e.strerror}"
+                )
+                continue
+
+            target = os.path.join(dest, entry.name)
+            if stat.S_ISDIR(st.st_mode):
+                if (st.st_dev, st.st_ino) in parents:
+                    self.errors.append(f"Symlink {entry.path} points to a parent dir")
+                    continue
+                synced.add(entry.name)
+                self._sync_dir(entry.path, target, parents | {(st.st_dev, st.st_ino)})
+            elif stat.S_ISREG(st.st_mode):
+                synced.add(entry.name)
+                self._sync_file(entry.path, st, target)
+            else:
+                logger.debug(f"Not syncing {entry.path}, it is not a file or dir")
+
+        self._remove_extraneous(dest, synced)
+
+    def _make_dir(self, path: str):
+        mode = DIR_MODE & ~self.umask
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            os.mkdir(path, mode)
+            st = os.lstat(path)
+        if not stat.S_ISDIR(st.st_mode):
+            os.unlink(path)
+            os.mkdir(path, mode)
+            st = os.lstat(path)
+        if stat.S_IMODE(st.st_mode) != mode:
+            os.chmod(path, mode)
+        if self.as_root and (st.st_uid, st.st_gid) != (0, 0):
+            os.chown(path, 0, 0)
+
+    def _sync_file(self, src: str, st: os.stat_result, dest: str):
+        mode = st.st_mode & FILE_MODE_MASK & ~self.umask
+        try:
+            dest_st = os.lstat(dest)
+        except FileNotFoundError:
+            dest_st = None
+        if dest_st is not None and self._is_up_to_date(st, mode, dest_st):
+            return
+
+        dest_dir, name = os.path.split(dest)
+        fd, tmp = tempfile.mkstemp(prefix=f".{name}.", dir=dest_dir)
+        try:
+            try:
+                with open(src, "rb") as f:
+                    _copy_data(f.fileno(), fd, st.st_size)
+            except OSError as e:
+                self.errors.append(f"Can't copy {src}: {e.strerror}")
+                os.unlink(tmp)
+                return
+            os.fchmod(fd, mode)
+            if self.as_root:
+                os.fchown(fd, 0, 0)
+            os.utime(fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        finally:
+            os.close(fd)
+
+        if dest_st is not None and stat.S_ISDIR(dest_st.st_mode):
+            shutil.rmtree(dest)
+        os.rename(tmp, dest)
+        self.copied += 1
+
+    def _is_up_to_date(
+        self, st: os.stat_result, mode: int, dest_st: os.stat_result
+    ) -> bool:
+        # The copy is written after the source was read, so a source that was
+        # written since has a later ctime, even if its mtime was set back
+        return (
+            stat.S_ISREG(dest_st.st_mode)
+            and dest_st.st_size == st.st_size
+            and dest_st.st_mtime_ns == st.st_mtime_ns
+            and st.st_ctime_ns <= dest_st.st_ctime_ns
+            and stat.S_IMODE(dest_st.st_mode) == mode
+            and (not self.as_root or (dest_st.st_uid, dest_st.st_gid) == (0, 0))
+        )
+
+    def _remove_extraneous(self, dest: str, synced: set[str]):
+        with os.scandir(dest) as it:
+            extraneous = [entry for entry in it if entry.name not in synced]
+        for entry in extraneous:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+
+
+def _copy_data(src_fd: int, dest_fd: int, size: int):
+    """Copy size bytes from src_fd to dest_fd without copying them to userspace
+
+    copy_file_range can share the data blocks on filesystems that support it.
+    It isn't supported across all filesystems, sendfile is used in that case.
+    """
+    copy = os.copy_file_range
+    offset = 0
+    while True:
+        try:
+            copied = copy(src_fd, dest_fd, max(size - offset, 1 << 20))
+        except OSError as e:
+            if copy is _sendfile or e.errno not in (
+                errno.EXDEV,
+                errno.ENOSYS,
+                errno.EINVAL,
+                errno.EOPNOTSUPP,
+            ):
+                raise
+            # Both move the file offsets, so sendfile continues where this stopped
+            copy = _sendfile
+            continue
+        if not copied:
+            return
+        offset += copied
+
 
-    cmd = [
-        # Adding a / at the end copies contents of the dir and not the dir itself
-        # This is achieved with `os.path.join(x, '')`, which ensures a trailing slash
-        "rsync",
-        os.path.join(src, ""),
-        dest,
-        # Delete and archive without copying over permissions, aka -da but without -p (-a equals -rlptgoD)
-        "-drltgoD",
-        "--chown",
-        "root:root",
-        "--copy-links",  # Follow symlinks and copy actual file
-        # Dirs default to 0755 to read. Remove setuid bits. Remove executability for others
-        '--chmod="D755,-s,Fo-wx"',
-    ]
-    cmd.extend([f'--exclude="{pattern}"' for pattern in ignore_files])
-    cmd = " ".join(cmd)
-    # shell=True to ensure globs are not escaped
-    check_output(cmd, shell=True, stderr=STDOUT)
+def _sendfile(src_fd: int, dest_fd: int, count: int) -> int:
+    return os.sendfile(dest_fd, src_fd, None, count)
@@ -0,0 +1,27 @@
+from dasbus.error import DBusError
+
+from nginx_config_reloader.dbus.common import NGINX_CONFIG_RELOADER, SYSTEM_BUS
+
+# The errors of calls to a service that doesn't run
+SERVICE_NOT_RUNNING_ERRORS = (
+    "org.freedesktop.DBus.Error.ServiceUnknown",
+    "org.freedesktop.DBus.Error.NameHasNoOwner",
+)
+
+
+def request_rollback(generation: str) -> bool | None:
+    """Have the running reloader install a previously installed config, so
+    its state follows the rollback
+
+    :param str generation: The generation to roll back to
+    :return bool: True if the rollback succeeded, or None if no reloader
+    runs on the system bus
+    """
+    if not SYSTEM_BUS.check_connection():
+        return None
+    try:
+        return NGINX_CONFIG_RELOADER.get_proxy().Rollback(generation)
+    except DBusError as e:
+        if getattr(e, "dbus_name", None) in SERVICE_NOT_RUNNING_ERRORS:
+            return None
+        raise
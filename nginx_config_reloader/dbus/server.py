@@ -1,6 +1,7 @@
 from dasbus.server.interface import dbus_interface, dbus_signal
 from dasbus.server.property import emits_properties_changed
 from dasbus.server.template import InterfaceTemplate
+from dasbus.typing import Bool, Int, List, Str
 
 from nginx_config_reloader.dbus.common import NGINX_CONFIG_RELOADER
 
@@ -18,4 +19,16 @@ class NginxConfigReloaderInterface(InterfaceTemplate):
     def Reload(self):
         """Mark the last reload at current time."""
         # send_signal=False because we don't want to emit the signal
-        self.implementation.reload(send_signal=False)
+        self.implementation.reload(send_signal=False, full=True)
+
+    def ListGenerations(self) -> List[Str]:
+        """The installed configs that can be rolled back to, oldest first."""
+        return self.implementation.generation_store.generations()
+
+    def Rollback(self, generation: Str) -> Bool:
+        """Install a previously installed config and reload nginx."""
+        return self.implementation.rollback(generation)
+
+    def WatchCount(self) -> Int:
+        """The number of dirs that are watched for changes."""
+        return self.implementation.watch_count()
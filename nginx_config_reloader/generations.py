@@ -0,0 +1,186 @@
+import hashlib
+import logging
+import os
+import shutil
+import stat
+
+from nginx_config_reloader.settings import (
+    GENERATION_STORE_DIR,
+    GENERATION_STORE_MAX_BYTES,
+    KEEP_GENERATIONS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationStore:
+    """Store of the custom configs that were installed, to roll back to
+
+    Every file content is stored once under objects/, named by its hash and
+    mode. A generation is a directory under generations/ with the tree of the
+    config, of which the files are hardlinks to the objects. The objects are
+    hardlinks to the files of the installed config they were added from, so
+    adding a generation doesn't copy any data. This relies on files in the
+    custom config dir being replaced rather than written to, like the sync
+    does, and on the store being on the same filesystem.
+
+    Only the newest generations are kept, at most keep of them and as many as
+    fit in max_bytes of unique file contents, but always the newest one.
+    """
+
+    def __init__(
+        self,
+        directory: str = GENERATION_STORE_DIR,
+        keep: int = KEEP_GENERATIONS,
+        max_bytes: int = GENERATION_STORE_MAX_BYTES,
+    ):
+        """
+        :param str directory: The dir to keep the store in
+        :param int keep: The number of generations to keep
+        :param int max_bytes: The most bytes of file contents to keep, 0 for
+        no limit
+        """
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, "objects")
+        self.generations_dir = os.path.join(directory, "generations")
+        self.keep = max(keep, 1)
+        self.max_bytes = max_bytes
+        # The object of an installed file, by its path and inode. Linking
+        # changes the ctime, so the file identity can't be used. But installed
+        # files are never written to and the object keeps the inode from being
+        # reused, so the inode stands for the contents while the object exists.
+        self.file_objects: dict[str, tuple[tuple[int, int], str]] = {}
+
+    def generations(self) -> list[str]:
+        """Return the names of the generations in the store, oldest first"""
+        try:
+            names = os.listdir(self.generations_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if name.isdigit())
+
+    def add(self, directory: str) -> str:
+        """Add the config in directory as the newest generation
+
+        If it is the same as the newest generation, no generation is added.
+
+        :param str directory: The installed config dir
+        :return str: The name of the generation with the config
+        """
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.generations_dir, exist_ok=True)
+        generations = self.generations()
+        name = f"{int(generations[-1]) + 1 if generations else 1:08d}"
+        staging = os.path.join(self.generations_dir, f".{name}")
+        shutil.rmtree(staging, ignore_errors=True)
+
+        seen: set[str] = set()
+        self._link_tree(directory, staging, seen)
+        for path in self.file_objects.keys() - seen:
+            del self.file_objects[path]
+
+        if generations and _tree(staging) == _tree(self.path(generations[-1])):
+            shutil.rmtree(staging)
+            return generations[-1]
+        os.rename(staging, os.path.join(self.generations_dir, name))
+        logger.debug(f"Added config generation {name}")
+        self.prune()
+        return name
+
+    def path(self, generation: str) -> str:
+        """Return the dir of generation"""
+        if generation not in self.generations():
+            raise FileNotFoundError(f"No config generation {generation}")
+        return os.path.join(self.generations_dir, generation)
+
+    def checkout(self, generation: str, dest: str):
+        """Make dest a copy of generation, of hardlinks to the stored files
+
+        :param str generation: The name of the generation
+        :param str dest: The dir to place the generation in, removed first
+        """
+        source = self.path(generation)
+        shutil.rmtree(dest, ignore_errors=True)
+        shutil.copytree(source, dest, copy_function=os.link)
+
+    def prune(self):
+        """Remove the generations that aren't kept and unused file contents"""
+        generations = self.generations()
+        removed = generations[: -self.keep]
+        generations = generations[-self.keep :]
+        if self.max_bytes:
+            usage = {name: _tree_usage(self.path(name)) for name in generations}
+            while len(generations) > 1:
+                used: dict[tuple[int, int], int] = {}
+                for name in generations:
+                    used.update(usage[name])
+                if sum(used.values()) <= self.max_bytes:
+                    break
+                removed.append(generations.pop(0))
+
+        for name in removed:
+            logger.debug(f"Removing config generation {name}")
+            shutil.rmtree(os.path.join(self.generations_dir, name))
+        if removed:
+            self._collect_garbage()
+
+    def _collect_garbage(self):
+        # Objects that are only linked from the store itself aren't used by any
+        # generation nor by the installed configs
+        for root, _, files in os.walk(self.objects_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.lstat(path).st_nlink == 1:
+                    os.unlink(path)
+
+    def _link_tree(self, source: str, dest: str, seen: set[str]):
+        os.mkdir(dest)
+        with os.scandir(source) as it:
+            entries = list(it)
+        for entry in entries:
+            target = os.path.join(dest, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                self._link_tree(entry.path, target, seen)
+            elif entry.is_file(follow_symlinks=False):
+                seen.add(entry.path)
+                os.link(self._object(entry.path), target)
+
+    def _object(self, path: str) -> str:
+        st = os.lstat(path)
+        inode = st.st_dev, st.st_ino
+        cached = self.file_objects.get(path)
+        if cached and cached[0] == inode and os.path.exists(cached[1]):
+            return cached[1]
+
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        mode = stat.S_IMODE(st.st_mode)
+        obj = os.path.join(self.objects_dir, digest[:2], f"{digest[2:]}.{mode:o}")
+        if not os.path.exists(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            os.link(path, obj)
+        self.file_objects[path] = (inode, obj)
+        return obj
+
+
+def _tree(directory: str) -> set[tuple[str, int]]:
+    """Return the paths in directory with the inodes of the files"""
+    tree = set()
+    for root, dirs, files in os.walk(directory):
+        relative = os.path.relpath(root, directory)
+        tree.update((os.path.join(relative, name), 0) for name in dirs)
+        tree.update(
+            (os.path.join(relative, name), os.lstat(os.path.join(root, name)).st_ino)
+            for name in files
+        )
+    return tree
+
+
+def _tree_usage(directory: str) -> dict[tuple[int, int], int]:
+    """Return the sizes of the files in directory by their device and inode"""
+    usage = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            st = os.lstat(os.path.join(root, name))
+            usage[(st.st_dev, st.st_ino)] = st.st_size
+    return usage
@@ -0,0 +1,315 @@
+import fnmatch
+import glob
+import logging
+import os
+from collections.abc import Iterable
+
+from nginx_config_reloader.scanner import read_directives
+from nginx_config_reloader.settings import (
+    CUSTOM_CONFIG_DIR,
+    MAGENTO1_CONF,
+    MAGENTO2_CONF,
+    MAIN_CONFIG_DIR,
+    MAIN_CONFIG_FILE,
+    SYNC_IGNORE_FILES,
+)
+from nginx_config_reloader.utils import (
+    FileIdentity,
+    expand_glob,
+    glob_matches,
+    is_below,
+    path_identity,
+)
+
+logger = logging.getLogger(__name__)
+
+# The magento config is switched by the reloader itself after the config was
+# checked, so the files of both variants count as entry points.
+INCLUDE_GRAPH_ROOTS = (MAIN_CONFIG_FILE, MAGENTO1_CONF, MAGENTO2_CONF)
+
+
+class IncludeNode:
+    def __init__(
+        self, identity: FileIdentity | None, patterns: list[str], realpath: str
+    ):
+        self.identity = identity
+        self.patterns = patterns
+        self.realpath = realpath
+        self.targets: list[str] | None = None
+        # The patterns with the symlinked dirs they go through resolved, as
+        # they were when the targets were expanded
+        self.real_patterns: list[str] = []
+
+
+def read_includes(path: str) -> list[str]:
+    """Return the arguments of all include directives in the file at path
+
+    Reading stops at syntax errors, nginx -t rejects such a file anyway.
+    """
+    return [
+        directive.args[0]
+        for directive in read_directives(path, ("include",), b"include")
+        if len(directive.args) == 1
+    ]
+
+
+class IncludeGraph:
+    """Index of the files in the watched dir that nginx actually loads
+
+    nginx only reads the user config that is included, directly or through
+    other included files, from its main config. Starting from the entry points
+    in INCLUDE_GRAPH_ROOTS, include directives are followed like nginx does:
+    relative paths are relative to the main config dir and globs are expanded
+    with glob(3). Includes of CUSTOM_CONFIG_DIR are resolved in the watched
+    dir, where the files that will be copied there live.
+
+    The graph is updated incrementally: only the watched files that changed and
+    the main config files whose identity changed are read again. Includes of
+    the main config are expanded again on every update, as files there aren't
+    watched. If the main config can't be read, the graph can't tell which
+    files are loaded and all files count as reachable.
+
+    A file that is included through a symlinked dir is known by that path,
+    while the tree walks and the observer know it by one other path to the
+    same dir. So besides their paths, the real paths and the device and inode
+    of the reachable files are kept, to find them by any path.
+    """
+
+    def __init__(
+        self,
+        dir_to_watch: str,
+        ignore_files: Iterable[str] = SYNC_IGNORE_FILES,
+        roots: Iterable[str] = INCLUDE_GRAPH_ROOTS,
+    ):
+        """
+        :param str dir_to_watch: The directory with the user config
+        :param list ignore_files: Glob patterns of file names that aren't synced
+        :param list roots: The files nginx starts reading its config from, the
+        main config first
+        """
+        self.dir_to_watch = os.path.normpath(dir_to_watch)
+        self.ignore_files = list(ignore_files)
+        self.roots = [os.path.normpath(root) for root in roots]
+        self.nodes: dict[str, IncludeNode] = {}
+        # Reverse index: the files that include a file, of all files read so far
+        self.includers: dict[str, set[str]] = {}
+        self.reachable: set[str] | None = None
+        # The real paths and the device and inode of the reachable files
+        self.realpaths: set[str] = set()
+        self.inodes: set[tuple[int, int]] = set()
+
+    def is_watched(self, path: str) -> bool:
+        return is_below(path, self.dir_to_watch)
+
+    def is_reachable(self, path: str) -> bool:
+        """Return True if nginx loads the file at path, or if that is unknown"""
+        return (
+            self.reachable is None
+            or os.path.normpath(path) in self.reachable
+            or os.path.realpath(path) in self.realpaths
+        )
+
+    def loads_any(self, paths: Iterable[str]) -> bool:
+        """Return True if nginx loads any of paths, or a file below one of them
+
+        Like is_reachable, this is True if it is unknown which files are loaded.
+        """
+        if self.reachable is None:
+            return True
+        for path in paths:
+            path, realpath = os.path.normpath(path), os.path.realpath(path)
+            if any(is_below(reachable, path) for reachable in self.reachable) or any(
+                is_below(reachable, realpath) for reachable in self.realpaths
+            ):
+                return True
+        return False
+
+    def loaded_below(self, paths: Iterable[str]) -> list[str]:
+        """Return the watched files that nginx loads among or below paths
+
+        Unlike loads_any, nothing is returned if it is unknown which files are
+        loaded.
+        """
+        if self.reachable is None:
+            return []
+        pairs = [(os.path.normpath(path), os.path.realpath(path)) for path in paths]
+        return sorted(
+            reachable
+            for reachable in self.reachable
+            if self.is_watched(reachable)
+            and any(
+                is_below(reachable, path)
+                or is_below(self.nodes[reachable].realpath, realpath)
+                for path, realpath in pairs
+            )
+        )
+
+    def resolve_pattern(self, pattern: str) -> str:
+        """Return the absolute pattern an include argument refers to
+
+        Includes of the installed user config are mapped to the watched dir.
+        """
+        path = os.path.normpath(os.path.join(MAIN_CONFIG_DIR, pattern))
+        if is_below(path, CUSTOM_CONFIG_DIR):
+            path = self.dir_to_watch + path[len(CUSTOM_CONFIG_DIR) :]
+        return path
+
+    def is_synced(self, path: str) -> bool:
+        """Return True if the file at path is copied to the custom config dir"""
+        if not self.is_watched(path):
+            return True
+        relative = os.path.relpath(path, self.dir_to_watch)
+        return not any(
+            fnmatch.fnmatch(part, pattern)
+            for part in relative.split("/")
+            for pattern in self.ignore_files
+        )
+
+    def update(self, changed_paths: Iterable[str] = ()) -> set[str]:
+        """Bring the graph up to date with changes of the files below it
+
+        Changes are reported by one path to a dir that may be linked to from
+        elsewhere, so files and patterns are matched against them by their
+        real paths too. Files and patterns of which the real path changed,
+        because a symlink on the way was repointed, are read and expanded
+        again. So are files of which the identity changed, in case their
+        change wasn't reported.
+
+        :param list changed_paths: Paths in the watched dir that were created,
+        modified, moved or deleted since the last update. A directory stands
+        for everything below it.
+        :return set: The paths whose reachability changed
+        """
+        changed_paths = [os.path.normpath(path) for path in changed_paths]
+        real_changed = [os.path.realpath(path) for path in changed_paths]
+        for path, node in list(self.nodes.items()):
+            if self.is_watched(path):
+                realpath = os.path.realpath(path)
+                if (
+                    realpath != node.realpath
+                    or path_identity(path) != node.identity
+                    or any(is_below(path, changed) for changed in changed_paths)
+                    or any(is_below(realpath, changed) for changed in real_changed)
+                ):
+                    self._forget(path)
+            elif path_identity(path) != node.identity:
+                self._forget(path)
+            elif any(not self.is_watched(pattern) for pattern in node.patterns):
+                self._set_targets(path, None)
+
+        for path, node in self.nodes.items():
+            if node.targets is None:
+                continue
+            real_patterns = [_real_pattern(pattern) for pattern in node.patterns]
+            if (
+                real_patterns != node.real_patterns
+                or any(
+                    _matches(pattern, changed)
+                    for pattern in node.patterns
+                    for changed in changed_paths
+                )
+                or any(
+                    _matches(pattern, changed)
+                    for pattern in real_patterns
+                    for changed in real_changed
+                )
+            ):
+                self._set_targets(path, None)
+
+        previous = self.reachable
+        self.reachable = self._walk()
+        self._index_files()
+        if previous is None or self.reachable is None:
+            return set() if previous is self.reachable else {self.dir_to_watch}
+        return previous ^ self.reachable
+
+    def _walk(self) -> set[str] | None:
+        if not os.path.isfile(self.roots[0]):
+            logger.debug(f"{self.roots[0]} not found, all config files are reachable")
+            return None
+
+        reachable = set()
+        pending = [root for root in self.roots if os.path.isfile(root)]
+        while pending:
+            path = pending.pop()
+            if path in reachable:
+                continue
+            reachable.add(path)
+            node = self.nodes.get(path)
+            if node is None:
+                node = self.nodes[path] = IncludeNode(
+                    path_identity(path),
+                    [self.resolve_pattern(arg) for arg in read_includes(path)],
+                    os.path.realpath(path),
+                )
+            if node.targets is None:
+                node.real_patterns = [_real_pattern(p) for p in node.patterns]
+                self._set_targets(path, self._expand(node.patterns))
+            pending.extend(node.targets or ())
+        return reachable
+
+    def _index_files(self):
+        """Index the reachable files by their real path and their inode"""
+        self.realpaths = set()
+        self.inodes = set()
+        for path in self.reachable or ():
+            self.realpaths.add(self.nodes[path].realpath)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            self.inodes.add((st.st_dev, st.st_ino))
+
+    def _expand(self, patterns: list[str]) -> list[str]:
+        targets = []
+        for pattern in patterns:
+            if glob.has_magic(pattern):
+                paths = expand_glob(pattern)
+            else:
+                paths = [pattern]
+            targets.extend(
+                path for path in paths if os.path.isfile(path) and self.is_synced(path)
+            )
+        return targets
+
+    def _set_targets(self, path: str, targets: list[str] | None):
+        node = self.nodes[path]
+        for target in node.targets or ():
+            includers = self.includers.get(target)
+            if includers is not None:
+                includers.discard(path)
+                if not includers:
+                    del self.includers[target]
+        node.targets = targets
+        for target in targets or ():
+            self.includers.setdefault(target, set()).add(path)
+
+    def _forget(self, path: str):
+        self._set_targets(path, None)
+        del self.nodes[path]
+
+
+def _real_pattern(pattern: str) -> str:
+    """Return pattern with the symlinks before its first wildcard resolved"""
+    parts = pattern.split("/")
+    literal = len(parts)
+    for index, part in enumerate(parts):
+        if glob.has_magic(part):
+            literal = index
+            break
+    return os.path.join(
+        os.path.realpath("/".join(parts[:literal]) or "/"), *parts[literal:]
+    )
+
+
+def _matches(pattern: str, changed: str) -> bool:
+    """Return True if pattern may expand differently after changed changed
+
+    That is the case if changed matches as many components of pattern as it
+    has, so it is a match or a dir a match may be in.
+    """
+    parts, changed_parts = pattern.split("/"), changed.split("/")
+    return len(changed_parts) <= len(parts) and all(
+        glob_matches(part, changed_part)
+        for part, changed_part in zip(parts, changed_parts)
+    )
@@ -0,0 +1,342 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+from collections.abc import Callable
+
+from watchdog.events import (
+    DirCreatedEvent,
+    DirDeletedEvent,
+    DirModifiedEvent,
+    DirMovedEvent,
+    FileClosedEvent,
+    FileCreatedEvent,
+    FileDeletedEvent,
+    FileModifiedEvent,
+    FileMovedEvent,
+    FileSystemEventHandler,
+)
+from watchdog.observers.api import ObservedWatch
+
+from nginx_config_reloader.settings import INOTIFY_READ_SIZE
+from nginx_config_reloader.utils import is_below
+
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# Writes and attribute changes are reported as modified like watchdog does,
+# and files that were closed after writing as closed, so a change is applied
+# once the file is complete.
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+
+# struct inotify_event without the name that follows it
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        raise OSError("inotify is not available on this system")
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+def _check(result: int, path: str | None = None) -> int:
+    if result == -1:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), path)
+    return result
+
+
+def parse_events(data: bytes) -> list[tuple[int, int, int, str]]:
+    """Return the wd, mask, cookie and name of the events read from inotify
+
+    :param bytes data: What was read from the inotify fd, whole events only
+    """
+    events = []
+    offset = 0
+    while offset < len(data):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        name = data[offset : offset + length].rstrip(b"\0")
+        offset += length
+        events.append((wd, mask, cookie, os.fsdecode(name)))
+    return events
+
+
+class InotifyWatch(ObservedWatch):
+    """A path that is watched, with the handler of its events
+
+    It is a watchdog watch, so both observers are used in the same way. Unlike
+    those, watches of the same path with other handlers are told apart.
+    """
+
+    def __init__(self, handler: FileSystemEventHandler, path: str, recursive: bool):
+        super().__init__(os.path.normpath(path), recursive=recursive)
+        self.handler = handler
+
+    def __eq__(self, watch: object) -> bool:
+        return self is watch
+
+    def __ne__(self, watch: object) -> bool:
+        return self is not watch
+
+    def __hash__(self) -> int:
+        return id(self)
+
+
+class InotifyObserver:
+    """Reports the changes below watched paths to their handlers, like the
+    watchdog observer, with one inotify fd and one thread
+
+    Events are read in bulk and dispatched as the watchdog events the handlers
+    know, without a queue or a delay to pair moves in between. Like watchdog,
+    symlinked dirs are not followed.
+    """
+
+    def __init__(self, on_overflow: Callable[[], None] | None = None):
+        """
+        :param callable on_overflow: Called when the kernel dropped events
+        """
+        self.libc = _load_libc()
+        self.on_overflow = on_overflow
+        self.fd = _check(self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        self.stop_read, self.stop_write = os.pipe()
+        self.lock = threading.RLock()
+        # The watches and the paths of the dirs they watch, by descriptor. One
+        # dir can be part of more than one watch.
+        self.paths: dict[int, dict[InotifyWatch, str]] = {}
+        self.watches: list[InotifyWatch] = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.closed = False
+
+    def schedule(
+        self, handler: FileSystemEventHandler, path: str, recursive: bool = False
+    ) -> InotifyWatch:
+        """Watch path, and the dirs below it if recursive
+
+        :return InotifyWatch: The watch, to unschedule it
+        """
+        watch = InotifyWatch(handler, path, recursive)
+        with self.lock:
+            self._add_watch(watch, watch.path)
+            if recursive:
+                self._add_subdirs(watch, watch.path)
+            self.watches.append(watch)
+        return watch
+
+    def unschedule(self, watch: ObservedWatch):
+        if not isinstance(watch, InotifyWatch):
+            return
+        with self.lock:
+            if watch in self.watches:
+                self.watches.remove(watch)
+            for wd in [wd for wd, paths in self.paths.items() if watch in paths]:
+                self._remove_wd(wd, watch)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        os.write(self.stop_write, b"\0")
+
+    def join(self, timeout: float | None = None):
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+        if self.thread.is_alive() or self.closed:
+            return
+        self.closed = True
+        for fd in (self.fd, self.stop_read, self.stop_write):
+            os.close(fd)
+
+    def run(self):
+        poll = select.poll()
+        poll.register(self.fd, select.POLLIN)
+        poll.register(self.stop_read, select.POLLIN)
+        while True:
+            ready = {fd for fd, _ in poll.poll()}
+            if self.stop_read in ready:
+                return
+            try:
+                data = os.read(self.fd, INOTIFY_READ_SIZE)
+            except BlockingIOError:
+                continue
+            self.dispatch(parse_events(data))
+
+    def dispatch(self, events: list[tuple[int, int, int, str]]):
+        """Dispatch the events of one read to the handlers of their watches
+
+        A move within the watched dirs is reported as a move when both halves
+        were read at once, which they are as the kernel queues them together.
+        """
+        moved_to = {
+            cookie: (wd, name)
+            for wd, mask, cookie, name in events
+            if mask & IN_MOVED_TO
+        }
+        paired = set()
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("Inotify event queue overflowed, events were lost")
+                if self.on_overflow:
+                    self.on_overflow()
+                continue
+            with self.lock:
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+                    continue
+                if mask & IN_MOVED_FROM and cookie in moved_to:
+                    paired.add(cookie)
+                    dispatched = self._moved(wd, mask, name, *moved_to[cookie])
+                elif mask & IN_MOVED_TO and cookie in paired:
+                    continue
+                else:
+                    dispatched = self._events(wd, mask, name)
+            for handler, event in dispatched:
+                handler.dispatch(event)
+
+    def _events(
+        self, wd: int, mask: int, name: str, only: InotifyWatch | None = None
+    ) -> list:
+        is_directory = bool(mask & IN_ISDIR)
+        events = []
+        for watch, directory in list(self.paths.get(wd, {}).items()):
+            if only is not None and watch is not only:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if path == watch.path:
+                    events.append((watch, DirDeletedEvent(path)))
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                if is_directory:
+                    events.append((watch, DirCreatedEvent(path)))
+                    if watch.is_recursive:
+                        events.extend(self._watch_new_dir(watch, path))
+                else:
+                    events.append((watch, FileCreatedEvent(path)))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                if is_directory:
+                    self._forget_dir(watch, path)
+                    events.append((watch, DirDeletedEvent(path)))
+                else:
+                    events.append((watch, FileDeletedEvent(path)))
+            elif mask & IN_CLOSE_WRITE:
+                if not is_directory:
+                    events.append((watch, FileClosedEvent(path)))
+            elif mask & (IN_ATTRIB | IN_MODIFY):
+                event_class = DirModifiedEvent if is_directory else FileModifiedEvent
+                events.append((watch, event_class(path)))
+        return [(watch.handler, event) for watch, event in events]
+
+    def _moved(
+        self, wd: int, mask: int, name: str, dest_wd: int, dest_name: str
+    ) -> list:
+        is_directory = bool(mask & IN_ISDIR)
+        sources = self.paths.get(wd, {})
+        destinations = self.paths.get(dest_wd, {})
+        events = []
+        for watch in sources.keys() | destinations.keys():
+            if watch not in destinations:
+                # Moved out of this watch
+                events.extend(self._events(wd, mask, name, only=watch))
+                continue
+            if watch not in sources:
+                # Moved into this watch
+                dest_mask = IN_MOVED_TO | mask & IN_ISDIR
+                events.extend(self._events(dest_wd, dest_mask, dest_name, only=watch))
+                continue
+            src_path = os.path.join(sources[watch], name)
+            dest_path = os.path.join(destinations[watch], dest_name)
+            if is_directory:
+                self._rename_dir(watch, src_path, dest_path)
+                events.append((watch.handler, DirMovedEvent(src_path, dest_path)))
+            else:
+                events.append((watch.handler, FileMovedEvent(src_path, dest_path)))
+        return events
+
+    def _watch_new_dir(self, watch: InotifyWatch, path: str) -> list:
+        """Watch a new dir below a recursive watch, and report what was created
+        in it before it was watched"""
+        events = []
+        try:
+            self._add_watch(watch, path)
+        except OSError:
+            return events
+        for root, dirnames, filenames in os.walk(path):
+            for dirname in dirnames:
+                subdir = os.path.join(root, dirname)
+                try:
+                    self._add_watch(watch, subdir)
+                except OSError:
+                    continue
+                events.append((watch, DirCreatedEvent(subdir)))
+            for filename in filenames:
+                events.append((watch, FileCreatedEvent(os.path.join(root, filename))))
+        return events
+
+    def _add_subdirs(self, watch: InotifyWatch, path: str):
+        for root, dirnames, _ in os.walk(path):
+            for dirname in dirnames:
+                try:
+                    self._add_watch(watch, os.path.join(root, dirname))
+                except OSError as e:
+                    logger.debug(f"Not watching {os.path.join(root, dirname)}: {e}")
+
+    def _add_watch(self, watch: InotifyWatch, path: str):
+        wd = _check(
+            self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK), path
+        )
+        self.paths.setdefault(wd, {})[watch] = path
+
+    def _remove_wd(self, wd: int, watch: InotifyWatch):
+        paths = self.paths.get(wd, {})
+        paths.pop(watch, None)
+        if not paths:
+            self.paths.pop(wd, None)
+            # Fails if the dir is gone already, the kernel removed the watch
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def _forget_dir(self, watch: InotifyWatch, path: str):
+        """Stop watching the dirs below path that was removed or moved away"""
+        for wd, paths in list(self.paths.items()):
+            directory = paths.get(watch)
+            if directory is not None and is_below(directory, path):
+                self._remove_wd(wd, watch)
+
+    def _rename_dir(self, watch: InotifyWatch, src_path: str, dest_path: str):
+        for paths in self.paths.values():
+            directory = paths.get(watch)
+            if directory is not None and is_below(directory, src_path):
+                paths[watch] = dest_path + directory[len(src_path) :]
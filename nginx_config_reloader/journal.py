@@ -0,0 +1,53 @@
+import threading
+from typing import NamedTuple
+
+
+class Change(NamedTuple):
+    path: str
+    event_type: str
+
+
+class ChangeJournal:
+    """The changes in the watched dir that weren't applied yet
+
+    Changes are recorded from the observer thread and taken all at once when
+    they are applied. Every change increments the generation, so changes that
+    came in during an apply can be told apart from the ones it applied.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generation = 0
+        # The generation of the last time every change was recorded
+        self.entries: dict[Change, int] = {}
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self.entries)
+
+    def record(self, path: str, event_type: str) -> int:
+        """Record a change of path
+
+        :param str path: The changed path
+        :param str event_type: The kind of change, like the watchdog event type
+        :return int: The generation of the change
+        """
+        with self.lock:
+            self.generation += 1
+            self.entries[Change(path, event_type)] = self.generation
+            return self.generation
+
+    def take(self) -> tuple[int, set[Change]]:
+        """Return the generation and the pending changes, and forget those"""
+        with self.lock:
+            entries, self.entries = self.entries, {}
+            return self.generation, set(entries)
+
+    def discard(self, generation: int):
+        """Forget the changes recorded up to and including generation"""
+        with self.lock:
+            self.entries = {
+                change: recorded
+                for change, recorded in self.entries.items()
+                if recorded > generation
+            }
@@ -0,0 +1,520 @@
+import fnmatch
+import hashlib
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import time
+from collections import OrderedDict
+from collections.abc import Container, Iterable, Iterator
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import NamedTuple
+
+from nginx_config_reloader.settings import (
+    FORBIDDEN_CONFIG_DIRECTIVES,
+    PARALLEL_SCAN_MIN_FILES,
+    PARALLEL_SCAN_PROCESS_MIN_BYTES,
+    SCAN_CACHE_MAX_ENTRIES,
+    SCAN_FILE_TIME_BUDGET,
+    SCAN_TIME_BUDGET,
+    SCAN_TIMEOUT_MESSAGE,
+    SCAN_WINDOW_SIZE,
+)
+from nginx_config_reloader.tokenizer import (
+    ConfigSyntaxError,
+    DeadlineExceeded,
+    Directive,
+    iter_directives,
+)
+from nginx_config_reloader.utils import file_identity
+
+logger = logging.getLogger(__name__)
+
+
+class ForbiddenConfigViolation(NamedTuple):
+    path: str
+    line: int
+    message: str
+    text: str
+
+
+class ForbiddenDirectiveRule(NamedTuple):
+    arguments: re.Pattern | None
+    message: str
+
+    def matches(self, directive: Directive) -> bool:
+        if self.arguments is None:
+            return True
+        arguments = " ".join(arg.strip() for arg in directive.args)
+        return bool(self.arguments.search(arguments))
+
+
+FORBIDDEN_CONFIG_RULES = {
+    f"rule{index}": ForbiddenDirectiveRule(
+        re.compile(arguments) if arguments is not None else None, message
+    )
+    for index, (_, arguments, message) in enumerate(FORBIDDEN_CONFIG_DIRECTIVES)
+}
+# Directive names of all rules are combined into a single pattern, the named
+# group that matched tells which rule applies to a directive.
+FORBIDDEN_CONFIG_NAMES = re.compile(
+    "|".join(
+        f"(?P<rule{index}>{name})"
+        for index, (name, _, _) in enumerate(FORBIDDEN_CONFIG_DIRECTIVES)
+    )
+)
+
+
+def _literal_prefixes(pattern: str) -> list[bytes]:
+    """Return the literal text every alternative of a name pattern starts with
+
+    Every directive a rule applies to contains one of these, so files that
+    contain none of them can't have forbidden directives.
+    """
+    alternatives = []
+    depth = start = 0
+    for index, char in enumerate(pattern):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            alternatives.append(pattern[start:index])
+            start = index + 1
+    alternatives.append(pattern[start:])
+
+    prefixes = []
+    for alternative in alternatives:
+        match = re.match(r"\w*", alternative)
+        # \w* matches every string, if only an empty part of it
+        assert match is not None
+        prefix = match[0]
+        if alternative[len(prefix) : len(prefix) + 1] in ("?", "*", "{"):
+            prefix = prefix[:-1]
+        if not prefix:
+            raise ValueError(f"Rule {pattern!r} does not start with a literal")
+        prefixes.append(prefix.encode())
+    return prefixes
+
+
+FORBIDDEN_CONFIG_KEYWORDS = tuple(
+    dict.fromkeys(
+        keyword
+        for name, _, _ in FORBIDDEN_CONFIG_DIRECTIVES
+        for keyword in _literal_prefixes(name)
+    )
+)
+# Cached scan results are only valid for the rules they were produced with
+FORBIDDEN_CONFIG_RULES_DIGEST = hashlib.sha256(
+    json.dumps(FORBIDDEN_CONFIG_DIRECTIVES).encode()
+).hexdigest()
+
+
+class ScanCache:
+    """Scan results per file, keyed by the identity of the file
+
+    A file is only scanned again when its path, device, inode, size, mtime or
+    ctime changed. The ctime can't be set back like the mtime, so a file that
+    was rewritten to the same size with its old mtime is scanned again. The
+    cache is bounded to max_entries, evicting the least recently used entries,
+    and is persisted to path so it survives restarts. Results stored with a
+    different rule set are discarded on load.
+    """
+
+    def __init__(
+        self, path: str | None = None, max_entries: int = SCAN_CACHE_MAX_ENTRIES
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, list | None] = OrderedDict()
+        self.changed = False
+        self.load()
+
+    @staticmethod
+    def key(path: str, st: os.stat_result) -> str:
+        return "\0".join([path, *map(str, file_identity(st))])
+
+    def get(self, key: str) -> tuple[bool, ForbiddenConfigViolation | None]:
+        """Return (hit, violation) for key"""
+        if key not in self.entries:
+            return False, None
+        self.entries.move_to_end(key)
+        value = self.entries[key]
+        return True, ForbiddenConfigViolation(*value) if value else None
+
+    def set(self, key: str, violation: ForbiddenConfigViolation | None):
+        self.entries[key] = list(violation) if violation else None
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.changed = True
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict) or data.get("rules") != (
+            FORBIDDEN_CONFIG_RULES_DIGEST
+        ):
+            logger.debug("Discarding scan cache created with other rules")
+            return
+        for key, value in data.get("entries", [])[-self.max_entries :]:
+            self.entries[key] = value
+
+    def save(self):
+        if not self.path or not self.changed:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(
+                    {
+                        "rules": FORBIDDEN_CONFIG_RULES_DIGEST,
+                        "entries": list(self.entries.items()),
+                    },
+                    f,
+                )
+            os.replace(tmp_path, self.path)
+            self.changed = False
+        except OSError as e:
+            logger.debug(f"Unable to save scan cache to {self.path}: {e}")
+
+
+def iter_config_files(
+    directory: str, exclude_files: Iterable[str] = ()
+) -> Iterator[tuple[str, os.stat_result]]:
+    """Yield the path and stat result of every regular file below directory
+
+    Files are yielded in a stable order.
+    Symlinks are followed, because the sync copies their targets into the nginx
+    config dir. Directories that were already visited (symlink loops, or several
+    links pointing to the same directory) are only walked once.
+
+    :param str directory: The directory to walk
+    :param list exclude_files: Glob patterns of file names to skip
+    """
+    exclude_files = list(exclude_files)
+    visited = set()
+
+    def walk(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if (st.st_dev, st.st_ino) in visited:
+            return
+        visited.add((st.st_dev, st.st_ino))
+
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            return
+
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    yield from walk(entry.path)
+                elif entry.is_file() and not any(
+                    fnmatch.fnmatch(entry.name, pat) for pat in exclude_files
+                ):
+                    yield entry.path, entry.stat()
+            except OSError:
+                continue
+
+    yield from walk(directory)
+
+
+def find_forbidden_directive(
+    data, path: str, deadline: float | None = None
+) -> ForbiddenConfigViolation | None:
+    """Return the first forbidden directive in nginx configuration data, if any
+
+    Syntax errors end the search: nginx -t rejects the file anyway if it is
+    loaded. A statement cut off by the end of the file is still checked.
+
+    :raises DeadlineExceeded: When time.monotonic() passes deadline
+    """
+    # Most config files contain none of the keywords of the rules, searching
+    # for those is much cheaper than tokenizing. Directives that start after
+    # the last keyword can't match either, so tokenizing stops there.
+    last_keyword = _find_last_keyword(data)
+    if last_keyword == -1:
+        return None
+    last_line = _count_lines(data, last_keyword)
+
+    try:
+        for directive in iter_directives(data, path, deadline):
+            if directive.line > last_line:
+                break
+            match = FORBIDDEN_CONFIG_NAMES.fullmatch(directive.name)
+            if not match:
+                continue
+            # Every alternative of the names is a named group
+            assert match.lastgroup is not None
+            rule = FORBIDDEN_CONFIG_RULES[match.lastgroup]
+            if rule.matches(directive):
+                return ForbiddenConfigViolation(
+                    path=path,
+                    line=directive.line,
+                    message=rule.message,
+                    text=_line_text(data, directive.line),
+                )
+    except ConfigSyntaxError:
+        pass
+    return None
+
+
+def _release(data, start: int, end: int):
+    """Drop the pages of a memory-mapped file between start and end from memory
+
+    They are read in again if they are accessed later on.
+    """
+    if isinstance(data, mmap.mmap) and hasattr(mmap, "MADV_DONTNEED"):
+        start -= start % mmap.PAGESIZE
+        if end > start:
+            data.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+
+def _find_last_keyword(data) -> int:
+    """Return the offset of the last keyword of the rules in data, or -1
+
+    data is searched backwards in windows of SCAN_WINDOW_SIZE bytes, so only a
+    window of a memory-mapped file is in memory at a time.
+    """
+    overlap = max(len(keyword) for keyword in FORBIDDEN_CONFIG_KEYWORDS) - 1
+    end = len(data)
+    while end > 0:
+        start = max(0, end - SCAN_WINDOW_SIZE)
+        window = data[start:end]
+        last = max(window.rfind(keyword) for keyword in FORBIDDEN_CONFIG_KEYWORDS)
+        _release(data, start, end)
+        if last != -1:
+            return start + last
+        if not start:
+            break
+        # Keywords that start in this window but end in the next one
+        end = start + overlap
+    return -1
+
+
+def _count_lines(data, end: int) -> int:
+    """Return the line number of offset end in data
+
+    mmap objects have no count method, so this counts in windows.
+    """
+    lines = 1
+    for start in range(0, end, SCAN_WINDOW_SIZE):
+        stop = min(start + SCAN_WINDOW_SIZE, end)
+        lines += data[start:stop].count(b"\n")
+        _release(data, start, stop)
+    return lines
+
+
+def _line_text(data, line: int) -> str:
+    start = 0
+    for _ in range(line - 1):
+        start = data.find(b"\n", start) + 1
+    end = data.find(b"\n", start)
+    if end == -1:
+        end = len(data)
+    return data[start:end].decode(errors="replace").strip()
+
+
+@contextmanager
+def map_file(path: str) -> Iterator[mmap.mmap | bytes]:
+    """Memory-map path for reading
+
+    Empty files can't be mapped and give b"". When the mapping is closed, the
+    pages of the file are dropped from memory and from the page cache.
+    """
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            try:
+                yield data
+            finally:
+                _release(data, 0, len(data))
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def read_directives(
+    path: str, names: Container[str], keyword: bytes
+) -> list[Directive]:
+    """Return the directives in the file at path with one of names
+
+    Files without keyword, which all of names contain, aren't parsed. Reading
+    stops at syntax errors, nginx -t reports those, and after
+    SCAN_FILE_TIME_BUDGET seconds. Unreadable files have no directives.
+    """
+    try:
+        with map_file(path) as data:
+            if data.find(keyword) == -1:
+                return []
+            deadline = time.monotonic() + SCAN_FILE_TIME_BUDGET
+            directives = []
+            try:
+                for directive in iter_directives(data, path, deadline):
+                    if directive.name in names:
+                        directives.append(directive)
+            except (ConfigSyntaxError, DeadlineExceeded):
+                pass
+            return directives
+    except (OSError, ValueError):
+        return []
+
+
+def scan_file(
+    path: str, deadline: float | None = None
+) -> ForbiddenConfigViolation | None:
+    """Return the first forbidden config directive in path, if any
+
+    The file is memory-mapped instead of read, so huge files (like map files
+    with many redirects) don't end up in memory as a whole. Only tokens and the
+    line of a violation are copied out of the mapping.
+    Unreadable files are skipped, like grep did before.
+
+    :param str path: The file to scan
+    :param float deadline: time.monotonic() value the whole scan has to finish
+    by, scanning the file itself may take at most SCAN_FILE_TIME_BUDGET seconds
+    :raises DeadlineExceeded: When the file could not be scanned in time
+    """
+    now = time.monotonic()
+    if deadline is not None and now > deadline:
+        raise DeadlineExceeded(path, 1)
+    file_deadline = now + SCAN_FILE_TIME_BUDGET
+    if deadline is not None:
+        file_deadline = min(file_deadline, deadline)
+
+    try:
+        with map_file(path) as data:
+            return find_forbidden_directive(data, path, file_deadline)
+    except (OSError, ValueError):
+        return None
+
+
+def _scan_file_in_time(path: str, deadline: float) -> ForbiddenConfigViolation | None:
+    """Scan path like scan_file, reporting a file that can't be scanned
+    before deadline as a violation"""
+    # Exceptions raised by executor.map would hide the results of the files
+    # before this one, so this returns them instead.
+    try:
+        return scan_file(path, deadline)
+    except DeadlineExceeded as e:
+        return ForbiddenConfigViolation(
+            path=e.file, line=e.line, message=SCAN_TIMEOUT_MESSAGE, text=""
+        )
+
+
+def _scan_in_pool(
+    files: list[tuple[str, os.stat_result]], workers: int, deadline: float
+) -> dict[str, ForbiddenConfigViolation | None] | None:
+    """Scan files in a pool of workers, or return None if it isn't worth it
+
+    Below PARALLEL_SCAN_MIN_FILES files the overhead of a pool is larger than
+    the gain. Many small files are mostly I/O, so threads suffice. Larger
+    amounts of data are tokenized in separate processes.
+    """
+    if workers <= 1 or len(files) < PARALLEL_SCAN_MIN_FILES:
+        return None
+
+    paths = [path for path, _ in files]
+    if sum(st.st_size for _, st in files) < PARALLEL_SCAN_PROCESS_MIN_BYTES:
+        executor: Executor = ThreadPoolExecutor(max_workers=workers)
+    else:
+        # Don't fork the daemon itself, it runs watchdog and dbus threads
+        executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("forkserver")
+        )
+    logger.debug(
+        f"Scanning {len(paths)} files with {workers} {type(executor).__name__} workers"
+    )
+    with executor:
+        chunksize = max(1, len(paths) // (workers * 4))
+        results = executor.map(
+            _scan_file_in_time,
+            paths,
+            [deadline] * len(paths),
+            chunksize=chunksize,
+        )
+        return dict(zip(paths, results))
+
+
+def find_forbidden_config(
+    directory: str,
+    exclude_files: Iterable[str] = (),
+    cache: ScanCache | None = None,
+    workers: int = 1,
+    reachable: Container[str] | None = None,
+    reachable_inodes: Container[tuple[int, int]] = (),
+) -> ForbiddenConfigViolation | None:
+    """Walk directory once and return the first forbidden config directive
+
+    The first violation in walk order is returned, also when files are scanned
+    in parallel. Every file may take at most SCAN_FILE_TIME_BUDGET seconds to
+    scan and the whole scan SCAN_TIME_BUDGET seconds. If a budget runs out, the
+    file that was being scanned is reported as a violation, so pathological
+    input rejects the config instead of blocking the reloader.
+
+    :param str directory: The directory to scan
+    :param list exclude_files: Glob patterns of file names to skip
+    :param ScanCache cache: Reuse results for files that did not change
+    :param int workers: Maximum number of workers to scan large trees with
+    :param set reachable: Only scan these files, the ones nginx loads. All
+    files are scanned if this is None
+    :param set reachable_inodes: The device and inode of the files nginx
+    loads, which are scanned too when they are walked by another path, like
+    through another symlink to their dir
+    :return ForbiddenConfigViolation: The first violation, or None
+    """
+    deadline = time.monotonic() + SCAN_TIME_BUDGET
+    files = iter_config_files(directory, exclude_files)
+    if reachable is not None:
+        files = (
+            (path, st)
+            for path, st in files
+            if os.path.normpath(path) in reachable
+            or (st.st_dev, st.st_ino) in reachable_inodes
+        )
+    scanned = None
+    if workers > 1:
+        files = list(files)
+        misses = [
+            (path, st)
+            for path, st in files
+            if cache is None or not cache.get(ScanCache.key(path, st))[0]
+        ]
+        scanned = _scan_in_pool(misses, workers, deadline)
+
+    for path, st in files:
+        key = ScanCache.key(path, st)
+        hit, violation = cache.get(key) if cache is not None else (False, None)
+        if not hit:
+            if scanned is None:
+                violation = _scan_file_in_time(path, deadline)
+            else:
+                violation = scanned[path]
+            if violation is not None and violation.message == SCAN_TIMEOUT_MESSAGE:
+                # Not cached, the file may well be scanned in time next round
+                logger.warning(
+                    f"Scanning the config took too long: deadline exceeded in "
+                    f"{violation.path}:{violation.line}"
+                )
+                return violation
+            if cache is not None:
+                cache.set(key, violation)
+        if violation:
+            return violation
+    return None
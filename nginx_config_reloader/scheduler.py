@@ -0,0 +1,147 @@
+import threading
+import time
+from typing import Callable
+
+from nginx_config_reloader.settings import (
+    RELOAD_MAX_LATENCY,
+    RELOAD_QUIET_PERIOD,
+    RELOAD_WRITE_TIMEOUT,
+)
+
+
+class ReloadScheduler:
+    """Decides when changes are applied, so a burst of them is applied once
+
+    A reload is due when no change came in for quiet_period seconds, or when
+    max_latency seconds passed since the first change that wasn't applied yet,
+    so a writer that never stops still gets its changes applied.
+
+    A reload is postponed while files are being written, until they are
+    closed or until write_timeout seconds passed since the writing started,
+    so a half-written file isn't applied.
+
+    Changes may be applied by others than the waiting thread, like over DBus.
+    When pending returns False, nothing is left to apply and the changes that
+    were noted are forgotten.
+    """
+
+    def __init__(
+        self,
+        quiet_period: float = RELOAD_QUIET_PERIOD,
+        max_latency: float = RELOAD_MAX_LATENCY,
+        write_timeout: float = RELOAD_WRITE_TIMEOUT,
+        pending: Callable[[], bool] | None = None,
+    ):
+        """
+        :param float quiet_period: Seconds without changes to wait for
+        :param float max_latency: Most seconds to wait after the first change
+        :param float write_timeout: Most seconds to wait for a file that is
+        being written to be closed
+        :param pending: Returns whether there are changes that weren't
+        applied yet, None if only reset tells that
+        """
+        self.quiet_period = quiet_period
+        self.max_latency = max(max_latency, quiet_period)
+        self.write_timeout = write_timeout
+        self.pending = pending
+        self.condition = threading.Condition()
+        self.first_change: float | None = None
+        self.last_change: float | None = None
+        # The paths that are being written, with the time the writing started
+        self.writing: dict[str, float] = {}
+
+    def notify(self):
+        """Record a change, called from the observer thread"""
+        with self.condition:
+            now = time.monotonic()
+            if self.first_change is None:
+                self.first_change = now
+            self.last_change = now
+            self.condition.notify_all()
+
+    def hold(self, path: str):
+        """Record that path is being written, called from the observer thread
+
+        Only the first write of a burst wakes up the waiting thread, the later
+        ones don't change when a reload is due.
+        """
+        with self.condition:
+            now = time.monotonic()
+            self.writing.setdefault(path, now)
+            if self.first_change is None:
+                self.first_change = now
+                self.last_change = now
+                self.condition.notify_all()
+
+    def release(self, path: str):
+        """Record that path was closed or removed, so it isn't written anymore"""
+        with self.condition:
+            if self.writing.pop(path, None) is not None:
+                self.condition.notify_all()
+
+    def is_held(self, path: str) -> bool:
+        """Return True if path is being written"""
+        with self.condition:
+            return path in self.writing
+
+    def delay(self) -> float | None:
+        """Return the seconds until a reload is due, or None if no change is
+        pending"""
+        with self.condition:
+            # Changes are recorded before they are noted here, so changes
+            # that are recorded meanwhile are noted again after this
+            if self.pending is not None and not self.pending():
+                self.first_change = None
+                self.last_change = None
+            if self.first_change is None or self.last_change is None:
+                return None
+            due = min(
+                self.last_change + self.quiet_period,
+                self.first_change + self.max_latency,
+            )
+            for started in self.writing.values():
+                due = max(due, started + self.write_timeout)
+            return due - time.monotonic()
+
+    def due(self) -> bool:
+        """Return True if the pending changes may be applied now
+
+        That is also the case if there are no pending changes, for reloads
+        that weren't caused by a change.
+        """
+        delay = self.delay()
+        return delay is None or delay <= 0
+
+    def reset(self):
+        """Forget the pending changes, when they are about to be applied"""
+        with self.condition:
+            self.first_change = None
+            self.last_change = None
+            # Files that weren't closed in time are applied as they are
+            now = time.monotonic()
+            self.writing = {
+                path: started
+                for path, started in self.writing.items()
+                if started + self.write_timeout > now
+            }
+
+    def wait(self, timeout: float | None = None):
+        """Block until a reload is due or until timeout seconds passed
+
+        Without pending changes it blocks until a change comes in.
+
+        :param float timeout: Most seconds to wait, None to wait until a reload
+        is due
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                delay = self.delay()
+                if delay is not None:
+                    if delay <= 0:
+                        return
+                    remaining = delay if remaining is None else min(remaining, delay)
+                if remaining is not None and remaining <= 0:
+                    return
+                self.condition.wait(remaining)
@@ -1,7 +1,14 @@
 DIR_TO_WATCH = "/data/web/nginx"
 MAIN_CONFIG_DIR = "/etc/nginx"
+MAIN_CONFIG_FILE = MAIN_CONFIG_DIR + "/nginx.conf"
 CUSTOM_CONFIG_DIR = MAIN_CONFIG_DIR + "/app"
 BACKUP_CONFIG_DIR = MAIN_CONFIG_DIR + "/app_bak"
+# Installed custom configs are kept here to roll back to, as trees of hardlinks
+# to file contents that are stored once
+GENERATION_STORE_DIR = MAIN_CONFIG_DIR + "/app_generations"
+KEEP_GENERATIONS = 10
+# The most bytes of file contents to keep in the store, 0 for no limit
+GENERATION_STORE_MAX_BYTES = 0
 UNPRIVILEGED_GID = 1000  # This is the 'app' user on a Hypernode, or generally the first user on any system
 UNPRIVILEGED_UID = 1000  # This is the 'app' user on a Hypernode, or generally the first user on any system
 
@@ -24,36 +31,79 @@ WATCH_IGNORE_FILES = _BASE_IGNORE_FILES + ("*.crtkeyca",)
 SYNC_IGNORE_FILES = _BASE_IGNORE_FILES + ("*.flag",)
 SYSLOG_SOCKET = "/dev/log"
 
+# Changes are applied after no change came in for this many seconds, but at
+# most this many seconds after the first change
+RELOAD_QUIET_PERIOD = 0.1
+RELOAD_MAX_LATENCY = 2
+# Changes are not applied while a file is open for writing, for at most this
+# many seconds after the writing started
+RELOAD_WRITE_TIMEOUT = 10
+# The backends that can watch the config dir for changes, the first is the
+# default
+WATCHERS = ("watchdog", "inotify")
+# Most bytes of inotify events to read at once
+INOTIFY_READ_SIZE = 64 * 1024
+# Seconds between checks for newer changes while nginx -t runs
+CONFIG_TEST_POLL_INTERVAL = 0.05
+
+# Scan results of unchanged files are reused, also across restarts
+SCAN_CACHE_FILE = "/var/cache/nginx-config-reloader/scan_cache.json"
+SCAN_CACHE_MAX_ENTRIES = 100000
+# Trees with fewer files to scan than this are always scanned in one thread
+PARALLEL_SCAN_MIN_FILES = 1000
+# Use processes instead of threads if the files to scan are at least this large
+PARALLEL_SCAN_PROCESS_MIN_BYTES = 64 * 1024 * 1024
+SCAN_WORKERS = 1
+# Seconds scanning a single file and all files for forbidden directives may take
+SCAN_FILE_TIME_BUDGET = 30
+SCAN_TIME_BUDGET = 120
+SCAN_TIMEOUT_MESSAGE = (
+    "Checking the nginx config for forbidden directives took too long, so it was "
+    "not loaded. Please split up or shrink very large config files.\n"
+)
+# Outcomes of nginx -t are remembered for this many configs, for this many seconds
+CONFIG_CHECK_CACHE_MAX_ENTRIES = 64
+CONFIG_CHECK_CACHE_TTL = 3600
+# Seconds the syntax check of the changed files before nginx -t may take
+SYNTAX_CHECK_TIME_BUDGET = 5
+# Config files are memory-mapped and searched this many bytes at a time
+SCAN_WINDOW_SIZE = 16 * 1024 * 1024
+
+# For security reasons the following nginx configuration directives are forbidden.
+# Every rule consists of
+# - a regex that has to match the whole name of the directive
+# - a regex that is searched for in the arguments of the directive, with
+#   surrounding whitespace stripped from every argument and the arguments joined
+#   by a space. None means the directive is not allowed at all.
+# - the message to show when the rule matches
+#
 # Using include or load_module is forbidden unless
-# - it is in a comment
 # - the include is a relative path but does not contain  ..
 # - the include is absolute but in the MAIN_CONFIG_DIR
-# - but not in the BACKUP_CONFIG_DIR
+# - but not in the BACKUP_CONFIG_DIR or GENERATION_STORE_DIR
 # - also takes into account double slashes
-# Because of bash escaping problems we define quote's in octal format \042 == ' and \047 == "
-
-# For security reasons the following nginx configuration parameters are forbidden
-FORBIDDEN_CONFIG_REGEX = [
+FORBIDDEN_CONFIG_DIRECTIVES = [
     (
         "client_body_temp_path",
+        None,
         "Usage of configuration parameter client_body_temp_path is not allowed.\n",
     ),
     (
-        "^(?!\\s*#)\\s*(access|error)_log\\s*"
-        "(\\042|\\047)?\\s*"
-        "(?!(off|on|/+data/+|syslog:server=(?!unix)))(?=.*\\.\\.|/+(?!data)|\\w)"
-        "(\\042|\\047)?\\s*",
+        "access_log|error_log",
+        "\\.\\.|^(?!(off|on)$|/+data/+|syslog:server=(?!unix:))[/\\w]",
         "It's not allowed store access_log or error_log outside of /data/.\n",
     ),
     (
-        "^(?!\\s*#)\\s*(include|load_module)\\s*"
-        "(\\042|\\047)?\\s*"
-        "(?=.*\\.\\.|/+etc/+nginx/+app_bak|/+(?!etc/+nginx))"
-        "(\\042|\\047)?\\s*",
+        "include|load_module",
+        "\\.\\.|^/+etc/+nginx/+app_(bak|generations)|^/+(?!etc/+nginx)",
         "You are not allowed to use include or load_module in the nginx config unless the path is relative "
         "or in the main nginx config directory. "
         "See the NGINX dos and don'ts in this article: "
         "https://docs.hypernode.com/hypernode-platform/nginx/how-to-use-nginx.html\n",
     ),
-    ("init_by_lua", "Usage of Lua initialization is not allowed.\n"),
+    (
+        "init_by_lua(_block|_file)?",
+        None,
+        "Usage of Lua initialization is not allowed.\n",
+    ),
 ]
@@ -0,0 +1,254 @@
+import os
+import stat
+import threading
+from collections import deque
+from collections.abc import Iterable
+
+from nginx_config_reloader.utils import is_below
+
+# The resolved path of a symlink, and the device, inode and ctime of what it
+# resolves to, or None for those if it is dangling. The ctime of a dir is left
+# out, it changes with every file that is added to it, which the watch of the
+# dir reports already
+SymlinkTarget = tuple[str, int | None, int | None, int | None]
+
+
+def read_symlink_target(path: str) -> SymlinkTarget:
+    realpath = os.path.realpath(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return realpath, None, None, None
+    ctime = None if stat.S_ISDIR(st.st_mode) else st.st_ctime_ns
+    return realpath, st.st_dev, st.st_ino, ctime
+
+
+def alias_path(path: str, target: str, link: str) -> str:
+    """Return path below target as the path below the symlink to target"""
+    if is_below(path, target):
+        return link + path[len(target) :]
+    return path
+
+
+def _is_directory_link(link: str, previous: SymlinkTarget | None) -> bool:
+    """Return True if link is a symlink to a dir, or was one before"""
+    return os.path.isdir(link) or previous is not None and os.path.isdir(previous[0])
+
+
+class SymlinkIndex:
+    """The symlinks below the watched dir, with the identity of their targets
+
+    The index is built with one walk of the tree and then kept up to date from
+    the events of the observer. Symlinks to files are indexed too, as the sync
+    copies their targets.
+
+    Every real dir is walked once, by device and inode, however many symlinks
+    lead to it, so symlink loops end and a dir that is linked to from many
+    places costs one inotify watch. When symlinks to dirs change, only the
+    dirs that were reached through them are walked again.
+    """
+
+    def __init__(self, directory: str):
+        """
+        :param str directory: The watched dir
+        """
+        self.directory = os.path.normpath(directory)
+        self.links: dict[str, SymlinkTarget] = {}
+        # The device and inode of the walked dirs, with the directory or the
+        # symlink through which they were reached
+        self.walked: dict[tuple[int, int], str] = {}
+        # The symlinks through which the dirs outside the real tree of the
+        # directory were reached
+        self.walk_roots: list[str] = []
+        # The walk roots to watch recursively, the others are below them
+        self.watch_roots: list[str] = []
+        self.lock = threading.Lock()
+
+    @property
+    def watched_dirs(self) -> int:
+        """The number of real dirs below the directory and the watch roots"""
+        return len(self.walked)
+
+    def build(self):
+        """Index all symlinks below the directory, following symlinked dirs"""
+        with self.lock:
+            self.links = {}
+            self.walked = {}
+            self.walk_roots = self._walk([self.directory], self.walked)
+            self.watch_roots = self._outermost(self.walk_roots)
+
+    def rearm(self, changed: Iterable[str]) -> tuple[list[str], list[str]]:
+        """Walk again the dirs that were reached through changed symlinks
+
+        The dirs are walked from the changed symlinks, and from the other
+        symlinks that lead to a dir that was reached through them before.
+        The symlinks themselves are kept up to date by update.
+
+        :param list changed: The symlinks to dirs that changed
+        :return tuple: The watch roots to stop watching, and the ones to watch
+        """
+        changed = [os.path.normpath(link) for link in changed]
+        with self.lock:
+            removed = {
+                root
+                for root in self.walk_roots
+                if any(is_below(root, link) for link in changed)
+            }
+            dropped = {key for key, root in self.walked.items() if root in removed}
+            for key in dropped:
+                del self.walked[key]
+            self.walk_roots = [root for root in self.walk_roots if root not in removed]
+
+            tops = sorted(link for link in changed if os.path.isdir(link))
+            tops += sorted(
+                link
+                for link, (_, dev, ino, _) in self.links.items()
+                if (dev, ino) in dropped and link not in tops
+            )
+            added = self._walk(tops, self.walked, index_links=False)
+            self.walk_roots += added
+
+            old = self.watch_roots
+            self.watch_roots = self._outermost(self.walk_roots)
+        kept = {
+            root
+            for root in old
+            if root in self.watch_roots and root not in removed and root not in added
+        }
+        return (
+            [root for root in old if root not in kept],
+            [root for root in self.watch_roots if root not in kept],
+        )
+
+    def update(self, path: str, recursive: bool) -> dict[str, bool]:
+        """Bring the index up to date with a change of path
+
+        :param str path: The path an event was reported for
+        :param bool recursive: True if path was created, deleted or moved, so
+        the symlinks below it may have changed as well
+        :return dict: The symlinks that appeared, disappeared or of which the
+        target changed, with True for the ones that are or were symlinks to dirs
+        """
+        path = os.path.normpath(path)
+        with self.lock:
+            if recursive:
+                old = {
+                    link: self.links.pop(link)
+                    for link in list(self.links)
+                    if is_below(link, path)
+                }
+            elif path in self.links:
+                old = {path: self.links.pop(path)}
+            else:
+                old = {}
+
+            if os.path.islink(path):
+                self.links[path] = read_symlink_target(path)
+            if recursive and os.path.isdir(path):
+                self._walk([path], {})
+
+            new = {
+                link: target
+                for link, target in self.links.items()
+                if link == path or recursive and is_below(link, path)
+            }
+        return {
+            link: _is_directory_link(link, old.get(link))
+            for link in old.keys() | new.keys()
+            if old.get(link) != new.get(link)
+        }
+
+    def refresh_targets(self, target: str, replaced: bool = False) -> dict[str, bool]:
+        """Read the targets again of the symlinks that resolve to target
+
+        :param str target: A path an event was reported for outside the dir
+        :param bool replaced: True if target was removed or moved away, so the
+        symlinks changed even if a new target got the same inode
+        :return dict: The symlinks of which the target changed, like update
+        """
+        target = os.path.normpath(target)
+        changed = {}
+        with self.lock:
+            for link, (realpath, *_) in list(self.links.items()):
+                if realpath != target:
+                    continue
+                previous, current = self.links[link], read_symlink_target(link)
+                if replaced or current != previous:
+                    self.links[link] = current
+                    changed[link] = _is_directory_link(link, previous)
+        return changed
+
+    def target_parents(self) -> set[str]:
+        """Return the dirs outside the directory that contain symlink targets
+
+        Changes of a target itself, like a new inode, other permissions or
+        written contents, are reported by a watch on the dir that contains it.
+        """
+        with self.lock:
+            parents = {
+                os.path.dirname(realpath) for realpath, *_ in self.links.values()
+            }
+        return {
+            parent
+            for parent in parents
+            if not is_below(parent, self.directory) and os.path.isdir(parent)
+        }
+
+    def _walk(
+        self,
+        tops: list[str],
+        walked: dict[tuple[int, int], str],
+        index_links: bool = True,
+    ) -> list[str]:
+        """Walk the real dirs below tops that weren't walked yet, once each
+
+        The real trees of tops are walked first, then the symlinked dirs in the
+        order they were found, so a dir is reached through the shortest path.
+
+        :param list tops: The dirs to start from
+        :param dict walked: The walked dirs, updated with the newly walked ones
+        :param bool index_links: True to index the symlinks that are found
+        :return list: The symlinks through which new dirs were walked
+        """
+        roots = []
+        pending = deque(tops)
+        while pending:
+            root = pending.popleft()
+            if index_links and os.path.islink(root):
+                self.links[root] = read_symlink_target(root)
+            stack = [root]
+            while stack:
+                path = stack.pop()
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if (st.st_dev, st.st_ino) in walked:
+                    continue
+                walked[(st.st_dev, st.st_ino)] = root
+                if path == root and root != self.directory:
+                    roots.append(root)
+                try:
+                    with os.scandir(path) as it:
+                        entries = sorted(it, key=lambda entry: entry.name)
+                except OSError:
+                    continue
+                for entry in entries:
+                    if entry.is_symlink():
+                        if index_links:
+                            self.links[entry.path] = read_symlink_target(entry.path)
+                        if entry.is_dir():
+                            pending.append(entry.path)
+                    elif entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+        return roots
+
+    @staticmethod
+    def _outermost(roots: list[str]) -> list[str]:
+        """Leave out the roots of which the target is below that of another
+        root, the recursive watch of that one covers them"""
+        kept: list[tuple[str, str]] = []
+        for realpath, root in sorted((os.path.realpath(root), root) for root in roots):
+            if not any(is_below(realpath, other) for other, _ in kept):
+                kept.append((realpath, root))
+        return [root for _, root in kept]
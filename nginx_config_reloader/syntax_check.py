@@ -0,0 +1,54 @@
+import logging
+import time
+from collections.abc import Iterable
+
+from nginx_config_reloader.scanner import map_file
+from nginx_config_reloader.settings import SYNTAX_CHECK_TIME_BUDGET
+from nginx_config_reloader.tokenizer import (
+    ConfigSyntaxError,
+    DeadlineExceeded,
+    iter_directives,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def check_syntax(path: str, deadline: float | None = None):
+    """Parse the nginx config file at path like nginx does
+
+    Every file is parsed on its own by nginx, so braces have to be balanced
+    and statements terminated within the file that contains them.
+
+    :param str path: The config file
+    :param float deadline: time.monotonic() value after which DeadlineExceeded
+    is raised
+    :raises ConfigSyntaxError: On the first syntax error in the file
+    """
+    with map_file(path) as data:
+        for _ in iter_directives(data, path, deadline):
+            pass
+
+
+def find_syntax_errors(
+    paths: Iterable[str], budget: float = SYNTAX_CHECK_TIME_BUDGET
+) -> list[ConfigSyntaxError]:
+    """Return the first syntax error of each file in paths that has one
+
+    Files that can't be read or parsed within the budget are left to nginx -t.
+
+    :param list paths: The config files
+    :param float budget: Seconds all files may take together
+    """
+    deadline = time.monotonic() + budget
+    errors = []
+    for path in paths:
+        try:
+            check_syntax(path, deadline)
+        except ConfigSyntaxError as e:
+            errors.append(e)
+        except DeadlineExceeded:
+            logger.debug(f"Syntax check of {path} took too long, skipping the rest")
+            break
+        except (OSError, ValueError):
+            pass
+    return errors
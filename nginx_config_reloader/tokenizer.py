@@ -0,0 +1,248 @@
+import os
+import re
+import time
+from collections.abc import Iterator
+from typing import NamedTuple
+
+# Mirrors the lexer of nginx (ngx_conf_read_token): tokens are separated by
+# whitespace, ";", "{" and "}". Quotes and "#" comments are only recognized at
+# the start of a token, a backslash escapes the next character and "${" does
+# not open a block. All repetitions are possessive, so every byte of the input
+# is looked at a constant number of times.
+_SPACE = rb"(?P<space>[ \t\r\n]++)"
+_COMMENT = rb"(?P<comment>#[^\n]*+)"
+_SPECIAL = rb"(?P<special>[;{}])"
+_DQUOTED = rb'"(?P<dquoted>(?:[^"\\]|\\.)*+)"'
+_SQUOTED = rb"'(?P<squoted>(?:[^'\\]|\\.)*+)'"
+_WORD = rb"(?P<word>(?:\\.|\$\{|[^ \t\r\n;{}\"'#\\])" rb"(?:\\.|\$\{|[^ \t\r\n;{\\])*+)"
+_TOKEN = re.compile(
+    b"|".join((_SPACE, _COMMENT, _SPECIAL, _DQUOTED, _SQUOTED, _WORD)), re.DOTALL
+)
+# A quoted token has to be followed by one of these (or the end of the input)
+_AFTER_QUOTE = frozenset(b" \t\r\n;{)")
+
+# The contents of *_by_lua_block directives are Lua code, which ngx_lua reads
+# up to the matching brace while skipping Lua strings and comments.
+_LUA_BLOCK_SUFFIX = b"_by_lua_block"
+# Only the start of strings and long brackets is matched, their end is looked
+# up separately. This way unterminated ones can't make the search quadratic.
+_LUA = re.compile(
+    rb"(?:--)?\[(?P<level>=*+)\["
+    rb"|--[^\n]*+"
+    rb"|(?P<quote>[\"'])"
+    rb"|(?P<brace>[{}])"
+)
+_LUA_STRING_END = {
+    b'"': re.compile(rb'(?:[^"\\\n]|\\.)*+"', re.DOTALL),
+    b"'": re.compile(rb"(?:[^'\\\n]|\\.)*+'", re.DOTALL),
+}
+
+_ESCAPE = re.compile(rb"\\(.)", re.DOTALL)
+_ESCAPES = {b'"': b'"', b"'": b"'", b"\\": b"\\", b"t": b"\t", b"r": b"\r", b"n": b"\n"}
+
+UNEXPECTED_EOF = 'unexpected end of file, expecting ";" or "}"'
+# nginx reads tokens in a buffer of this size and rejects longer ones
+MAX_TOKEN_LENGTH = 4096
+# Number of tokens between checks of the deadline
+_DEADLINE_INTERVAL = 256
+
+
+class ConfigSyntaxError(Exception):
+    def __init__(self, file: str, line: int, message: str):
+        super().__init__(f"{message} in {file}:{line}")
+        self.file = file
+        self.line = line
+        self.message = message
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, file: str, line: int):
+        super().__init__(file, line)
+        self.file = file
+        self.line = line
+
+    def __str__(self):
+        return f"deadline exceeded in {self.file}:{self.line}"
+
+
+class Token(NamedTuple):
+    kind: str  # "word", ";", "{", "}" or "lua" for the body of a Lua block
+    value: bytes
+    line: int
+    # Offsets of the token in the data, including quotes
+    start: int = 0
+    end: int = 0
+
+
+class Directive(NamedTuple):
+    name: str
+    args: tuple[str, ...]
+    file: str
+    line: int
+    # Offsets of the name and arguments in the data, without the ; or { after
+    start: int = 0
+    end: int = 0
+
+
+def _unescape(match: re.Match[bytes]) -> bytes:
+    return _ESCAPES.get(match[1], match[0])
+
+
+def _skip_lua_block(
+    data, pos: int, path: str, line: int, deadline: float | None = None
+) -> int:
+    depth = 1
+    search = _LUA.search
+    matches = 0
+    while match := search(data, pos):
+        pos = match.end()
+        matches += 1
+        if (
+            deadline is not None
+            and not matches % _DEADLINE_INTERVAL
+            and time.monotonic() > deadline
+        ):
+            raise DeadlineExceeded(path, line)
+        if match["level"] is not None:
+            close = b"]" + match["level"] + b"]"
+            pos = data.find(close, pos)
+            if pos == -1:
+                break
+            pos += len(close)
+        elif match["quote"] is not None:
+            string_end = _LUA_STRING_END[match["quote"]].match(data, pos)
+            if string_end is None:
+                raise ConfigSyntaxError(path, line, "unfinished string in Lua block")
+            pos = string_end.end()
+        elif match["brace"] == b"{":
+            depth += 1
+        elif match["brace"] == b"}":
+            depth -= 1
+            if depth == 0:
+                return pos
+    raise ConfigSyntaxError(path, line, 'unexpected end of file, expecting "}"')
+
+
+def tokenize(
+    data, path: str = "<string>", deadline: float | None = None
+) -> Iterator[Token]:
+    """Yield the tokens of nginx configuration data in a single linear pass
+
+    :param bytes data: The configuration, any bytes-like object is accepted
+    :param str path: File name to use in error messages
+    :param float deadline: time.monotonic() value after which DeadlineExceeded
+    is raised
+    """
+    pos = 0
+    end = len(data)
+    line = 1
+    first_word = None
+    match_token = _TOKEN.match
+    tokens = 0
+
+    while pos < end:
+        match = match_token(data, pos)
+        if match is None:
+            # An unterminated quote or a trailing backslash
+            raise ConfigSyntaxError(path, line, UNEXPECTED_EOF)
+
+        tokens += 1
+        if (
+            deadline is not None
+            and not tokens % _DEADLINE_INTERVAL
+            and time.monotonic() > deadline
+        ):
+            raise DeadlineExceeded(path, line)
+
+        kind = match.lastgroup
+        # Every alternative of the token pattern is a named group
+        assert kind is not None
+        if kind == "space":
+            line += match[kind].count(b"\n")
+        elif kind == "special":
+            char = match[kind]
+            yield Token(char.decode(), char, line, match.start(), match.end())
+            if (
+                char == b"{"
+                and first_word is not None
+                and first_word.endswith(_LUA_BLOCK_SUFFIX)
+            ):
+                lua_end = _skip_lua_block(data, match.end(), path, line, deadline)
+                body = data[match.end() : lua_end - 1]
+                yield Token("lua", body, line, match.end(), lua_end - 1)
+                yield Token("}", b"}", line + body.count(b"\n"), lua_end - 1, lua_end)
+                line += body.count(b"\n")
+                pos = lua_end
+                first_word = None
+                continue
+            first_word = None
+        elif kind != "comment":
+            if match.end() - pos > MAX_TOKEN_LENGTH:
+                raise ConfigSyntaxError(
+                    path, line, f'too long parameter "{chr(data[pos])}..." started'
+                )
+            value = match[kind]
+            if kind != "word":
+                following = match.end()
+                if following < end and data[following] not in _AFTER_QUOTE:
+                    raise ConfigSyntaxError(
+                        path, line, f'unexpected "{chr(data[following])}"'
+                    )
+            if b"\\" in value:
+                value = _ESCAPE.sub(_unescape, value)
+            yield Token("word", value, line, pos, match.end())
+            if first_word is None:
+                first_word = value
+            line += match[0].count(b"\n")
+        pos = match.end()
+
+
+def iter_directives(
+    data, path: str = "<string>", deadline: float | None = None
+) -> Iterator[Directive]:
+    """Yield every directive in nginx configuration data
+
+    Block directives are yielded when their block opens, the directives inside
+    the block follow. A statement that is cut off by the end of the input is
+    still yielded before the ConfigSyntaxError is raised, so callers looking for
+    particular directives see it too.
+
+    :param bytes data: The configuration, any bytes-like object is accepted
+    :param str path: File name to use in the directives and error messages
+    :param float deadline: time.monotonic() value after which DeadlineExceeded
+    is raised
+    """
+    words: list[Token] = []
+    last_line = 1
+    depth = 0
+
+    for token in tokenize(data, path, deadline):
+        last_line = token.line
+        if token.kind == "word":
+            words.append(token)
+        elif token.kind in (";", "{"):
+            if not words:
+                raise ConfigSyntaxError(path, token.line, f'unexpected "{token.kind}"')
+            yield _directive(words, path)
+            words = []
+            if token.kind == "{":
+                depth += 1
+        elif token.kind == "}":
+            if words or not depth:
+                raise ConfigSyntaxError(path, token.line, 'unexpected "}"')
+            depth -= 1
+
+    if words:
+        yield _directive(words, path)
+        raise ConfigSyntaxError(path, last_line, UNEXPECTED_EOF)
+    if depth:
+        raise ConfigSyntaxError(
+            path, last_line, 'unexpected end of file, expecting "}"'
+        )
+
+
+def _directive(words: list[Token], path: str) -> Directive:
+    name, *args = (os.fsdecode(word.value) for word in words)
+    return Directive(
+        name, tuple(args), path, words[0].line, words[0].start, words[-1].end
+    )
@@ -0,0 +1,117 @@
+import fnmatch
+import hashlib
+import logging
+import os
+import stat
+from collections.abc import Iterable
+
+from nginx_config_reloader.settings import SYNC_IGNORE_FILES
+from nginx_config_reloader.utils import FileIdentity, file_identity
+
+logger = logging.getLogger(__name__)
+
+
+class TreeDigest:
+    """Merkle digest of a config dir as it ends up in the custom config dir
+
+    The digest covers the paths and contents of all files that are synced, with
+    symlinks followed like the sync does, and the targets of those symlinks.
+    Touching a file or changing its mode doesn't change the digest. The hash of
+    a file is cached by its identity, so only files that may have changed are
+    read again. A dir that is linked to more than once is only hashed once.
+    """
+
+    def __init__(self, ignore_files: Iterable[str] = SYNC_IGNORE_FILES):
+        """
+        :param list ignore_files: Glob patterns of file names that aren't synced
+        """
+        self.ignore_files = list(ignore_files)
+        self.file_hashes: dict[str, tuple[FileIdentity, bytes]] = {}
+
+    def digest(self, directory: str, extra: Iterable[bytes] = ()) -> str:
+        """Return the digest of directory
+
+        :param str directory: The directory to compute the digest of
+        :param list extra: Other state to include in the digest
+        :return str: The hex digest
+        """
+        seen: set[str] = set()
+        root_hash, _ = self._directory_hash(directory, set(), seen, {})
+        root = hashlib.sha256(root_hash)
+        for value in extra:
+            root.update(b"\0" + value)
+        for path in self.file_hashes.keys() - seen:
+            del self.file_hashes[path]
+        return root.hexdigest()
+
+    def _directory_hash(
+        self, path: str, parents: set, seen: set[str], hashed: dict
+    ) -> tuple[bytes, bool]:
+        """Return the hash of the dir at path, and False if a symlink below it
+        loops back to one of its parents, so the hash depends on them
+
+        :param dict hashed: The hashes of the dirs without loops below them by
+        device and inode, so every dir that is linked to more than once is
+        hashed once
+        """
+        h = hashlib.sha256()
+        try:
+            st = os.stat(path)
+        except OSError:
+            return h.digest(), True
+        key = (st.st_dev, st.st_ino)
+        if key in hashed:
+            return hashed[key], True
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            return h.digest(), True
+        parents = parents | {key}
+        acyclic = True
+
+        for entry in entries:
+            if any(fnmatch.fnmatch(entry.name, pat) for pat in self.ignore_files):
+                continue
+            name = os.fsencode(entry.name)
+            try:
+                if entry.is_symlink():
+                    h.update(b"L" + name + b"\0" + os.fsencode(os.readlink(entry.path)))
+                entry_st = entry.stat()
+            except OSError:
+                # A dangling symlink, the sync fails on it
+                h.update(b"X" + name + b"\0")
+                continue
+
+            if stat.S_ISDIR(entry_st.st_mode):
+                if (entry_st.st_dev, entry_st.st_ino) in parents:
+                    h.update(b"C" + name + b"\0")
+                    acyclic = False
+                    continue
+                child, child_acyclic = self._directory_hash(
+                    entry.path, parents, seen, hashed
+                )
+                acyclic = acyclic and child_acyclic
+                h.update(b"D" + name + b"\0" + child)
+            elif stat.S_ISREG(entry_st.st_mode):
+                file_hash = self._file_hash(entry.path, entry_st)
+                seen.add(entry.path)
+                h.update(b"F" + name + b"\0" + file_hash)
+        if acyclic:
+            hashed[key] = h.digest()
+        return h.digest(), acyclic
+
+    def _file_hash(self, path: str, st: os.stat_result) -> bytes:
+        identity = file_identity(st)
+        cached = self.file_hashes.get(path)
+        if cached and cached[0] == identity:
+            return cached[1]
+        try:
+            with open(path, "rb") as f:
+                file_hash = hashlib.file_digest(f, "sha256").digest()
+        except OSError:
+            # Unreadable files make the sync fail, so they never compare equal
+            logger.debug(f"Unable to read {path} for the config digest")
+            return os.urandom(32)
+        self.file_hashes[path] = (identity, file_hash)
+        return file_hash
@@ -1,7 +1,65 @@
+import ctypes
+import errno
+import fnmatch
+import glob
 import json
+import logging
 import os
 import subprocess
 
+logger = logging.getLogger(__name__)
+
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+# The device, inode, size, mtime and ctime of a file. Writing to a file,
+# replacing it or changing its mode changes its identity, even if its mtime is
+# set back.
+FileIdentity = tuple[int, int, int, int, int]
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_renameat2 = getattr(_libc, "renameat2", None)
+if _renameat2 is not None:
+    _renameat2.argtypes = [
+        ctypes.c_int,
+        ctypes.c_char_p,
+        ctypes.c_int,
+        ctypes.c_char_p,
+        ctypes.c_uint,
+    ]
+    _renameat2.restype = ctypes.c_int
+
+GLOB_NOMATCH = 3
+
+
+class _GlobT(ctypes.Structure):
+    # glob_t of glibc and musl, up to the fields that are read
+    _fields_ = [
+        ("gl_pathc", ctypes.c_size_t),
+        ("gl_pathv", ctypes.POINTER(ctypes.c_char_p)),
+        ("gl_offs", ctypes.c_size_t),
+        ("gl_flags", ctypes.c_int),
+        ("gl_funcs", ctypes.c_void_p * 5),
+    ]
+
+
+_glob = getattr(_libc, "glob", None)
+_globfree = getattr(_libc, "globfree", None)
+if _glob is not None and _globfree is not None:
+    _glob.argtypes = [
+        ctypes.c_char_p,
+        ctypes.c_int,
+        ctypes.c_void_p,
+        ctypes.POINTER(_GlobT),
+    ]
+    _glob.restype = ctypes.c_int
+    _globfree.argtypes = [ctypes.POINTER(_GlobT)]
+    _globfree.restype = None
+_fnmatch = getattr(_libc, "fnmatch", None)
+if _fnmatch is not None:
+    _fnmatch.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]
+    _fnmatch.restype = ctypes.c_int
+
 
 def apply_chmod(path, mode, preexec_fn=None):
     if isinstance(mode, int):
@@ -23,6 +81,57 @@ def apply_chmod(path, mode, preexec_fn=None):
     )
 
 
+def file_identity(st: os.stat_result) -> FileIdentity:
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+
+
+def path_identity(path: str) -> FileIdentity | None:
+    """Return the identity of the file at path, or None if it can't be read"""
+    try:
+        return file_identity(os.stat(path))
+    except OSError:
+        return None
+
+
+def is_below(path: str, directory: str) -> bool:
+    """Return True if path is directory or a path below it"""
+    return path == directory or path.startswith(directory + "/")
+
+
+def expand_glob(pattern: str) -> list[str]:
+    """Return the paths that match pattern, sorted, like nginx expands the
+    globs in includes
+
+    nginx uses glob(3), which differs from the glob module: [!x] and [^x] both
+    negate and a backslash escapes the next character. The glob module is only
+    used if libc has no glob.
+    """
+    if _glob is None or _globfree is None:
+        return sorted(glob.glob(pattern))
+    result = _GlobT()
+    try:
+        status = _glob(os.fsencode(pattern), 0, None, ctypes.byref(result))
+        if status == GLOB_NOMATCH:
+            return []
+        if status != 0:
+            # nginx fails to load the config in that case
+            logger.debug(f"glob() of {pattern} failed with {status}")
+            return []
+        return [os.fsdecode(result.gl_pathv[i]) for i in range(result.gl_pathc)]
+    finally:
+        _globfree(ctypes.byref(result))
+
+
+def glob_matches(pattern: str, path: str) -> bool:
+    """Return True if path matches pattern, with the syntax of glob(3)
+
+    Unlike with glob(3), wildcards match slashes and a leading dot.
+    """
+    if _fnmatch is None:
+        return fnmatch.fnmatchcase(path, pattern)
+    return _fnmatch(os.fsencode(pattern), os.fsencode(path), 0) == 0
+
+
 def directory_is_unmounted(path):
     output = subprocess.check_output(
         ["systemctl", "list-units", "-t", "mount", "--all", "-o", "json"],
@@ -33,3 +142,28 @@ def directory_is_unmounted(path):
         if unit["description"] == path:
             return unit["active"] != "active" or unit["sub"] != "mounted"
     return False
+
+
+def exchange_paths(a, b):
+    """Atomically swap the files or dirs at a and b
+
+    Uses renameat2 with RENAME_EXCHANGE. Where the kernel, libc or filesystem
+    doesn't support that, the paths are swapped with three renames, during which
+    b briefly doesn't exist.
+    """
+    if _renameat2 is not None:
+        if (
+            _renameat2(
+                AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE
+            )
+            == 0
+        ):
+            return
+        error = ctypes.get_errno()
+        if error not in (errno.ENOSYS, errno.EINVAL):
+            raise OSError(error, os.strerror(error), a, None, b)
+    logger.debug(f"Atomic exchange of {a} and {b} not supported, renaming instead")
+    tmp = f"{b}.exchange"
+    os.rename(b, tmp)
+    os.rename(a, b)
+    os.rename(tmp, a)
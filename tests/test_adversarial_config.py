@@ -0,0 +1,149 @@
+import os
+import shutil
+import time
+from tempfile import mkdtemp
+
+from nginx_config_reloader.scanner import (
+    ScanCache,
+    find_forbidden_config,
+    find_forbidden_directive,
+)
+from nginx_config_reloader.settings import SCAN_TIMEOUT_MESSAGE
+from nginx_config_reloader.tokenizer import DeadlineExceeded
+from tests.testcase import TestCase
+
+# Scanning these inputs takes minutes instead of a fraction of a second if the
+# scan is quadratic in any of them
+SIZE = 64 * 1024
+# Seconds of noise to allow for when comparing scan times
+TIME_MARGIN = 0.25
+# Makes sure the keyword prefilter doesn't skip tokenizing the input
+FORBIDDEN = b"\ninclude /etc/passwd;\n"
+
+
+def adversarial_configs(size: int) -> dict[str, bytes]:
+    """Return configs of about size bytes that are slow to scan if the scan
+    of any of their constructs isn't linear"""
+    repeat = size // 4096
+    return {
+        "long_include_argument": b"include " + b"a" * size + b";" + FORBIDDEN,
+        "long_quoted_argument": b'include "' + b"a" * size + b'";' + FORBIDDEN,
+        "many_arguments": b"access_log " + b"a " * (size // 2) + b";" + FORBIDDEN,
+        "many_dots": b"access_log " + b"/data/. " * (size // 8) + b";" + FORBIDDEN,
+        "many_slashes": (b"include " + b"/" * 4000 + b"etc/nginx/app_bak;\n") * repeat,
+        "many_escaped_quotes": FORBIDDEN + b'return 200 "' + b'\\"' * size,
+        "many_unterminated_quotes": FORBIDDEN + b"return 200 " + b'"a' * size,
+        "many_variables": (b"set $a " + b"${" * 2000 + b";" + FORBIDDEN) * repeat,
+        "many_backslashes": (b"return 200 " + b"\\\\" * 2000 + b";" + FORBIDDEN)
+        * repeat,
+        "deep_nesting": b"location / {" * (size // 16)
+        + FORBIDDEN
+        + b"}" * (size // 16),
+        "many_comments": b"#include /etc/passwd;\n" * (size // 16) + b"include a;\n",
+        "many_keywords": b"include fastcgi_params;\n" * (size // 16),
+        "lua_escaped_quotes": b"content_by_lua_block {\n"
+        + b'"'
+        + b'\\"' * size
+        + b"\n}"
+        + FORBIDDEN,
+        "lua_unterminated_long_comments": b"content_by_lua_block {\n"
+        + b"--[[\n" * (size // 4)
+        + b"}"
+        + FORBIDDEN,
+        "lua_unterminated_long_strings": b"content_by_lua_block {\n"
+        + b"[==[" * (size // 4)
+        + b"}"
+        + FORBIDDEN,
+        "lua_many_braces": b"content_by_lua_block {"
+        + b"{" * size
+        + b"}" * size
+        + b"}"
+        + FORBIDDEN,
+    }
+
+
+class TestAdversarialConfig(TestCase):
+    def test_adversarial_configs_are_scanned_in_linear_time(self):
+        small, large = adversarial_configs(SIZE // 4), adversarial_configs(SIZE)
+        for name in small:
+            # A quadratic scan of the large config takes 16 times as long
+            self.assertLess(
+                self._scan_time(large[name], name),
+                8 * self._scan_time(small[name], name) + TIME_MARGIN,
+                name,
+            )
+
+    def test_adversarial_configs_stop_at_deadline(self):
+        monotonic = self.set_up_patch(
+            "nginx_config_reloader.tokenizer.time.monotonic", return_value=100.0
+        )
+        for name, data in adversarial_configs(SIZE).items():
+            monotonic.reset_mock()
+
+            try:
+                find_forbidden_directive(data, name, deadline=99.0)
+            except DeadlineExceeded:
+                pass
+
+            # Scans that take long check the deadline, and stop at the first
+            # check
+            self.assertLessEqual(monotonic.call_count, 1, name)
+
+    @staticmethod
+    def _scan_time(data, name):
+        """Return the shortest time of a few scans of data, which the load of
+        the machine affects least"""
+        times = []
+        for _ in range(3):
+            start = time.monotonic()
+            find_forbidden_directive(data, name)
+            times.append(time.monotonic() - start)
+        return min(times)
+
+
+class TestScanTimeBudget(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.set_up_patch("nginx_config_reloader.scanner.PARALLEL_SCAN_MIN_FILES", 2)
+        for name in ("a.conf", "c.conf"):
+            self._write(name, b"location / {}\n")
+        self._write("b.conf", b"include fastcgi_params;\n" * 10000)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_file_over_budget_is_rejected(self):
+        self.set_up_patch("nginx_config_reloader.scanner.SCAN_FILE_TIME_BUDGET", -1)
+
+        violation = find_forbidden_config(self.dir)
+
+        self.assertEqual(violation.path, os.path.join(self.dir, "b.conf"))
+        self.assertEqual(violation.message, SCAN_TIMEOUT_MESSAGE)
+
+    def test_scan_over_budget_is_rejected(self):
+        self.set_up_patch("nginx_config_reloader.scanner.SCAN_TIME_BUDGET", -1)
+
+        violation = find_forbidden_config(self.dir)
+
+        self.assertEqual(violation.path, os.path.join(self.dir, "a.conf"))
+        self.assertEqual(violation.message, SCAN_TIMEOUT_MESSAGE)
+
+    def test_file_over_budget_is_rejected_when_scanning_in_parallel(self):
+        self.set_up_patch("nginx_config_reloader.scanner.SCAN_FILE_TIME_BUDGET", -1)
+
+        violation = find_forbidden_config(self.dir, workers=2)
+
+        self.assertEqual(violation.path, os.path.join(self.dir, "b.conf"))
+        self.assertEqual(violation.message, SCAN_TIMEOUT_MESSAGE)
+
+    def test_file_over_budget_is_not_cached(self):
+        cache = ScanCache()
+        self.set_up_patch("nginx_config_reloader.scanner.SCAN_FILE_TIME_BUDGET", -1)
+        find_forbidden_config(self.dir, cache=cache)
+        self.set_up_patch("nginx_config_reloader.scanner.SCAN_FILE_TIME_BUDGET", 30)
+
+        self.assertIsNone(find_forbidden_config(self.dir, cache=cache))
+
+    def _write(self, name, contents):
+        with open(os.path.join(self.dir, name), "wb") as f:
+            f.write(contents)
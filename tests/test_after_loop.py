@@ -1,14 +1,16 @@
+import threading
 from tempfile import mkdtemp
 from unittest.mock import Mock
 
 import nginx_config_reloader
+from nginx_config_reloader.journal import Change
 from tests.testcase import TestCase
 
 
 class TestAfterLoop(TestCase):
     def setUp(self) -> None:
         self.source = mkdtemp()
-        self.set_up_patch(
+        self.directory_is_unmounted = self.set_up_patch(
             "nginx_config_reloader.directory_is_unmounted", return_value=False
         )
 
@@ -22,49 +24,168 @@ class TestAfterLoop(TestCase):
     def test_it_applies_config_if_tree_dirty(self):
         tm = self._get_nginx_config_reloader_instance()
         tm.apply_new_config = Mock()
-        tm.dirty = True
+        tm.changes.record(self.source, "modified")
 
         nginx_config_reloader.after_loop(tm)
 
-        tm.apply_new_config.assert_called_once_with()
+        tm.apply_new_config.assert_called_once_with(full=False)
         self.assertFalse(tm.dirty)
 
+    def test_it_does_not_apply_config_before_changes_are_due(self):
+        tm = self._get_nginx_config_reloader_instance()
+        tm.apply_new_config = Mock()
+        tm.changes.record(self.source, "modified")
+        tm.scheduler.notify()
+
+        nginx_config_reloader.after_loop(tm)
+
+        tm.apply_new_config.assert_not_called()
+        self.assertTrue(tm.dirty)
+
+    def test_changes_during_reload_are_applied_by_next_reload(self):
+        tm = self._get_nginx_config_reloader_instance()
+        tm.changes.record(self.source, "modified")
+        tm.apply_new_config = Mock(
+            side_effect=lambda full: tm.changes.record(self.source + "/a", "modified")
+        )
+
+        nginx_config_reloader.after_loop(tm)
+
+        self.assertTrue(tm.dirty)
+        self.assertEqual(
+            {change.path for change in tm.changes.take()[1]}, {self.source + "/a"}
+        )
+
+    def test_changes_during_an_apply_over_dbus_are_kept_for_the_next_one(self):
+        tm = self._get_nginx_config_reloader_instance()
+        started, done = threading.Event(), threading.Event()
+
+        def apply(full):
+            tm.changes.take()
+            started.set()
+            done.wait(5)
+            return True
+
+        tm._apply = Mock(side_effect=apply)
+        dbus = threading.Thread(target=tm.reload, kwargs={"send_signal": False})
+        dbus.start()
+        started.wait(5)
+        tm.changes.record(self.source, "modified")
+
+        nginx_config_reloader.after_loop(tm)
+        done.set()
+        dbus.join()
+
+        tm._apply.assert_called_once()
+        self.assertTrue(tm.dirty)
+        self.assertIsNotNone(tm.scheduler.delay())
+
+    def test_changes_applied_over_dbus_are_not_waited_for(self):
+        tm = self._get_nginx_config_reloader_instance()
+        tm.apply_new_config = Mock()
+        tm.changes.record(self.source, "modified")
+        tm.scheduler.notify()
+
+        tm.changes.take()
+        nginx_config_reloader.after_loop(tm)
+
+        tm.apply_new_config.assert_not_called()
+        self.assertIsNone(tm.scheduler.delay())
+
+    def test_changes_are_kept_while_the_dir_is_unmounted(self):
+        tm = self._get_nginx_config_reloader_instance()
+        tm.apply_new_config = Mock()
+        tm.changes.record(self.source, "modified")
+        self.directory_is_unmounted.return_value = True
+
+        nginx_config_reloader.after_loop(tm)
+
+        tm.apply_new_config.assert_not_called()
+        self.assertTrue(tm.dirty)
+        self.assertIsNotNone(tm.scheduler.delay())
+
+    def test_everything_is_applied_after_restarting_observer(self):
+        tm = self._get_nginx_config_reloader_instance()
+        tm.events_lost = True
+        tm.stop_observer = Mock()
+        tm.start_observer = Mock()
+        tm.reload = Mock(return_value=False)
+
+        nginx_config_reloader.after_loop(tm)
+
+        tm.start_observer.assert_called_once_with()
+        tm.reload.assert_called_once_with()
+        self.assertIn(Change(self.source, "observer_restarted"), tm.changes.take()[1])
+
     def test_it_does_not_apply_config_if_tree_not_dirty(self):
         tm = self._get_nginx_config_reloader_instance()
         tm.apply_new_config = Mock()
-        tm.dirty = False
 
         nginx_config_reloader.after_loop(tm)
 
         tm.apply_new_config.assert_not_called()
         self.assertFalse(tm.dirty)
 
-    def test_it_restarts_observer_and_reloads_when_symlink_targets_change(self):
+    def test_it_rearms_watches_and_reloads_when_symlink_targets_change(self):
         tm = self._get_nginx_config_reloader_instance()
-        tm.symlink_targets_changed = Mock(return_value=True)
+        tm.changes.record("/data/web/nginx/example.com", "symlink_changed")
+        tm.rearm_links = {"/data/web/nginx/example.com"}
+        tm.rearm_watches = Mock()
         tm.restart_observer = Mock()
         tm.reload = Mock()
 
         nginx_config_reloader.after_loop(tm)
 
-        tm.restart_observer.assert_called_once_with()
+        tm.rearm_watches.assert_called_once_with({"/data/web/nginx/example.com"})
+        tm.restart_observer.assert_not_called()
         tm.reload.assert_called_once_with()
         self.assertFalse(tm.dirty)
+        self.assertEqual(tm.rearm_links, set())
 
-    def test_it_does_not_restart_observer_when_symlink_targets_are_stable(self):
+    def test_it_does_not_rearm_watches_when_symlink_targets_are_stable(self):
         tm = self._get_nginx_config_reloader_instance()
-        tm.symlink_targets_changed = Mock(return_value=False)
+        tm.rearm_watches = Mock()
         tm.restart_observer = Mock()
+        tm.sync_target_watches = Mock()
         tm.reload = Mock()
 
         nginx_config_reloader.after_loop(tm)
 
+        tm.rearm_watches.assert_not_called()
         tm.restart_observer.assert_not_called()
+        tm.sync_target_watches.assert_not_called()
         tm.reload.assert_not_called()
 
+    def test_it_only_updates_target_watches_when_symlinks_to_files_change(self):
+        tm = self._get_nginx_config_reloader_instance()
+        tm.target_watches_stale = True
+        tm.restart_observer = Mock()
+        tm.sync_target_watches = Mock()
+
+        nginx_config_reloader.after_loop(tm)
+
+        tm.restart_observer.assert_not_called()
+        tm.sync_target_watches.assert_called_once_with()
+        self.assertFalse(tm.target_watches_stale)
+
+    def test_it_restarts_observer_when_rearming_watches_fails(self):
+        tm = self._get_nginx_config_reloader_instance()
+        tm.changes.record("/data/web/nginx/example.com", "symlink_changed")
+        tm.rearm_links = {"/data/web/nginx/example.com"}
+        tm.rearm_watches = Mock(side_effect=OSError("inotify watch limit reached"))
+        tm.restart_observer = Mock()
+        tm.reload = Mock()
+
+        nginx_config_reloader.after_loop(tm)
+
+        tm.restart_observer.assert_called_once_with()
+        tm.reload.assert_called_once_with()
+
     def test_it_swallows_errors_while_restarting_observer(self):
         tm = self._get_nginx_config_reloader_instance()
-        tm.symlink_targets_changed = Mock(return_value=True)
+        tm.changes.record("/data/web/nginx/example.com", "symlink_changed")
+        tm.rearm_links = {"/data/web/nginx/example.com"}
+        tm.rearm_watches = Mock(side_effect=OSError("inotify watch limit reached"))
         tm.restart_observer = Mock(side_effect=OSError("inotify watch limit reached"))
         tm.reload = Mock()
 
@@ -84,4 +205,5 @@ class TestAfterLoop(TestCase):
             no_custom_config=no_custom_config,
             dir_to_watch=self.source,
             magento2_flag=magento2_flag,
+            scan_cache_file=None,
         )
@@ -1,59 +1,132 @@
-import shlex
-import sys
-from subprocess import CalledProcessError, check_output
+import os
+import shutil
+from tempfile import mkdtemp
 
-import pytest
-
-from nginx_config_reloader import (
-    ERROR_FILE,
-    FORBIDDEN_CONFIG_REGEX,
-    NginxConfigReloader,
-)
+from nginx_config_reloader import ERROR_FILE, NginxConfigReloader
+from nginx_config_reloader.scanner import find_forbidden_config, scan_file
+from nginx_config_reloader.settings import FORBIDDEN_CONFIG_DIRECTIVES
 from tests.testcase import TestCase
 
-# Skip marker for tests that require grep -P (PCRE support, not available on macOS)
-requires_pcre_grep = pytest.mark.skipif(
-    sys.platform != "linux", reason="Requires grep -P (PCRE support)"
-)
-
 
 class TestAssertNoForbiddenStatementsInConfig(TestCase):
     def setUp(self):
         self.custom_error_file = "nginx_error_output.hnclusterweb1"
-        self.isdir = self.set_up_patch("nginx_config_reloader.os.path.isdir")
-        self.isdir.return_value = True
-        self.check_output = self.set_up_patch(
-            "nginx_config_reloader.subprocess.check_output"
+        self.dir = mkdtemp()
+        self.write_error_file = self.set_up_patch(
+            "nginx_config_reloader.NginxConfigReloader.write_error_file"
         )
 
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
     def test_assert_no_includes_in_config_does_not_check_config_if_no_dir_to_watch(
         self,
     ):
-        self.isdir.return_value = False
-
-        NginxConfigReloader.check_no_forbidden_config_directives_are_present(
-            NginxConfigReloader()
+        find_forbidden_config = self.set_up_patch(
+            "nginx_config_reloader.find_forbidden_config"
         )
 
-        self.assertFalse(self.check_output.called)
+        ret = NginxConfigReloader(
+            dir_to_watch=os.path.join(self.dir, "missing"), scan_cache_file=None
+        ).check_no_forbidden_config_directives_are_present()
+
+        self.assertFalse(ret)
+        self.assertFalse(find_forbidden_config.called)
 
     def test_check_no_forbidden_config_excludes_default_and_custom_error_files(self):
+        for name in (ERROR_FILE, self.custom_error_file):
+            self._write(name, "client_body_temp_path /tmp;\n")
         reloader = NginxConfigReloader(
-            dir_to_watch="/tmp/nginx", error_file=self.custom_error_file
+            dir_to_watch=self.dir,
+            error_file=self.custom_error_file,
+            scan_cache_file=None,
         )
 
-        reloader.check_no_forbidden_config_directives_are_present()
+        ret = reloader.check_no_forbidden_config_directives_are_present()
 
-        self.assertEqual(
-            len(self.check_output.call_args_list), len(FORBIDDEN_CONFIG_REGEX)
+        self.assertFalse(ret)
+        self.assertFalse(self.write_error_file.called)
+
+    def test_check_no_forbidden_config_writes_rule_file_and_line_to_error_file(self):
+        path = self._write("server.logs", "\n\n   access_log /var/log/evil.log;\n")
+        reloader = NginxConfigReloader(dir_to_watch=self.dir, scan_cache_file=None)
+
+        ret = reloader.check_no_forbidden_config_directives_are_present()
+
+        self.assertTrue(ret)
+        self.write_error_file.assert_called_once_with(
+            f"Unable to load config: {FORBIDDEN_CONFIG_DIRECTIVES[1][2]}"
+            f"{path}:3: access_log /var/log/evil.log;\n"
         )
-        for call_args in self.check_output.call_args_list:
-            command = call_args.args[0]
-            self.assertIn(f"--exclude={ERROR_FILE}", command)
-            self.assertIn(f"--exclude={self.custom_error_file}", command)
-            self.assertIn("'/tmp/nginx'", command)
 
-    @requires_pcre_grep
+    def test_find_forbidden_config_reports_first_violation_in_walk_order(self):
+        os.mkdir(os.path.join(self.dir, "b"))
+        self._write("b/server.conf", "init_by_lua 'x';\n")
+        self._write("a.conf", "location / {}\nclient_body_temp_path /tmp;\n")
+
+        violation = find_forbidden_config(self.dir)
+
+        self.assertEqual(violation.path, os.path.join(self.dir, "a.conf"))
+        self.assertEqual(violation.line, 2)
+        self.assertEqual(violation.message, FORBIDDEN_CONFIG_DIRECTIVES[0][2])
+        self.assertEqual(violation.text, "client_body_temp_path /tmp;")
+
+    def test_find_forbidden_config_returns_none_for_clean_tree(self):
+        self._write("server.conf", "location / {\n  include fastcgi_params;\n}\n")
+
+        self.assertIsNone(find_forbidden_config(self.dir))
+
+    def test_find_forbidden_config_scans_symlink_targets_once(self):
+        target = mkdtemp()
+        self.addCleanup(shutil.rmtree, target, ignore_errors=True)
+        with open(os.path.join(target, "server.conf"), "w") as f:
+            f.write("init_by_lua_block {}\n")
+        os.symlink(target, os.path.join(self.dir, "site"))
+        os.symlink(self.dir, os.path.join(target, "loop"))
+
+        violation = find_forbidden_config(self.dir)
+
+        self.assertEqual(violation.path, os.path.join(self.dir, "site", "server.conf"))
+
+    def test_forbidden_directive_split_over_lines_is_detected(self):
+        self.assertMatchesRule("include\n    /etc/passwd;", 2)
+        self.assertMatchesRule("access_log\n'/var/log/x.log';", 1)
+
+    def test_forbidden_directive_after_other_directive_on_same_line_is_detected(
+        self,
+    ):
+        self.assertMatchesRule("listen 80; include /data/web/evil.conf;", 2)
+
+    def test_forbidden_directive_in_quotes_or_comments_is_allowed(self):
+        TEST_CASES = [
+            'add_header X-Info "# access_log /var/log/x.log;";',
+            "listen 80; # include /etc/passwd;",
+            'return 200 "client_body_temp_path /tmp";',
+        ]
+
+        for line in TEST_CASES:
+            self.assertAllowed(line)
+
+    def test_quoted_forbidden_directive_name_is_detected(self):
+        self.assertMatchesRule('"client_body_temp_path" /tmp;', 0)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.dir, name)
+        with open(path, "w") as f:
+            f.write(contents)
+        return path
+
+    def _scan(self, line):
+        return scan_file(self._write("server.test", line + "\n"))
+
+    def assertMatchesRule(self, line, rule):
+        violation = self._scan(line)
+        self.assertIsNotNone(violation, line)
+        self.assertEqual(violation.message, FORBIDDEN_CONFIG_DIRECTIVES[rule][2], line)
+
+    def assertAllowed(self, line):
+        self.assertIsNone(self._scan(line), line)
+
     def test_include_prevention_legal_includes(self):
         TEST_CASES = [
             "include /etc/nginx/fastcgi_params",
@@ -69,14 +142,8 @@ class TestAssertNoForbiddenStatementsInConfig(TestCase):
         ]
 
         for line in TEST_CASES:
-            check_output(
-                "[ $(echo {} | grep -P '{}' | wc -l) -lt 1 ]".format(
-                    shlex.quote(line), FORBIDDEN_CONFIG_REGEX[2][0]
-                ),
-                shell=True,
-            )
-
-    @requires_pcre_grep
+            self.assertAllowed(line)
+
     def test_include_prevention_illegal_includes(self):
         TEST_CASES = [
             "include /data/web/nginx/someexample.allow;",
@@ -88,6 +155,7 @@ class TestAssertNoForbiddenStatementsInConfig(TestCase):
             "include '/data/web/banaan.config'",
             'include "/data/web/banaan.config"',
             "include /etc/nginx/app_bak/server.*;",
+            "include /etc/nginx/app_generations/generations/00000001/server.*;",
             'include "/data//web/banaan.config"',
             'include "//data/web/banaan.config"',
             'include "/data/web//banaan.config"',
@@ -95,15 +163,8 @@ class TestAssertNoForbiddenStatementsInConfig(TestCase):
         ]
 
         for line in TEST_CASES:
-            with self.assertRaises(CalledProcessError):
-                check_output(
-                    "[ $(echo {} | grep -P '{}' | wc -l) -lt 1 ]".format(
-                        shlex.quote(line), FORBIDDEN_CONFIG_REGEX[2][0]
-                    ),
-                    shell=True,
-                )
-
-    @requires_pcre_grep
+            self.assertMatchesRule(line, 2)
+
     def test_forbidden_config_client_body_temp_path_regex_unhappy_case(self):
         TEST_CASES = [
             "client_body_temp_path /tmp/path",
@@ -114,15 +175,8 @@ class TestAssertNoForbiddenStatementsInConfig(TestCase):
         ]
 
         for test in TEST_CASES:
-            with self.assertRaises(CalledProcessError):
-                check_output(
-                    "[ $(echo {} | grep -P '{}' | wc -l) -lt 1 ]".format(
-                        shlex.quote(test), FORBIDDEN_CONFIG_REGEX[0][0]
-                    ),
-                    shell=True,
-                )
-
-    @requires_pcre_grep
+            self.assertMatchesRule(test, 0)
+
     def test_forbidden_access_or_error_log_configuration_options(self):
         TEST_CASES = [
             "access_log /var/log/nginx/acceptatie.log;",
@@ -146,15 +200,8 @@ class TestAssertNoForbiddenStatementsInConfig(TestCase):
         ]
 
         for test in TEST_CASES:
-            with self.assertRaises(CalledProcessError):
-                check_output(
-                    "[ $(echo {} | grep -P '{}' | wc -l) -lt 1 ]".format(
-                        shlex.quote(test), FORBIDDEN_CONFIG_REGEX[1][0]
-                    ),
-                    shell=True,
-                )
-
-    @requires_pcre_grep
+            self.assertMatchesRule(test, 1)
+
     def test_allowed_access_or_error_log_configuration_options(self):
         TEST_CASES = [
             "access_log /data/var/log/access.log;",
@@ -169,22 +216,10 @@ class TestAssertNoForbiddenStatementsInConfig(TestCase):
         ]
 
         for test in TEST_CASES:
-            check_output(
-                "[ $(echo {} | grep -P '{}' | wc -l) -lt 1 ]".format(
-                    shlex.quote(test), FORBIDDEN_CONFIG_REGEX[1][0]
-                ),
-                shell=True,
-            )
-
-    @requires_pcre_grep
+            self.assertAllowed(test)
+
     def test_forbidden_config_init_by_lua_regex_matches_target_directives(self):
         TEST_CASES = ["init_by_lua", "init_by_lua_block", "init_by_lua_file"]
 
         for test in TEST_CASES:
-            with self.assertRaises(CalledProcessError):
-                check_output(
-                    "[ $(echo {} | grep -P '{}' | wc -l) -lt 1 ]".format(
-                        shlex.quote(test), FORBIDDEN_CONFIG_REGEX[3][0]
-                    ),
-                    shell=True,
-                )
+            self.assertMatchesRule(test, 3)
@@ -0,0 +1,105 @@
+import os
+import shutil
+from tempfile import mkdtemp
+
+from nginx_config_reloader.check_cache import ConfigCheckCache, read_file_references
+from tests.testcase import TestCase
+
+
+class TestConfigCheckCache(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.set_up_patch("nginx_config_reloader.check_cache.MAIN_CONFIG_DIR", self.dir)
+        self.main_config = self._write("nginx.conf", "include app/*;\n")
+        self.cache = ConfigCheckCache(max_entries=2, ttl=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_outcome_is_returned_for_same_key(self):
+        self.cache.put("a", False, "error")
+
+        self.assertEqual(self.cache.get("a"), (False, "error"))
+        self.assertIsNone(self.cache.get("b"))
+
+    def test_least_recently_used_outcome_is_evicted(self):
+        self.cache.put("a", True, "")
+        self.cache.put("b", True, "")
+        self.cache.get("a")
+
+        self.cache.put("c", True, "")
+
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("a"))
+
+    def test_outcome_expires_after_ttl(self):
+        monotonic = self.set_up_patch(
+            "nginx_config_reloader.check_cache.time.monotonic", return_value=100
+        )
+        self.cache.put("a", False, "error")
+
+        monotonic.return_value = 161
+
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_key_depends_on_config_digest(self):
+        self.assertNotEqual(self._key("a"), self._key("b"))
+        self.assertEqual(self._key("a"), self._key("a"))
+
+    def test_key_depends_on_contents_of_unwatched_files(self):
+        key = self._key()
+
+        self._write("nginx.conf", "include app/*.conf;\n")
+
+        self.assertNotEqual(self._key(), key)
+
+    def test_key_does_not_depend_on_contents_of_watched_files(self):
+        key = self.cache.key("a", [self.main_config], lambda path: True)
+
+        self._write("nginx.conf", "include app/*.conf;\n")
+
+        self.assertEqual(
+            self.cache.key("a", [self.main_config], lambda path: True), key
+        )
+
+    def test_key_depends_on_referenced_files(self):
+        self._write("nginx.conf", "ssl_certificate certs/site.pem;\n")
+        cert = self._write("certs/site.pem", "old")
+        key = self._key()
+
+        os.unlink(cert)
+        self._write("certs/site.pem", "new")
+
+        self.assertNotEqual(self._key(), key)
+
+    def test_files_without_identity_are_not_cached(self):
+        self.set_up_patch(
+            "nginx_config_reloader.check_cache.path_identity", return_value=None
+        )
+
+        self._key()
+
+        self.assertEqual(self.cache.file_hashes, {})
+        self.assertEqual(self.cache.file_references, {})
+
+    def test_references_with_variables_are_left_out(self):
+        self._write(
+            "nginx.conf",
+            "ssl_certificate $ssl_server_name.pem;\n"
+            "ssl_certificate_key data:secret;\n"
+            "ssl_dhparam /etc/ssl/dhparam.pem;\n",
+        )
+
+        self.assertEqual(
+            read_file_references(self.main_config), ["/etc/ssl/dhparam.pem"]
+        )
+
+    def _key(self, digest="a"):
+        return self.cache.key(digest, [self.main_config], lambda path: False)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(contents)
+        return path
@@ -0,0 +1,144 @@
+import os
+import shutil
+from tempfile import mkdtemp
+
+from nginx_config_reloader.check_config import (
+    StagedConfigCheck,
+    read_include_directives,
+)
+from tests.testcase import TestCase
+
+
+class TestStagedConfigCheck(TestCase):
+    def setUp(self):
+        self.main = mkdtemp()
+        self.custom = os.path.join(self.main, "app")
+        self.staging = os.path.join(self.main, "app_bak")
+        os.mkdir(self.custom)
+        os.mkdir(self.staging)
+        self.main_config = self._write(
+            "nginx.conf",
+            "events {}\nhttp {\n    include mime.types;\n"
+            f"    include {self.custom}/http.*;\n    include sites/*.conf;\n}}\n",
+        )
+        self._write("mime.types", "types {}\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.main, ignore_errors=True)
+
+    def test_includes_of_custom_dir_point_to_staging_dir(self):
+        with self._check() as check:
+            wrapper = self._read(check.path)
+
+        self.assertIn(f'include "{self.staging}/http.*";', wrapper)
+        self.assertIn("include mime.types;", wrapper)
+        self.assertIn("include sites/*.conf;", wrapper)
+
+    def test_wrapper_is_placed_next_to_main_config(self):
+        with self._check() as check:
+            self.assertEqual(os.path.dirname(check.path), self.main)
+            self.assertTrue(os.path.basename(check.path).startswith("."))
+
+    def test_files_that_include_custom_dir_are_rewritten(self):
+        self._write("sites/a.conf", "server { include app/server.*; }\n")
+        self._write("sites/b.conf", "server { listen 80; }\n")
+
+        with self._check() as check:
+            wrapper = self._read(check.path)
+            rewritten = os.path.join(check.scratch_dir + self.main, "sites/a.conf")
+
+            self.assertIn(
+                f'include "{rewritten}"; '
+                f'include "{os.path.join(self.main, "sites/b.conf")}";',
+                wrapper,
+            )
+            self.assertEqual(
+                self._read(rewritten),
+                f'server {{ include "{self.staging}/server.*"; }}\n',
+            )
+
+    def test_globs_are_expanded_like_nginx_expands_them(self):
+        self._write("nginx.conf", "include sites/[^x]*.conf;\n")
+        self._write("sites/a.conf", "include app/server.*;\n")
+        self._write("sites/x.conf", "include app/server.*;\n")
+
+        with self._check() as check:
+            rewritten = os.path.join(check.scratch_dir + self.main, "sites/a.conf")
+
+            self.assertEqual(self._read(check.path), f'include "{rewritten}";\n')
+
+    def test_staged_files_that_include_custom_dir_are_rewritten(self):
+        self._write("app_bak/http.conf", f"include {self.custom}/shared;\n")
+        self._write("app_bak/shared", "gzip on;\n")
+
+        with self._check() as check:
+            wrapper = self._read(check.path)
+            rewritten = check.scratch_dir + os.path.join(self.staging, "http.conf")
+
+            self.assertIn(f'include "{rewritten}";', wrapper)
+            self.assertEqual(
+                self._read(rewritten), f'include "{self.staging}/shared";\n'
+            )
+
+    def test_include_cycle_is_written_once(self):
+        self._write("sites/a.conf", "include sites/b.conf;\ninclude app/x;\n")
+        self._write("sites/b.conf", "include sites/a.conf;\n")
+
+        with self._check() as check:
+            self.assertTrue(os.path.isfile(check.path))
+
+    def test_output_refers_to_installed_paths(self):
+        with self._check() as check:
+            output = (
+                f"nginx: [emerg] unknown directive in {self.staging}/http.conf:1\n"
+                f"nginx: configuration file {check.path} test failed\n"
+            ).encode()
+
+            self.assertEqual(
+                check.translate(output),
+                (
+                    f"nginx: [emerg] unknown directive in {self.custom}/http.conf:1\n"
+                    f"nginx: configuration file {self.main_config} test failed\n"
+                ).encode(),
+            )
+
+    def test_check_files_are_removed(self):
+        self._write("sites/a.conf", "include app/server.*;\n")
+
+        with self._check() as check:
+            pass
+
+        self.assertFalse(os.path.exists(check.path))
+        self.assertFalse(os.path.exists(check.scratch_dir))
+
+    def test_include_directive_offsets(self):
+        path = self._write("a.conf", 'listen 80;\n  include  "x y" ;\n')
+
+        (directive,) = read_include_directives(path)
+
+        self.assertEqual((directive.start, directive.end), (13, 27))
+        self.assertEqual(directive.args, ("x y",))
+
+    def test_unterminated_include_is_not_terminated_by_the_rewrite(self):
+        self._write("sites/a.conf", "include app/server.*")
+
+        with self._check() as check:
+            rewritten = os.path.join(check.scratch_dir + self.main, "sites/a.conf")
+
+            self.assertEqual(
+                self._read(rewritten), f'include "{self.staging}/server.*"'
+            )
+
+    def _check(self):
+        return StagedConfigCheck(self.staging, self.main_config, self.custom)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.main, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(contents)
+        return path
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
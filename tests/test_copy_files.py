@@ -0,0 +1,159 @@
+import errno
+import os
+import shutil
+import time
+from tempfile import mkdtemp
+
+from nginx_config_reloader.copy_files import SyncError, _copy_data, safe_copy_files
+from tests.testcase import TestCase
+
+
+class TestSafeCopyFiles(TestCase):
+    def setUp(self):
+        self.src = mkdtemp()
+        self.dest = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.src, ignore_errors=True)
+        shutil.rmtree(self.dest, ignore_errors=True)
+
+    def test_unchanged_files_are_not_copied(self):
+        self._write("server.conf", "listen 80;")
+        safe_copy_files(self.src, self.dest)
+        inode = os.stat(self._dest("server.conf")).st_ino
+
+        safe_copy_files(self.src, self.dest)
+
+        self.assertEqual(os.stat(self._dest("server.conf")).st_ino, inode)
+
+    def test_changed_file_is_replaced_instead_of_written_to(self):
+        self._write("server.conf", "listen 80;")
+        safe_copy_files(self.src, self.dest)
+        os.link(self._dest("server.conf"), os.path.join(self.src, ".backup"))
+        self._write("server.conf", "listen 8080;")
+
+        safe_copy_files(self.src, self.dest)
+
+        with open(self._dest("server.conf")) as f:
+            self.assertEqual(f.read(), "listen 8080;")
+        with open(os.path.join(self.src, ".backup")) as f:
+            self.assertEqual(f.read(), "listen 80;")
+
+    def test_file_rewritten_with_its_old_mtime_is_copied(self):
+        path = os.path.join(self.src, "server.conf")
+        self._write("server.conf", "listen 80;")
+        safe_copy_files(self.src, self.dest)
+        mtime = os.stat(path).st_mtime_ns
+        # ctime has the resolution of the kernel clock tick
+        time.sleep(0.02)
+        self._write("server.conf", "listen 81;")
+        os.utime(path, ns=(mtime, mtime))
+
+        safe_copy_files(self.src, self.dest)
+
+        with open(self._dest("server.conf")) as f:
+            self.assertEqual(f.read(), "listen 81;")
+
+    def test_mtime_is_preserved(self):
+        self._write("server.conf", "listen 80;")
+        os.utime(os.path.join(self.src, "server.conf"), ns=(0, 1234567890123456789))
+
+        safe_copy_files(self.src, self.dest)
+
+        self.assertEqual(
+            os.stat(self._dest("server.conf")).st_mtime_ns, 1234567890123456789
+        )
+
+    def test_removed_files_and_dirs_are_removed(self):
+        self._write("sub/server.conf", "listen 80;")
+        self._write("other.conf", "listen 80;")
+        safe_copy_files(self.src, self.dest)
+        shutil.rmtree(os.path.join(self.src, "sub"))
+        os.unlink(os.path.join(self.src, "other.conf"))
+
+        safe_copy_files(self.src, self.dest)
+
+        self.assertEqual(os.listdir(self.dest), [])
+
+    def test_file_replaced_by_dir_is_synced(self):
+        self._write("server", "listen 80;")
+        safe_copy_files(self.src, self.dest)
+        os.unlink(os.path.join(self.src, "server"))
+        self._write("server/a.conf", "listen 80;")
+
+        safe_copy_files(self.src, self.dest)
+
+        self.assertTrue(os.path.isfile(self._dest("server/a.conf")))
+
+    def test_ignored_files_are_skipped_in_subdirs(self):
+        self._write("sub/server.conf", "listen 80;")
+        self._write("sub/server.conf~", "listen 80;")
+        self._write("sub/.hidden/a.conf", "listen 80;")
+
+        safe_copy_files(self.src, self.dest, ["*~", ".*"])
+
+        self.assertEqual(os.listdir(self._dest("sub")), ["server.conf"])
+
+    def test_mode_change_is_synced(self):
+        self._write("server.conf", "listen 80;")
+        safe_copy_files(self.src, self.dest)
+        os.chmod(os.path.join(self.src, "server.conf"), 0o600)
+
+        safe_copy_files(self.src, self.dest)
+
+        self.assertEqual(os.stat(self._dest("server.conf")).st_mode & 0o7777, 0o600)
+
+    def test_dangling_symlink_fails_sync_after_syncing_other_files(self):
+        os.symlink("/nonexistent", os.path.join(self.src, "a.conf"))
+        self._write("b.conf", "listen 80;")
+
+        with self.assertRaises(SyncError) as cm:
+            safe_copy_files(self.src, self.dest)
+
+        self.assertIn("a.conf has no referent", str(cm.exception))
+        self.assertTrue(os.path.isfile(self._dest("b.conf")))
+
+    def test_special_files_are_skipped(self):
+        os.mkfifo(os.path.join(self.src, "fifo"))
+
+        safe_copy_files(self.src, self.dest)
+
+        self.assertEqual(os.listdir(self.dest), [])
+
+    def test_missing_source_fails_sync(self):
+        with self.assertRaises(SyncError):
+            safe_copy_files(os.path.join(self.src, "missing"), self.dest)
+
+    def test_data_is_copied_with_sendfile_if_copy_file_range_is_unsupported(self):
+        self.set_up_patch(
+            "nginx_config_reloader.copy_files.os.copy_file_range",
+            side_effect=OSError(errno.EXDEV, "Invalid cross-device link"),
+        )
+        sendfile = self.set_up_patch(
+            "nginx_config_reloader.copy_files.os.sendfile", side_effect=os.sendfile
+        )
+        self._write("server.conf", "listen 80;")
+
+        safe_copy_files(self.src, self.dest)
+
+        self.assertTrue(sendfile.called)
+        with open(self._dest("server.conf")) as f:
+            self.assertEqual(f.read(), "listen 80;")
+
+    def test_other_copy_errors_are_raised(self):
+        self.set_up_patch(
+            "nginx_config_reloader.copy_files.os.copy_file_range",
+            side_effect=OSError(errno.EIO, "Input/output error"),
+        )
+
+        with self.assertRaises(OSError):
+            _copy_data(0, 1, 10)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.src, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(contents)
+
+    def _dest(self, name):
+        return os.path.join(self.dest, name)
@@ -0,0 +1,41 @@
+from dasbus.error import DBusError
+
+from nginx_config_reloader.dbus.client import request_rollback
+from tests.testcase import TestCase
+
+
+class TestRequestRollback(TestCase):
+    def setUp(self):
+        self.system_bus = self.set_up_patch(
+            "nginx_config_reloader.dbus.client.SYSTEM_BUS"
+        )
+        self.get_proxy = self.set_up_patch(
+            "nginx_config_reloader.dbus.client.NGINX_CONFIG_RELOADER.get_proxy"
+        )
+
+    def test_running_reloader_rolls_back(self):
+        self.get_proxy.return_value.Rollback.return_value = False
+
+        self.assertFalse(request_rollback("00000003"))
+
+        self.get_proxy.return_value.Rollback.assert_called_once_with("00000003")
+
+    def test_nothing_is_rolled_back_without_system_bus(self):
+        self.system_bus.check_connection.return_value = False
+
+        self.assertIsNone(request_rollback("00000003"))
+
+        self.get_proxy.assert_not_called()
+
+    def test_nothing_is_rolled_back_if_no_reloader_is_running(self):
+        error = DBusError("The name is not activatable")
+        error.dbus_name = "org.freedesktop.DBus.Error.ServiceUnknown"
+        self.get_proxy.return_value.Rollback.side_effect = error
+
+        self.assertIsNone(request_rollback("00000003"))
+
+    def test_other_errors_are_raised(self):
+        self.get_proxy.return_value.Rollback.side_effect = DBusError("Failed")
+
+        with self.assertRaises(DBusError):
+            request_rollback("00000003")
@@ -0,0 +1,47 @@
+import errno
+import os
+import shutil
+from tempfile import mkdtemp
+
+from nginx_config_reloader.utils import exchange_paths
+from tests.testcase import TestCase
+
+
+class TestExchangePaths(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.a = os.path.join(self.dir, "a")
+        self.b = os.path.join(self.dir, "b")
+        os.mkdir(self.a)
+        os.mkdir(self.b)
+        open(os.path.join(self.a, "from_a"), "w").close()
+        open(os.path.join(self.b, "from_b"), "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_dirs_are_swapped(self):
+        exchange_paths(self.a, self.b)
+
+        self.assertEqual(os.listdir(self.a), ["from_b"])
+        self.assertEqual(os.listdir(self.b), ["from_a"])
+
+    def test_dirs_are_swapped_with_renames_if_exchange_is_unsupported(self):
+        renameat2 = self.set_up_patch(
+            "nginx_config_reloader.utils._renameat2", return_value=-1
+        )
+        self.set_up_patch(
+            "nginx_config_reloader.utils.ctypes.get_errno", return_value=errno.EINVAL
+        )
+
+        exchange_paths(self.a, self.b)
+
+        self.assertTrue(renameat2.called)
+        self.assertEqual(os.listdir(self.a), ["from_b"])
+        self.assertEqual(sorted(os.listdir(self.dir)), ["a", "b"])
+
+    def test_missing_path_raises(self):
+        with self.assertRaises(FileNotFoundError):
+            exchange_paths(os.path.join(self.dir, "missing"), self.b)
+
+        self.assertEqual(os.listdir(self.b), ["from_b"])
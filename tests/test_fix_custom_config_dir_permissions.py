@@ -15,6 +15,7 @@ class TestFixCustomConfigDirPermissions(TestCase):
             no_custom_config=False,
             dir_to_watch=self.temp_dir,
             magento2_flag=None,
+            scan_cache_file=None,
         )
 
     def test_fix_custom_config_dir_permissions_chmods_dirs_to_755(self):
@@ -0,0 +1,137 @@
+import hashlib
+import os
+import shutil
+from tempfile import mkdtemp
+
+from nginx_config_reloader.generations import GenerationStore
+from tests.testcase import TestCase
+
+
+class TestGenerationStore(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.config = os.path.join(self.dir, "app")
+        os.mkdir(self.config)
+        self.store = GenerationStore(os.path.join(self.dir, "store"), keep=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_generation_is_tree_of_links_to_installed_files(self):
+        self._write("server.conf", "listen 80;")
+        self._write("sub/other.conf", "listen 81;")
+
+        generation = self.store.add(self.config)
+
+        self.assertEqual(self.store.generations(), ["00000001"])
+        path = self.store.path(generation)
+        self.assertEqual(
+            os.stat(os.path.join(path, "sub/other.conf")).st_ino,
+            os.stat(os.path.join(self.config, "sub/other.conf")).st_ino,
+        )
+
+    def test_same_contents_are_stored_once(self):
+        self._write("a.conf", "listen 80;")
+        self._write("b.conf", "listen 80;")
+        first = self.store.add(self.config)
+        self._replace("a.conf", "listen 81;")
+
+        second = self.store.add(self.config)
+
+        self.assertEqual(
+            os.stat(os.path.join(self.store.path(first), "b.conf")).st_ino,
+            os.stat(os.path.join(self.store.path(second), "b.conf")).st_ino,
+        )
+        self.assertEqual(
+            os.stat(os.path.join(self.store.path(first), "a.conf")).st_ino,
+            os.stat(os.path.join(self.store.path(first), "b.conf")).st_ino,
+        )
+
+    def test_unchanged_config_is_not_added_again(self):
+        self._write("server.conf", "listen 80;")
+        self.store.add(self.config)
+
+        self.assertEqual(self.store.add(self.config), "00000001")
+        self.assertEqual(self.store.generations(), ["00000001"])
+
+    def test_unchanged_files_are_not_hashed_again(self):
+        self._write("server.conf", "listen 80;")
+        self.store.add(self.config)
+        self._write("other.conf", "listen 81;")
+        file_digest = self.set_up_patch(
+            "nginx_config_reloader.generations.hashlib.file_digest",
+            side_effect=hashlib.file_digest,
+        )
+
+        self.store.add(self.config)
+
+        self.assertEqual(file_digest.call_count, 1)
+
+    def test_only_newest_generations_are_kept(self):
+        for index in range(5):
+            self._replace("server.conf", f"listen {index};")
+            self.store.add(self.config)
+
+        self.assertEqual(self.store.generations(), ["00000003", "00000004", "00000005"])
+
+    def test_unused_contents_are_removed(self):
+        for index in range(5):
+            self._replace("server.conf", f"listen {index};")
+            self.store.add(self.config)
+
+        self.store.keep = 1
+        self.store.prune()
+
+        self.assertEqual(len(self._objects()), 1)
+
+    def test_oldest_generations_are_removed_to_fit_max_bytes(self):
+        self.store.max_bytes = 40
+        for index in range(3):
+            self._replace("server.conf", f"listen {index}; # {'x' * 5}")
+            self.store.add(self.config)
+
+        self.assertEqual(self.store.generations(), ["00000002", "00000003"])
+
+    def test_newest_generation_is_kept_if_it_exceeds_max_bytes(self):
+        self.store.max_bytes = 1
+        self._write("server.conf", "listen 80;")
+
+        self.store.add(self.config)
+
+        self.assertEqual(self.store.generations(), ["00000001"])
+
+    def test_checkout_links_generation_into_dest(self):
+        self._write("sub/server.conf", "listen 80;")
+        generation = self.store.add(self.config)
+        self._replace("sub/server.conf", "listen 81;")
+        dest = os.path.join(self.dir, "dest")
+
+        self.store.checkout(generation, dest)
+
+        with open(os.path.join(dest, "sub/server.conf")) as f:
+            self.assertEqual(f.read(), "listen 80;")
+
+    def test_checkout_of_unknown_generation_fails(self):
+        dest = os.path.join(self.dir, "dest")
+        os.mkdir(dest)
+
+        with self.assertRaises(FileNotFoundError):
+            self.store.checkout("00000042", dest)
+        self.assertTrue(os.path.isdir(dest))
+
+    def _write(self, name, contents):
+        path = os.path.join(self.config, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(contents)
+
+    def _replace(self, name, contents):
+        # Like the sync, which never writes to installed files
+        path = os.path.join(self.config, name)
+        self._write(name + ".tmp", contents)
+        os.rename(path + ".tmp", path)
+
+    def _objects(self):
+        return [
+            name for _, _, files in os.walk(self.store.objects_dir) for name in files
+        ]
@@ -0,0 +1,342 @@
+import os
+import shutil
+from tempfile import mkdtemp
+
+from nginx_config_reloader.include_graph import IncludeGraph, read_includes
+from nginx_config_reloader.scanner import find_forbidden_config
+from tests.testcase import TestCase
+
+
+class TestIncludeGraph(TestCase):
+    def setUp(self):
+        self.main = mkdtemp()
+        self.watch = mkdtemp()
+        self.set_up_patch(
+            "nginx_config_reloader.include_graph.MAIN_CONFIG_DIR", self.main
+        )
+        self.set_up_patch(
+            "nginx_config_reloader.include_graph.CUSTOM_CONFIG_DIR", self.main + "/app"
+        )
+        self.read_includes = self.set_up_patch(
+            "nginx_config_reloader.include_graph.read_includes",
+            side_effect=read_includes,
+        )
+        self.main_config = self._write(
+            self.main,
+            "nginx.conf",
+            "http {\n"
+            "    include /etc/nginx/app/http.*;\n"
+            "    server {\n"
+            "        include app/server.*;\n"
+            "    }\n"
+            "}\n".replace("/etc/nginx", self.main),
+        )
+        self.graph = IncludeGraph(
+            self.watch, ignore_files=[".*", "*.flag"], roots=[self.main_config]
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.main, ignore_errors=True)
+        shutil.rmtree(self.watch, ignore_errors=True)
+
+    def test_only_included_files_are_reachable(self):
+        server = self._write(self.watch, "server.rewrites", "include snippets/a;")
+        snippet = self._write(self.watch, "snippets/a", "")
+        http = self._write(self.watch, "http.maps", "")
+        unused = self._write(self.watch, "README", "include /etc/passwd;")
+        backup = self._write(self.watch, "old/server.rewrites", "")
+
+        self.graph.update()
+
+        self.assertEqual(self.graph.reachable, {self.main_config, server, http})
+        self.assertFalse(self.graph.is_reachable(snippet))
+        self.assertFalse(self.graph.is_reachable(unused))
+        self.assertFalse(self.graph.is_reachable(backup))
+
+    def test_relative_includes_are_relative_to_main_config_dir(self):
+        self._write(self.watch, "server.rewrites", "include app/snippets/*.conf;")
+        snippet = self._write(self.watch, "snippets/a.conf", "")
+
+        self.graph.update()
+
+        self.assertTrue(self.graph.is_reachable(snippet))
+
+    def test_includes_of_main_config_files_are_followed(self):
+        self._write(self.watch, "server.rewrites", "include fastcgi_params;")
+        params = self._write(self.main, "fastcgi_params", "include app/params.extra;")
+        extra = self._write(self.watch, "params.extra", "")
+
+        self.graph.update()
+
+        self.assertTrue(self.graph.is_reachable(params))
+        self.assertTrue(self.graph.is_reachable(extra))
+
+    def test_ignored_files_are_not_reachable(self):
+        self._write(self.watch, "server.rewrites", "include app/.hidden/*;")
+        hidden = self._write(self.watch, ".hidden/x", "")
+        flag = self._write(self.watch, "http.flag", "")
+
+        self.graph.update()
+
+        self.assertFalse(self.graph.is_reachable(flag))
+        self.assertFalse(self.graph.is_reachable(hidden))
+
+    def test_include_cycles_are_followed_once(self):
+        a = self._write(self.watch, "server.a", "include app/server.b;")
+        b = self._write(self.watch, "server.b", "include app/server.a;")
+
+        self.graph.update()
+
+        self.assertEqual(self.graph.includers[a], {self.main_config, b})
+
+    def test_reverse_index(self):
+        server = self._write(self.watch, "server.rewrites", "include app/snippet;")
+        other = self._write(self.watch, "server.other", "include app/snippet;")
+        snippet = self._write(self.watch, "snippet", "")
+
+        self.graph.update()
+
+        self.assertEqual(self.graph.includers[snippet], {server, other})
+
+    def test_loads_any(self):
+        server = self._write(self.watch, "sub/server.x", "")
+        self._write(self.main, "nginx.conf", "include app/sub/server.*;")
+        readme = self._write(self.watch, "README", "")
+
+        self.graph.update()
+
+        self.assertTrue(self.graph.loads_any([readme, server]))
+        self.assertTrue(self.graph.loads_any([os.path.dirname(server)]))
+        self.assertFalse(self.graph.loads_any([readme, server + ".bak"]))
+
+    def test_loaded_below(self):
+        server = self._write(self.watch, "sub/server.x", "")
+        self._write(self.main, "nginx.conf", "include app/sub/server.*;")
+        readme = self._write(self.watch, "sub/README", "")
+
+        self.graph.update()
+
+        self.assertEqual(self.graph.loaded_below([os.path.dirname(server)]), [server])
+        self.assertEqual(self.graph.loaded_below([readme]), [])
+        self.assertEqual(self.graph.loaded_below([self.main]), [])
+
+    def test_files_included_through_symlinked_dir_are_found_by_any_path(self):
+        self._write(self.watch, "server.rewrites", "include app/b/evil.conf;")
+        evil = self._write(self.watch, "a/evil.conf", "load_module /tmp/evil.so;")
+        os.symlink(os.path.join(self.watch, "a"), os.path.join(self.watch, "b"))
+        alias = os.path.join(self.watch, "b", "evil.conf")
+
+        self.graph.update()
+
+        self.assertTrue(self.graph.is_reachable(evil))
+        self.assertTrue(self.graph.loads_any([evil]))
+        self.assertTrue(self.graph.loads_any([os.path.dirname(evil)]))
+        self.assertEqual(self.graph.loaded_below([evil]), [alias])
+        self.assertIn((os.stat(evil).st_dev, os.stat(evil).st_ino), self.graph.inodes)
+
+    def test_forbidden_config_included_through_symlinked_dir_is_found(self):
+        self._write(self.watch, "server.rewrites", "include app/b/evil.conf;")
+        self._write(self.watch, "a/evil.conf", "load_module /tmp/evil.so;")
+        os.symlink(os.path.join(self.watch, "a"), os.path.join(self.watch, "b"))
+        self.graph.update()
+
+        violation = find_forbidden_config(
+            self.watch,
+            reachable=self.graph.reachable,
+            reachable_inodes=self.graph.inodes,
+        )
+
+        self.assertEqual(violation.path, os.path.join(self.watch, "a", "evil.conf"))
+
+    def test_globs_are_expanded_like_nginx_expands_them(self):
+        self._write(
+            self.watch,
+            "server.rewrites",
+            "include app/snippets/[^x]*.conf;\ninclude app/other/e[v]il\\.conf;\n",
+        )
+        snippet = self._write(self.watch, "snippets/a.conf", "")
+        self._write(self.watch, "snippets/x.conf", "")
+        other = self._write(self.watch, "other/evil.conf", "")
+
+        self.graph.update()
+
+        self.assertTrue(self.graph.is_reachable(snippet))
+        self.assertFalse(self.graph.is_reachable(self.watch + "/snippets/x.conf"))
+        self.assertTrue(self.graph.is_reachable(other))
+
+    def test_forbidden_config_included_by_negated_glob_is_found(self):
+        self._write(self.watch, "server.rewrites", "include app/[^x]*.conf;")
+        evil = self._write(self.watch, "evil.conf", "load_module /tmp/evil.so;")
+        self.graph.update()
+
+        violation = find_forbidden_config(
+            self.watch,
+            reachable=self.graph.reachable,
+            reachable_inodes=self.graph.inodes,
+        )
+
+        self.assertEqual(violation.path, evil)
+
+    def test_new_file_matching_negated_glob_becomes_reachable(self):
+        self._write(self.watch, "server.rewrites", "include app/snippets/[^x]*;")
+        self.graph.update()
+
+        snippet = self._write(self.watch, "snippets/a", "")
+        changed = self.graph.update([os.path.dirname(snippet)])
+
+        self.assertEqual(changed, {snippet})
+
+    def test_file_changed_without_a_report_is_read_again(self):
+        server = self._write(self.watch, "server.rewrites", "")
+        self.graph.update()
+
+        self._write(self.watch, "server.rewrites", "include app/b.conf;")
+        b = self._write(self.watch, "b.conf", "access_log /etc/cron.d/x;")
+        changed = self.graph.update()
+
+        self.assertEqual(changed, {b})
+        self.assertTrue(self.graph.is_reachable(server))
+
+    def test_all_files_are_reachable_without_main_config(self):
+        os.unlink(self.main_config)
+
+        self.graph.update()
+
+        self.assertIsNone(self.graph.reachable)
+        self.assertTrue(self.graph.is_reachable(os.path.join(self.watch, "x")))
+
+    def test_unchanged_files_are_not_read_again(self):
+        self._write(self.watch, "server.rewrites", "include app/snippet;")
+        self._write(self.watch, "snippet", "")
+        self.graph.update()
+        self.read_includes.reset_mock()
+
+        changed = self.graph.update()
+
+        self.assertEqual(changed, set())
+        self.assertFalse(self.read_includes.called)
+
+    def test_changed_file_is_read_again(self):
+        server = self._write(self.watch, "server.rewrites", "")
+        snippet = self._write(self.watch, "snippet", "")
+        self.graph.update()
+        self.read_includes.reset_mock()
+
+        self._write(self.watch, "server.rewrites", "include app/snippet;")
+        changed = self.graph.update([server])
+
+        self.assertEqual(
+            [call.args[0] for call in self.read_includes.call_args_list],
+            [server, snippet],
+        )
+        self.assertEqual(changed, {snippet})
+        self.assertTrue(self.graph.is_reachable(snippet))
+
+    def test_change_to_unreferenced_file_changes_nothing(self):
+        self._write(self.watch, "server.rewrites", "")
+        readme = self._write(self.watch, "README", "")
+        self.graph.update()
+        self.read_includes.reset_mock()
+
+        self._write(self.watch, "README", "include app/server.rewrites;")
+        changed = self.graph.update([readme])
+
+        self.assertEqual(changed, set())
+        self.assertFalse(self.graph.is_reachable(readme))
+        self.assertFalse(self.read_includes.called)
+
+    def test_new_file_matching_include_glob_becomes_reachable(self):
+        self.graph.update()
+
+        server = self._write(self.watch, "server.new", "")
+        changed = self.graph.update([server])
+
+        self.assertEqual(changed, {server})
+
+    def test_deleted_file_is_no_longer_reachable(self):
+        server = self._write(self.watch, "server.rewrites", "include app/snippet;")
+        snippet = self._write(self.watch, "snippet", "")
+        self.graph.update()
+
+        os.unlink(server)
+        changed = self.graph.update([server])
+
+        self.assertEqual(changed, {server, snippet})
+        self.assertNotIn(snippet, self.graph.includers)
+
+    def test_moved_directory_invalidates_files_below_it(self):
+        self._write(self.watch, "server.rewrites", "include app/snippets/*;")
+        self.graph.update()
+
+        snippet = self._write(self.watch, "snippets/a", "")
+        changed = self.graph.update([os.path.join(self.watch, "snippets")])
+
+        self.assertEqual(changed, {snippet})
+
+    def test_change_reported_by_another_path_to_a_symlinked_dir(self):
+        self._write(self.watch, "server.rewrites", "include app/b/site.conf;")
+        site = self._write(self.watch, "a/site.conf", "")
+        other = self._write(self.watch, "other", "")
+        os.symlink(os.path.join(self.watch, "a"), os.path.join(self.watch, "b"))
+        self.graph.update()
+
+        self._write(self.watch, "a/site.conf", "include app/other;")
+        changed = self.graph.update([site])
+
+        self.assertEqual(changed, {other})
+
+    def test_new_file_in_symlinked_dir_matching_include_glob(self):
+        self._write(self.watch, "server.rewrites", "include app/b/*.conf;")
+        os.mkdir(os.path.join(self.watch, "a"))
+        os.symlink(os.path.join(self.watch, "a"), os.path.join(self.watch, "b"))
+        self.graph.update()
+
+        site = self._write(self.watch, "a/site.conf", "")
+        changed = self.graph.update([site])
+
+        self.assertEqual(changed, {os.path.join(self.watch, "b", "site.conf")})
+
+    def test_files_below_repointed_nested_symlink_are_read_again(self):
+        self._write(self.watch, "server.rewrites", "include app/b/c/site.conf;")
+        self._write(self.watch, "d1/site.conf", "")
+        self._write(self.watch, "d2/site.conf", "include app/other;")
+        other = self._write(self.watch, "other", "")
+        os.mkdir(os.path.join(self.watch, "a"))
+        os.symlink(os.path.join(self.watch, "a"), os.path.join(self.watch, "b"))
+        link = os.path.join(self.watch, "a", "c")
+        os.symlink(os.path.join(self.watch, "d1"), link)
+        self.graph.update()
+
+        os.unlink(link)
+        os.symlink(os.path.join(self.watch, "d2"), link)
+        changed = self.graph.update([link])
+
+        self.assertEqual(changed, {other})
+
+    def test_changed_main_config_is_read_again(self):
+        server = self._write(self.watch, "server.rewrites", "")
+        other = self._write(self.watch, "other.conf", "")
+        self.graph.update()
+
+        self._write(self.main, "nginx.conf", "include app/other.conf;")
+        os.utime(self.main_config, ns=(0, 0))
+        changed = self.graph.update()
+
+        self.assertEqual(changed, {server, other})
+
+    def test_new_main_config_file_is_found_without_events(self):
+        self._write(self.main, "nginx.conf", "include conf.d/*.conf;")
+        self.graph.update()
+
+        self._write(self.main, "conf.d/site.conf", "include app/site;")
+        site = self._write(self.watch, "site", "")
+        self.graph.update()
+
+        self.assertTrue(self.graph.is_reachable(site))
+
+    def _write(self, directory, name, contents):
+        path = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(contents)
+        return path
@@ -0,0 +1,230 @@
+import os
+import shutil
+import struct
+import time
+from tempfile import mkdtemp
+from unittest.mock import Mock
+
+from watchdog.events import (
+    DirCreatedEvent,
+    FileClosedEvent,
+    FileCreatedEvent,
+    FileDeletedEvent,
+    FileModifiedEvent,
+    FileMovedEvent,
+    FileSystemEventHandler,
+)
+
+import nginx_config_reloader
+from nginx_config_reloader.inotify import (
+    IN_CLOSE_WRITE,
+    IN_Q_OVERFLOW,
+    InotifyObserver,
+    parse_events,
+)
+from nginx_config_reloader.journal import Change
+from tests.helpers import requires_linux
+from tests.testcase import TestCase
+
+
+class EventRecorder(FileSystemEventHandler):
+    def __init__(self):
+        self.events = []
+
+    def on_any_event(self, event):
+        self.events.append(event)
+
+
+class TestParseEvents(TestCase):
+    def test_events_are_parsed_with_their_names(self):
+        data = struct.pack("iIII", 1, IN_CLOSE_WRITE, 0, 16) + b"a.conf".ljust(
+            16, b"\0"
+        )
+        data += struct.pack("iIII", 2, IN_Q_OVERFLOW, 0, 0)
+
+        self.assertEqual(
+            parse_events(data),
+            [(1, IN_CLOSE_WRITE, 0, "a.conf"), (2, IN_Q_OVERFLOW, 0, "")],
+        )
+
+
+@requires_linux
+class TestInotifyObserver(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.recorder = EventRecorder()
+        self.observer = InotifyObserver()
+        self.watch = self.observer.schedule(self.recorder, self.dir, recursive=True)
+        self.observer.start()
+
+    def tearDown(self):
+        self.observer.stop()
+        self.observer.join()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_written_file_is_reported_as_closed_after_its_writes(self):
+        path = os.path.join(self.dir, "server.conf")
+        with open(path, "w") as f:
+            for _ in range(10):
+                f.write("rewrite ^/a /b;\n")
+                f.flush()
+
+        self._wait_for(FileClosedEvent(path))
+
+        events = self.recorder.events
+        self.assertEqual(events[0], FileCreatedEvent(path))
+        self.assertEqual(set(events[1:-1]), {FileModifiedEvent(path)})
+        self.assertEqual(events[-1], FileClosedEvent(path))
+
+    def test_changed_permissions_are_reported_as_modified(self):
+        path = self._touch(os.path.join(self.dir, "server.conf"))
+        self._wait_for(FileClosedEvent(path))
+
+        os.chmod(path, 0o600)
+
+        self._wait_for(FileModifiedEvent(path))
+
+    def test_rename_into_place_is_reported_as_move(self):
+        tmp = os.path.join(self.dir, ".server.conf.tmp")
+        path = os.path.join(self.dir, "server.conf")
+        with open(tmp, "w") as f:
+            f.write("rewrite ^/a /b;\n")
+        os.rename(tmp, path)
+
+        self._wait_for(FileMovedEvent(tmp, path))
+
+    def test_contents_of_new_dirs_are_watched_and_reported(self):
+        subdir = os.path.join(self.dir, "sub")
+        os.makedirs(os.path.join(subdir, "deeper"))
+        self._wait_for(DirCreatedEvent(subdir))
+
+        path = os.path.join(subdir, "deeper", "server.conf")
+        open(path, "w").close()
+
+        self._wait_for(FileCreatedEvent(path))
+
+    def test_dir_moved_in_is_reported_with_its_contents(self):
+        outside = mkdtemp()
+        self.addCleanup(shutil.rmtree, outside, ignore_errors=True)
+        open(os.path.join(outside, "server.conf"), "w").close()
+
+        os.rename(outside, os.path.join(self.dir, "moved"))
+
+        self._wait_for(FileCreatedEvent(os.path.join(self.dir, "moved", "server.conf")))
+
+    def test_moved_dir_is_reported_below_its_new_path(self):
+        os.mkdir(os.path.join(self.dir, "old"))
+        self._wait_for(DirCreatedEvent(os.path.join(self.dir, "old")))
+        os.rename(os.path.join(self.dir, "old"), os.path.join(self.dir, "new"))
+
+        path = os.path.join(self.dir, "new", "server.conf")
+        open(path, "w").close()
+
+        self._wait_for(FileCreatedEvent(path))
+
+    def test_unscheduled_watch_reports_nothing(self):
+        self.observer.unschedule(self.watch)
+
+        open(os.path.join(self.dir, "server.conf"), "w").close()
+        time.sleep(0.2)
+
+        self.assertEqual(self.recorder.events, [])
+        self.assertEqual(self.observer.paths, {})
+
+    def test_unscheduling_a_watch_keeps_other_watches_of_the_same_dir(self):
+        other = EventRecorder()
+        self.observer.schedule(other, self.dir, recursive=True)
+        path = os.path.join(self.dir, "server.conf")
+
+        self.observer.unschedule(self.watch)
+        self._touch(path)
+
+        self._wait_for(FileCreatedEvent(path), other)
+        self.assertEqual(self.recorder.events, [])
+
+    def test_events_are_reported_to_every_watch_of_a_dir(self):
+        other = EventRecorder()
+        self.observer.schedule(other, self.dir, recursive=False)
+        path = os.path.join(self.dir, "server.conf")
+
+        os.unlink(self._touch(path))
+
+        self._wait_for(FileDeletedEvent(path))
+        self._wait_for(FileDeletedEvent(path), other)
+
+    def test_overflow_is_reported(self):
+        on_overflow = Mock()
+        self.observer.on_overflow = on_overflow
+
+        self.observer.dispatch([(-1, IN_Q_OVERFLOW, 0, "")])
+
+        on_overflow.assert_called_once_with()
+
+    def _touch(self, path):
+        open(path, "w").close()
+        return path
+
+    def _wait_for(self, event, recorder=None, timeout=5.0):
+        recorder = recorder or self.recorder
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if event in recorder.events:
+                return
+            time.sleep(0.01)
+        self.fail(f"{event} was not reported, got {recorder.events}")
+
+
+@requires_linux
+class TestInotifyWatcher(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.handler = nginx_config_reloader.NginxConfigReloader(
+            dir_to_watch=self.dir, watcher="inotify", scan_cache_file=None
+        )
+
+    def tearDown(self):
+        self.handler.stop_observer()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_changes_are_recorded_with_the_inotify_backend(self):
+        self.handler.start_observer()
+        self.assertIsInstance(self.handler.observer, InotifyObserver)
+
+        with open(os.path.join(self.dir, "server.conf"), "w") as f:
+            f.write("rewrite ^/a /b;\n")
+
+        deadline = time.monotonic() + 5
+        while not self.handler.dirty and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(self.handler.dirty)
+
+    def test_lost_events_restart_the_observer(self):
+        self.handler.start_observer()
+        observer = self.handler.observer
+        self.handler.reload = Mock()
+
+        self.handler.on_events_lost()
+        self.handler.scheduler.reset()
+        nginx_config_reloader.after_loop(self.handler)
+
+        self.assertIsNot(self.handler.observer, observer)
+        self.assertFalse(self.handler.events_lost)
+        self.handler.reload.assert_called_once_with()
+
+    def test_file_open_for_writing_is_applied_when_closed(self):
+        self.handler.start_observer()
+        path = os.path.join(self.dir, "server.conf")
+
+        with open(path, "w") as f:
+            f.write("rewrite ^/a /b;\n")
+            f.flush()
+            deadline = time.monotonic() + 5
+            while not self.handler.dirty and time.monotonic() < deadline:
+                time.sleep(0.01)
+            time.sleep(self.handler.scheduler.quiet_period * 2)
+            self.assertTrue(self.handler.dirty)
+            self.assertFalse(self.handler.scheduler.due())
+
+        self.handler.scheduler.wait(5)
+        self.assertTrue(self.handler.scheduler.due())
+        self.assertIn(Change(path, "closed"), self.handler.changes.take()[1])
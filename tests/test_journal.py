@@ -0,0 +1,36 @@
+from nginx_config_reloader.journal import Change, ChangeJournal
+from tests.testcase import TestCase
+
+
+class TestChangeJournal(TestCase):
+    def setUp(self):
+        self.journal = ChangeJournal()
+
+    def test_new_journal_is_not_dirty(self):
+        self.assertFalse(self.journal.dirty)
+        self.assertEqual(self.journal.take(), (0, set()))
+
+    def test_take_returns_and_forgets_changes(self):
+        self.journal.record("/a", "modified")
+        self.journal.record("/b", "moved")
+        self.journal.record("/a", "modified")
+
+        self.assertEqual(
+            self.journal.take(),
+            (3, {Change("/a", "modified"), Change("/b", "moved")}),
+        )
+        self.assertFalse(self.journal.dirty)
+
+    def test_discard_keeps_newer_changes(self):
+        self.journal.record("/a", "modified")
+        self.journal.record("/b", "modified")
+        generation = self.journal.generation
+        self.journal.record("/c", "modified")
+        self.journal.record("/a", "modified")
+
+        self.journal.discard(generation)
+
+        self.assertEqual(
+            self.journal.take()[1],
+            {Change("/c", "modified"), Change("/a", "modified")},
+        )
@@ -1,6 +1,6 @@
 import shutil
 from tempfile import mkdtemp
-from unittest.mock import Mock
+from unittest.mock import Mock, call
 
 import nginx_config_reloader
 from nginx_config_reloader import main
@@ -24,6 +24,16 @@ class TestMain(TestCase):
             use_systemd=False,
             no_dbus=False,
             error_file=self.custom_error_file,
+            scan_workers=1,
+            skip_unreferenced_reloads=False,
+            keep_generations=10,
+            generation_store_max_bytes=0,
+            check_staged_config=False,
+            quiet_period=0.1,
+            max_latency=2,
+            watcher="watchdog",
+            list_generations=False,
+            rollback=None,
         )
         self.get_logger = self.set_up_context_manager_patch(
             "nginx_config_reloader.get_logger"
@@ -34,6 +44,9 @@ class TestMain(TestCase):
         self.reloader = self.set_up_context_manager_patch(
             "nginx_config_reloader.NginxConfigReloader"
         )
+        self.request_rollback = self.set_up_patch(
+            "nginx_config_reloader.request_rollback", return_value=None
+        )
 
     def tearDown(self):
         shutil.rmtree(self.source, ignore_errors=True)
@@ -58,6 +71,12 @@ class TestMain(TestCase):
             dir_to_watch=self.parse_nginx_config_reloader_arguments.return_value.watchdir,
             use_systemd=self.parse_nginx_config_reloader_arguments.return_value.use_systemd,
             error_file=self.parse_nginx_config_reloader_arguments.return_value.error_file,
+            scan_workers=self.parse_nginx_config_reloader_arguments.return_value.scan_workers,
+            skip_unreferenced_reloads=self.parse_nginx_config_reloader_arguments.return_value.skip_unreferenced_reloads,
+            keep_generations=self.parse_nginx_config_reloader_arguments.return_value.keep_generations,
+            generation_store_max_bytes=self.parse_nginx_config_reloader_arguments.return_value.generation_store_max_bytes,
+            check_staged_config=self.parse_nginx_config_reloader_arguments.return_value.check_staged_config,
+            scan_cache_file=nginx_config_reloader.SCAN_CACHE_FILE,
         )
         self.reloader.return_value.apply_new_config.assert_called_once_with()
 
@@ -85,6 +104,14 @@ class TestMain(TestCase):
             use_systemd=self.parse_nginx_config_reloader_arguments.return_value.use_systemd,
             no_dbus=self.parse_nginx_config_reloader_arguments.return_value.no_dbus,
             error_file=self.parse_nginx_config_reloader_arguments.return_value.error_file,
+            scan_workers=self.parse_nginx_config_reloader_arguments.return_value.scan_workers,
+            skip_unreferenced_reloads=self.parse_nginx_config_reloader_arguments.return_value.skip_unreferenced_reloads,
+            keep_generations=self.parse_nginx_config_reloader_arguments.return_value.keep_generations,
+            generation_store_max_bytes=self.parse_nginx_config_reloader_arguments.return_value.generation_store_max_bytes,
+            check_staged_config=self.parse_nginx_config_reloader_arguments.return_value.check_staged_config,
+            quiet_period=self.parse_nginx_config_reloader_arguments.return_value.quiet_period,
+            max_latency=self.parse_nginx_config_reloader_arguments.return_value.max_latency,
+            watcher=self.parse_nginx_config_reloader_arguments.return_value.watcher,
         )
 
     def test_main_watches_the_config_dir_if_monitor_mode_is_specified_and_includes_allowed(
@@ -104,6 +131,14 @@ class TestMain(TestCase):
             use_systemd=self.parse_nginx_config_reloader_arguments.return_value.use_systemd,
             no_dbus=self.parse_nginx_config_reloader_arguments.return_value.no_dbus,
             error_file=self.parse_nginx_config_reloader_arguments.return_value.error_file,
+            scan_workers=self.parse_nginx_config_reloader_arguments.return_value.scan_workers,
+            skip_unreferenced_reloads=self.parse_nginx_config_reloader_arguments.return_value.skip_unreferenced_reloads,
+            keep_generations=self.parse_nginx_config_reloader_arguments.return_value.keep_generations,
+            generation_store_max_bytes=self.parse_nginx_config_reloader_arguments.return_value.generation_store_max_bytes,
+            check_staged_config=self.parse_nginx_config_reloader_arguments.return_value.check_staged_config,
+            quiet_period=self.parse_nginx_config_reloader_arguments.return_value.quiet_period,
+            max_latency=self.parse_nginx_config_reloader_arguments.return_value.max_latency,
+            watcher=self.parse_nginx_config_reloader_arguments.return_value.watcher,
         )
 
     def test_main_does_not_reload_the_config_once_if_monitor_mode_is_specified(self):
@@ -135,6 +170,14 @@ class TestMain(TestCase):
             use_systemd=self.parse_nginx_config_reloader_arguments.return_value.use_systemd,
             no_dbus=True,
             error_file=self.parse_nginx_config_reloader_arguments.return_value.error_file,
+            scan_workers=self.parse_nginx_config_reloader_arguments.return_value.scan_workers,
+            skip_unreferenced_reloads=self.parse_nginx_config_reloader_arguments.return_value.skip_unreferenced_reloads,
+            keep_generations=self.parse_nginx_config_reloader_arguments.return_value.keep_generations,
+            generation_store_max_bytes=self.parse_nginx_config_reloader_arguments.return_value.generation_store_max_bytes,
+            check_staged_config=self.parse_nginx_config_reloader_arguments.return_value.check_staged_config,
+            quiet_period=self.parse_nginx_config_reloader_arguments.return_value.quiet_period,
+            max_latency=self.parse_nginx_config_reloader_arguments.return_value.max_latency,
+            watcher=self.parse_nginx_config_reloader_arguments.return_value.watcher,
         )
 
     def test_main_rejects_invalid_error_file_name(self):
@@ -173,4 +216,61 @@ class TestMain(TestCase):
             dir_to_watch=self.parse_nginx_config_reloader_arguments.return_value.watchdir,
             use_systemd=self.parse_nginx_config_reloader_arguments.return_value.use_systemd,
             error_file=self.custom_error_file,
+            scan_workers=self.parse_nginx_config_reloader_arguments.return_value.scan_workers,
+            skip_unreferenced_reloads=self.parse_nginx_config_reloader_arguments.return_value.skip_unreferenced_reloads,
+            keep_generations=self.parse_nginx_config_reloader_arguments.return_value.keep_generations,
+            generation_store_max_bytes=self.parse_nginx_config_reloader_arguments.return_value.generation_store_max_bytes,
+            check_staged_config=self.parse_nginx_config_reloader_arguments.return_value.check_staged_config,
+            scan_cache_file=nginx_config_reloader.SCAN_CACHE_FILE,
         )
+
+    def test_main_rolls_back_itself_if_no_reloader_is_running(self):
+        self.parse_nginx_config_reloader_arguments.return_value.rollback = "00000003"
+        self.reloader.return_value.rollback.return_value = True
+
+        ret = main()
+
+        self.assertEqual(0, ret)
+        self.reloader.return_value.rollback.assert_called_once_with("00000003")
+        self.assertFalse(self.reloader.return_value.apply_new_config.called)
+        self.assertIsNone(self.reloader.call_args.kwargs["scan_cache_file"])
+
+    def test_main_has_the_running_reloader_roll_back(self):
+        self.parse_nginx_config_reloader_arguments.return_value.rollback = "00000003"
+        self.request_rollback.return_value = True
+
+        ret = main()
+
+        self.assertEqual(0, ret)
+        self.request_rollback.assert_called_once_with("00000003")
+        self.assertFalse(self.reloader.called)
+
+    def test_main_returns_nonzero_if_rollback_by_running_reloader_fails(self):
+        self.parse_nginx_config_reloader_arguments.return_value.rollback = "00000003"
+        self.request_rollback.return_value = False
+
+        ret = main()
+
+        self.assertEqual(1, ret)
+        self.assertFalse(self.reloader.called)
+
+    def test_main_returns_nonzero_if_rollback_fails(self):
+        self.parse_nginx_config_reloader_arguments.return_value.rollback = "00000003"
+        self.reloader.return_value.rollback.return_value = False
+
+        ret = main()
+
+        self.assertEqual(1, ret)
+
+    def test_main_lists_generations(self):
+        store = self.set_up_patch("nginx_config_reloader.GenerationStore")
+        store.return_value.generations.return_value = ["00000001", "00000002"]
+        self.parse_nginx_config_reloader_arguments.return_value.list_generations = True
+        print_ = self.set_up_patch("builtins.print")
+
+        ret = main()
+
+        self.assertEqual(0, ret)
+        store.assert_called_once_with(nginx_config_reloader.GENERATION_STORE_DIR)
+        print_.assert_has_calls([call("00000001"), call("00000002")])
+        self.assertFalse(self.reloader.called)
@@ -4,14 +4,27 @@ import signal
 import stat
 import subprocess
 import sys
+import time
 from tempfile import NamedTemporaryFile, mkdtemp, mkstemp
 from unittest import mock
 from unittest.mock import Mock
 
 import pytest
+from watchdog.events import DirCreatedEvent
 
 import nginx_config_reloader
-from tests.testcase import TestCase
+from nginx_config_reloader import (
+    APPLY_STAGES,
+    CHMOD_STAGE,
+    MAGENTO_STAGE,
+    RELOAD_STAGE,
+    TEST_STAGE,
+    ApplyCancelled,
+)
+from nginx_config_reloader.include_graph import IncludeGraph
+from nginx_config_reloader.journal import Change
+from nginx_config_reloader.settings import FORBIDDEN_CONFIG_DIRECTIVES
+from tests.testcase import ApplyTestCase, TestCase
 
 # Skip marker for tests that require Linux-specific features (rsync with --chown, etc.)
 requires_linux = pytest.mark.skipif(
@@ -32,6 +45,7 @@ class TestConfigReloader(TestCase):
         self.source = mkdtemp()
         self.dest = mkdtemp()
         self.backup = mkdtemp()
+        self.generations = mkdtemp()
         self.main = mkdtemp()
         _, self.mag_conf = mkstemp(text=True)
         _, self.mag1_conf = mkstemp(text=True)
@@ -41,12 +55,16 @@ class TestConfigReloader(TestCase):
         nginx_config_reloader.DIR_TO_WATCH = self.source
         nginx_config_reloader.CUSTOM_CONFIG_DIR = self.dest
         nginx_config_reloader.BACKUP_CONFIG_DIR = self.backup
+        nginx_config_reloader.GENERATION_STORE_DIR = self.generations
 
         nginx_config_reloader.MAGENTO_CONF = self.mag_conf
         nginx_config_reloader.MAGENTO1_CONF = self.mag1_conf
         nginx_config_reloader.MAGENTO2_CONF = self.mag2_conf
 
-        self.test_config = self.set_up_patch("subprocess.check_output")
+        self.set_up_patch("subprocess.check_output")
+        self.test_config = self.set_up_patch(
+            "nginx_config_reloader.NginxConfigReloader.run_config_test"
+        )
         self.kill = self.set_up_patch("os.kill")
         self.error_file = os.path.join(
             nginx_config_reloader.DIR_TO_WATCH, nginx_config_reloader.ERROR_FILE
@@ -58,6 +76,7 @@ class TestConfigReloader(TestCase):
         shutil.rmtree(self.source, ignore_errors=True)
         shutil.rmtree(self.dest, ignore_errors=True)
         shutil.rmtree(self.backup, ignore_errors=True)
+        shutil.rmtree(self.generations, ignore_errors=True)
         shutil.rmtree(self.main, ignore_errors=True)
         for f in [self.mag_conf, self.mag1_conf, self.mag2_conf]:
             try:
@@ -233,32 +252,59 @@ class TestConfigReloader(TestCase):
     def test_that_apply_new_config_writes_error_message_to_source_dir_if_body_temp_path_check_fails(
         self,
     ):
-        self.test_config.side_effect = subprocess.CalledProcessError(
-            1, "nginx", "oops!"
-        )
+        self._write_file(self._source("server.tmp"), "client_body_temp_path /tmp;\n")
 
         tm = self._get_nginx_config_reloader_instance()
         tm.apply_new_config()
 
         contents = self._read_file(self._source(nginx_config_reloader.ERROR_FILE))
-        self.assertIn(nginx_config_reloader.FORBIDDEN_CONFIG_REGEX[0][1], contents)
+        self.assertIn(FORBIDDEN_CONFIG_DIRECTIVES[0][2], contents)
+        self.assertIn(f"{self._source('server.tmp')}:1:", contents)
+        self.assertFalse(self.test_config.called)
 
     def test_that_apply_new_config_writes_error_message_to_source_dir_if_include_is_rejected(
         self,
     ):
-        self.isdir = self.set_up_context_manager_patch(
-            "nginx_config_reloader.os.path.isdir"
+        self._write_file(
+            self._source("server.include"), "# comment\ninclude /etc/passwd;\n"
         )
-        self.isdir.return_value = True
-        self.test_config.side_effect = subprocess.CalledProcessError(
-            1, "", ""
-        )  # grep with -q
 
         tm = self._get_nginx_config_reloader_instance()
         tm.apply_new_config()
 
         contents = self._read_file(self._source(nginx_config_reloader.ERROR_FILE))
-        self.assertIn(nginx_config_reloader.FORBIDDEN_CONFIG_REGEX[0][1], contents)
+        self.assertIn(FORBIDDEN_CONFIG_DIRECTIVES[2][2], contents)
+        self.assertIn(
+            f"{self._source('server.include')}:2: include /etc/passwd;", contents
+        )
+        self.assertFalse(self.test_config.called)
+
+    def test_that_apply_new_config_ignores_forbidden_config_in_files_nginx_does_not_load(
+        self,
+    ):
+        self._write_file(self._source("server.rewrites"), "rewrite ^/a /b;\n")
+        self._write_file(self._source("README"), "include /etc/passwd;\n")
+        self._write_file(
+            os.path.join(self.main, "nginx.conf"), "include /etc/nginx/app/server.*;\n"
+        )
+        self.set_up_patch(
+            "nginx_config_reloader.include_graph.MAIN_CONFIG_DIR", self.main
+        )
+        self.set_up_patch(
+            "nginx_config_reloader.include_graph.CUSTOM_CONFIG_DIR", "/etc/nginx/app"
+        )
+        install = self.set_up_patch(
+            "nginx_config_reloader.NginxConfigReloader.install_new_custom_config_dir"
+        )
+
+        tm = self._get_nginx_config_reloader_instance()
+        tm.include_graph = IncludeGraph(
+            self.source, roots=[os.path.join(self.main, "nginx.conf")]
+        )
+        tm.apply_new_config()
+
+        self.assertFalse(os.path.exists(self.error_file))
+        self.assertTrue(install.called)
 
     @requires_linux
     def test_that_apply_new_config_does_not_check_includes_if_dir_to_watch_does_not_exist(
@@ -294,10 +340,7 @@ class TestConfigReloader(TestCase):
         tm = self._get_nginx_config_reloader_instance()
         result = tm.apply_new_config()
 
-        self.assertEqual(
-            len(self.test_config.mock_calls),
-            len(nginx_config_reloader.FORBIDDEN_CONFIG_REGEX),
-        )
+        self.assertFalse(self.test_config.called)
         self.assertEqual(len(self.kill.mock_calls), 0)
         self.assertFalse(result)
 
@@ -380,7 +423,7 @@ class TestConfigReloader(TestCase):
         directory_is_unmounted.assert_called_once_with(
             nginx_config_reloader.DIR_TO_WATCH
         )
-        apply_new_config.assert_called_once_with()
+        apply_new_config.assert_called_once_with(full=False)
 
     def test_that_reload_does_not_apply_new_config_if_directory_is_unmounted(self):
         directory_is_unmounted = self.set_up_patch(
@@ -422,7 +465,7 @@ class TestConfigReloader(TestCase):
         tm = self._get_nginx_config_reloader_instance()
         tm.reload(send_signal=False)
 
-        apply_new_config.assert_called_once_with()
+        apply_new_config.assert_called_once_with(full=False)
         signal.emit.assert_not_called()
 
     def test_that_error_file_is_not_moved_to_dest_dir(self):
@@ -461,6 +504,18 @@ class TestConfigReloader(TestCase):
 
         self.assertTrue(tm.dirty)
 
+    def test_that_handle_event_records_changes(self):
+        tm = self._get_nginx_config_reloader_instance()
+        event = Event("some_file")
+        event.dest_path = "other_file"
+
+        tm.handle_event(event)
+
+        self.assertEqual(
+            tm.changes.take()[1],
+            {Change("some_file", "modified"), Change("other_file", "modified")},
+        )
+
     def test_that_flags_trigger_config_reload(self):
         tm = self._get_nginx_config_reloader_instance()
         tm.handle_event(Event("magento2.flag"))
@@ -524,10 +579,14 @@ class TestConfigReloader(TestCase):
             "nginx_config_reloader.NginxConfigReloader.remove_error_file"
         )
         # ensure all IO operations would fail other than error_file removal
-        mock_shutil = self.set_up_patch("nginx_config_reloader.shutil")
-        mock_shutil.rmtree.side_effect = RuntimeError("mock error")
-        mock_shutil.move.side_effect = RuntimeError("mock error")
-        mock_shutil.copytree.side_effect = RuntimeError("mock error")
+        self.set_up_patch(
+            "nginx_config_reloader.safe_copy_files",
+            side_effect=RuntimeError("mock error"),
+        )
+        self.set_up_patch(
+            "nginx_config_reloader.exchange_paths",
+            side_effect=RuntimeError("mock error"),
+        )
 
         tm = self._get_nginx_config_reloader_instance()
         with self.assertRaises(RuntimeError):
@@ -538,10 +597,7 @@ class TestConfigReloader(TestCase):
     def test_that_install_new_custom_config_dir_excludes_custom_error_file_from_sync(
         self,
     ):
-        self.set_up_patch("nginx_config_reloader.shutil.rmtree")
-        self.set_up_patch("nginx_config_reloader.shutil.move")
-        self.set_up_patch("nginx_config_reloader.os.path.exists", return_value=True)
-        self.set_up_patch("nginx_config_reloader.os.mkdir")
+        self.set_up_patch("nginx_config_reloader.exchange_paths")
         safe_copy_files = self.set_up_patch("nginx_config_reloader.safe_copy_files")
 
         tm = self._get_nginx_config_reloader_instance(error_file=self.custom_error_name)
@@ -549,10 +605,164 @@ class TestConfigReloader(TestCase):
 
         safe_copy_files.assert_called_once_with(
             self.source,
-            self.dest,
+            self.backup,
             list(nginx_config_reloader.SYNC_IGNORE_FILES) + [self.custom_error_name],
         )
 
+    def test_new_config_is_swapped_with_installed_config(self):
+        self._write_file(self._dest("old.conf"), "listen 80;")
+        self._write_file(self._source("new.conf"), "listen 80;")
+        exchange_paths = self.set_up_patch(
+            "nginx_config_reloader.exchange_paths",
+            side_effect=nginx_config_reloader.exchange_paths,
+        )
+
+        tm = self._get_nginx_config_reloader_instance()
+        tm.install_new_custom_config_dir()
+
+        exchange_paths.assert_called_once_with(self.backup, self.dest)
+        self.assertEqual(os.listdir(self.dest), ["new.conf"])
+        self.assertEqual(os.listdir(self.backup), ["old.conf"])
+
+    def test_first_config_is_moved_into_place(self):
+        os.rmdir(self.dest)
+        self._write_file(self._source("new.conf"), "listen 80;")
+
+        tm = self._get_nginx_config_reloader_instance()
+        tm.install_new_custom_config_dir()
+        tm.restore_old_custom_config_dir()
+
+        self.assertFalse(os.path.exists(self.dest))
+
+    def test_restore_swaps_the_installed_config_back(self):
+        self._write_file(self._dest("old.conf"), "listen 80;")
+        self._write_file(self._source("new.conf"), "listen 80;")
+
+        tm = self._get_nginx_config_reloader_instance()
+        tm.install_new_custom_config_dir()
+        tm.restore_old_custom_config_dir()
+        tm.restore_old_custom_config_dir()
+
+        self.assertEqual(os.listdir(self.dest), ["old.conf"])
+        self.assertEqual(os.listdir(self.backup), ["new.conf"])
+
+    def test_restore_does_nothing_if_the_config_was_not_swapped(self):
+        self._write_file(self._dest("old.conf"), "listen 80;")
+        self.set_up_patch(
+            "nginx_config_reloader.safe_copy_files", side_effect=OSError("error")
+        )
+        exchange_paths = self.set_up_patch("nginx_config_reloader.exchange_paths")
+
+        tm = self._get_nginx_config_reloader_instance()
+        with self.assertRaises(OSError):
+            tm.install_new_custom_config_dir()
+        tm.restore_old_custom_config_dir()
+
+        self.assertFalse(exchange_paths.called)
+
+    def test_installed_config_is_stored_as_generation(self):
+        self._write_file(self._source("server.conf"), "listen 80;")
+
+        tm = self._get_nginx_config_reloader_instance()
+        tm.apply_new_config()
+
+        self.assertEqual(tm.generation_store.generations(), ["00000001"])
+
+    def test_config_that_fails_check_is_not_stored(self):
+        self.test_config.side_effect = subprocess.CalledProcessError(1, "nginx -t")
+
+        tm = self._get_nginx_config_reloader_instance()
+        tm.apply_new_config()
+
+        self.assertEqual(tm.generation_store.generations(), [])
+
+    def test_rollback_installs_generation_and_reloads(self):
+        self._write_file(self._source("server.conf"), "listen 80;")
+        tm = self._get_nginx_config_reloader_instance()
+        tm.apply_new_config()
+        self._write_file(self._source("server.conf"), "listen 81;")
+        tm.apply_new_config()
+        self.kill.reset_mock()
+
+        self.assertTrue(tm.rollback("00000001"))
+
+        self.assertEqual(self._read_file(self._dest("server.conf")), "listen 80;")
+        self.kill.assert_called_once_with(42, signal.SIGHUP)
+        self.assertIsNone(tm.applied_digest)
+
+    def test_rollback_is_undone_if_config_check_fails(self):
+        self._write_file(self._source("server.conf"), "listen 80;")
+        tm = self._get_nginx_config_reloader_instance()
+        tm.apply_new_config()
+        self._write_file(self._source("server.conf"), "listen 81;")
+        tm.apply_new_config()
+        self.test_config.side_effect = subprocess.CalledProcessError(1, "nginx -t")
+
+        self.assertFalse(tm.rollback("00000001"))
+
+        self.assertEqual(self._read_file(self._dest("server.conf")), "listen 81;")
+
+    def test_rollback_to_unknown_generation_fails(self):
+        tm = self._get_nginx_config_reloader_instance()
+
+        self.assertFalse(tm.rollback("00000042"))
+        self.assertFalse(self.kill.called)
+
+    def test_staged_config_is_checked_before_it_is_installed(self):
+        main_config = self._write_main_config()
+        self._write_file(self._source("server.conf"), "listen 80;")
+
+        tm = self._get_nginx_config_reloader_instance()
+        tm.check_staged_config = True
+        self.test_config.side_effect = lambda *args, **kwargs: self.assertEqual(
+            os.listdir(self.dest), []
+        )
+
+        self.assertTrue(tm.apply_new_config())
+
+        (args,), _ = self.test_config.call_args
+        self.assertEqual(args[:3], [nginx_config_reloader.NGINX, "-t", "-c"])
+        self.assertEqual(os.path.dirname(args[3]), os.path.dirname(main_config))
+        self.assertEqual(os.listdir(self.dest), ["server.conf"])
+        self.kill.assert_called_once_with(42, signal.SIGHUP)
+
+    def test_invalid_staged_config_is_not_installed(self):
+        self._write_main_config()
+        self._write_file(self._dest("old.conf"), "listen 80;")
+        self._write_file(self._source("server.conf"), "listen 80;")
+        exchange_paths = self.set_up_patch("nginx_config_reloader.exchange_paths")
+
+        def check(args, **kwargs):
+            raise subprocess.CalledProcessError(
+                1, args, f"error in {self.backup}/server.conf:1".encode()
+            )
+
+        self.test_config.side_effect = check
+        tm = self._get_nginx_config_reloader_instance()
+        tm.check_staged_config = True
+
+        self.assertFalse(tm.apply_new_config())
+
+        self.assertFalse(exchange_paths.called)
+        self.assertEqual(os.listdir(self.dest), ["old.conf"])
+        self.assertEqual(
+            self._read_file(self.error_file), f"error in {self.dest}/server.conf:1"
+        )
+        self.assertFalse(self.kill.called)
+
+    def test_config_is_installed_before_check_without_main_config(self):
+        self._write_file(self._source("server.conf"), "listen 80;")
+        self.set_up_patch(
+            "nginx_config_reloader.MAIN_CONFIG_FILE",
+            os.path.join(self.main, "missing.conf"),
+        )
+
+        tm = self._get_nginx_config_reloader_instance()
+        tm.check_staged_config = True
+        tm.apply_new_config()
+
+        self.test_config.assert_called_once_with([nginx_config_reloader.NGINX, "-t"])
+
     def test_recursive_symlink_is_not_copied(self):
         os.mkdir(os.path.join(self.source, "new_dir"))
         os.symlink(self.source, os.path.join(self.source, "new_dir/recursive_symlink"))
@@ -749,8 +959,15 @@ class TestConfigReloader(TestCase):
             dir_to_watch=self.source,
             magento2_flag=magento2_flag,
             error_file=error_file,
+            scan_cache_file=None,
         )
 
+    def _write_main_config(self):
+        main_config = os.path.join(self.main, "nginx.conf")
+        self._write_file(main_config, f"http {{ include {self.dest}/*; }}\n")
+        self.set_up_patch("nginx_config_reloader.MAIN_CONFIG_FILE", main_config)
+        return main_config
+
     def _write_file(self, name, contents):
         with open(name, "w") as f:
             f.write(contents)
@@ -766,9 +983,520 @@ class TestConfigReloader(TestCase):
         return os.path.join(self.dest, name)
 
 
+class TestReloadGating(ApplyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_main_config("include /etc/nginx/app/server.*;\n")
+        self.server = self.write(self.source, "server.rewrites", "")
+        self.readme = self.write(self.source, "README", "")
+        self.logger = self.set_up_patch("logging.Logger")
+        self.reloader(logger=self.logger, skip_unreferenced_reloads=True)
+
+    def test_first_apply_tests_and_reloads(self):
+        self.tm.changes.record(self.readme, "modified")
+
+        self.assertTrue(self.tm.apply_new_config())
+
+        self.assertTrue(self.run_config_test.called)
+        self.assertTrue(self.reload_nginx.called)
+
+    def test_change_of_unreferenced_file_is_synced_without_reload(self):
+        self._apply_once()
+
+        self.change(self.readme)
+        self.assertTrue(self.tm.apply_new_config())
+
+        self.assertTrue(self.install.called)
+        self.assertFalse(self.run_config_test.called)
+        self.assertFalse(self.reload_nginx.called)
+        self.logger.info.assert_any_call(
+            f"Not testing and reloading nginx: nginx does not load any of {self.readme}"
+        )
+
+    def test_change_of_loaded_file_reloads(self):
+        self._apply_once()
+
+        self.change(self.readme)
+        self.change(self.server)
+        self.tm.apply_new_config()
+
+        self.assertTrue(self.run_config_test.called)
+        self.assertTrue(self.reload_nginx.called)
+
+    def test_file_that_becomes_loaded_reloads(self):
+        self._apply_once()
+
+        new = self.write(self.source, "server.new", "")
+        self.tm.changes.record(new, "modified")
+        self.tm.apply_new_config()
+
+        self.assertTrue(self.reload_nginx.called)
+
+    def test_deleted_loaded_file_reloads(self):
+        self._apply_once()
+
+        os.unlink(self.server)
+        self.tm.changes.record(self.server, "modified")
+        self.tm.apply_new_config()
+
+        self.assertTrue(self.reload_nginx.called)
+
+    def test_changed_directory_with_loaded_files_reloads(self):
+        self.write(self.main, "nginx.conf", "include /etc/nginx/app/sub/*;\n")
+        self.write(self.source, "sub/server", "")
+        self._apply_once()
+
+        self.change(os.path.join(self.source, "sub/server"))
+        self.tm.changes.record(os.path.join(self.source, "sub"), "modified")
+        self.tm.apply_new_config()
+
+        self.assertTrue(self.reload_nginx.called)
+
+    def test_full_apply_finds_files_added_without_a_report(self):
+        self._apply_once()
+        new = self.write(self.source, "server.new", "")
+
+        self.tm.apply_new_config(full=True)
+
+        self.assertTrue(self.tm.include_graph.is_reachable(new))
+
+    def test_magento2_flag_reloads(self):
+        self._apply_once()
+
+        self.change(self.tm.magento2_flag)
+        self.tm.apply_new_config()
+
+        self.assertTrue(self.reload_nginx.called)
+
+    def test_reload_without_changed_files_is_not_skipped(self):
+        self._apply_once()
+
+        self.tm.apply_new_config()
+
+        self.assertTrue(self.reload_nginx.called)
+
+    def test_change_is_not_skipped_after_failed_config_test(self):
+        self.run_config_test.side_effect = subprocess.CalledProcessError(
+            1, "nginx -t", b"error"
+        )
+        self.tm.apply_new_config()
+        self.run_config_test.reset_mock(side_effect=True)
+
+        self.change(self.readme)
+        self.tm.apply_new_config()
+
+        self.assertTrue(self.run_config_test.called)
+        self.assertTrue(self.reload_nginx.called)
+
+    def test_change_is_not_skipped_if_loaded_files_are_unknown(self):
+        self._apply_once()
+        os.unlink(self.main_config)
+
+        self.change(self.readme)
+        self.tm.apply_new_config()
+
+        self.assertTrue(self.reload_nginx.called)
+
+    def test_change_is_not_skipped_if_disabled(self):
+        self.tm.skip_unreferenced_reloads = False
+        self._apply_once()
+
+        self.change(self.readme)
+        self.tm.apply_new_config()
+
+        self.assertTrue(self.reload_nginx.called)
+
+    def _apply_once(self):
+        self.tm.apply_new_config()
+        self.reset_apply_mocks()
+
+
+class TestUnchangedConfig(ApplyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.scan = self.set_up_scan()
+        self.path = self.write(self.source, "server.rewrites", "rewrite ^/a /b;\n")
+        self.reloader()
+        self.tm.apply_new_config()
+        self.scan.reset_mock()
+        self.reload_nginx.reset_mock()
+
+    def test_unchanged_config_is_not_applied(self):
+        self.change(self.path, "rewrite ^/a /b;\n")
+
+        self.assertTrue(self.tm.apply_new_config())
+
+        self.assertFalse(self.scan.called)
+        self.assertFalse(self.reload_nginx.called)
+
+    def test_unchanged_config_removes_error_file_of_failed_attempt(self):
+        error_file = os.path.join(self.source, nginx_config_reloader.ERROR_FILE)
+        self.change(self.path, "include /etc/passwd;\n")
+        self.scan.return_value = True
+        self.tm.apply_new_config()
+        with open(error_file, "w") as f:
+            f.write("error")
+
+        self.change(self.path, "rewrite ^/a /b;\n")
+        self.tm.apply_new_config()
+
+        self.assertFalse(os.path.exists(error_file))
+        self.assertFalse(self.reload_nginx.called)
+
+    def test_changed_config_is_applied(self):
+        self.change(self.path, "rewrite ^/a /c;\n")
+
+        self.tm.apply_new_config()
+
+        self.assertTrue(self.reload_nginx.called)
+
+    def test_magento2_flag_is_part_of_config(self):
+        with open(self.tm.magento2_flag, "w"):
+            pass
+        self.tm.changes.record(self.tm.magento2_flag, "modified")
+
+        self.tm.apply_new_config()
+
+        self.assertTrue(self.reload_nginx.called)
+
+    def test_reload_without_changes_is_always_applied(self):
+        self.tm.apply_new_config()
+
+        self.assertTrue(self.reload_nginx.called)
+
+    def test_unchanged_config_after_failed_test_is_not_applied(self):
+        self.run_config_test.side_effect = subprocess.CalledProcessError(
+            1, "nginx -t", b"error"
+        )
+        self.change(self.path, "rewrite ^/a /c;\n")
+        self.tm.apply_new_config()
+        self.run_config_test.side_effect = None
+
+        self.change(self.path, "rewrite ^/a /b;\n")
+        self.tm.apply_new_config()
+
+        self.assertFalse(self.reload_nginx.called)
+
+
+class TestCachedConfigCheck(ApplyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_main_config("include /etc/nginx/app/server.*;\n")
+        self.server = os.path.join(self.source, "server.rewrites")
+        self.error_file = os.path.join(self.source, nginx_config_reloader.ERROR_FILE)
+        self.reloader()
+
+    def test_config_that_failed_before_is_not_tested_again(self):
+        self.run_config_test.side_effect = subprocess.CalledProcessError(
+            1, "nginx -t", b"error"
+        )
+        self._apply("rewrite ^/a /b;\n")
+        self.run_config_test.side_effect = None
+        self._apply("rewrite ^/a /c;\n")
+
+        self.assertFalse(self._apply("rewrite ^/a /b;\n"))
+
+        self.assertFalse(self.run_config_test.called)
+        self.assertFalse(self.install.called)
+        self.assertFalse(self.reload_nginx.called)
+        with open(self.error_file) as f:
+            self.assertEqual(f.read(), "error")
+
+    def test_config_that_passed_before_is_not_tested_again(self):
+        self._apply("rewrite ^/a /b;\n")
+        self._apply("rewrite ^/a /c;\n")
+
+        self.assertTrue(self._apply("rewrite ^/a /b;\n"))
+
+        self.assertFalse(self.run_config_test.called)
+        self.assertTrue(self.install.called)
+        self.assertTrue(self.reload_nginx.called)
+
+    def test_changed_main_config_is_tested_again(self):
+        self._apply("rewrite ^/a /b;\n")
+        self._apply("rewrite ^/a /c;\n")
+        with open(self.main_config, "a") as f:
+            f.write("# changed\n")
+
+        self._apply("rewrite ^/a /b;\n")
+
+        self.assertTrue(self.run_config_test.called)
+
+    def test_reload_without_changes_is_always_tested(self):
+        self._apply("rewrite ^/a /b;\n")
+        self.run_config_test.reset_mock()
+
+        self.tm.apply_new_config()
+
+        self.assertTrue(self.run_config_test.called)
+
+    def _apply(self, contents):
+        self.reset_apply_mocks()
+        self.change(self.server, contents)
+        return self.tm.apply_new_config()
+
+
+class TestSyntaxCheckBeforeConfigTest(ApplyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_main_config("include /etc/nginx/app/server.*;\n")
+        self.set_up_patch("nginx_config_reloader.CUSTOM_CONFIG_DIR", "/etc/nginx/app")
+        self.error_file = os.path.join(self.source, nginx_config_reloader.ERROR_FILE)
+        self.reloader()
+
+    def test_syntax_error_is_reported_without_nginx_test(self):
+        self._change("sub/server.rewrites", "location / {\n")
+        self._change("server.conf", "include /etc/nginx/app/sub/server.rewrites;\n")
+
+        self.assertFalse(self.tm.apply_new_config())
+
+        self.assertFalse(self.run_config_test.called)
+        self.assertFalse(self.install.called)
+        self.assertFalse(self.reload_nginx.called)
+        with open(self.error_file) as f:
+            self.assertEqual(
+                f.read(),
+                'nginx: [emerg] unexpected end of file, expecting "}" in '
+                "/etc/nginx/app/sub/server.rewrites:1\n"
+                "nginx: syntax check of the changed files failed\n",
+            )
+
+    def test_valid_change_is_tested_with_nginx(self):
+        self._change("server.conf", "location / {\n}\n")
+
+        self.assertTrue(self.tm.apply_new_config())
+
+        self.assertTrue(self.run_config_test.called)
+
+    def test_files_nginx_does_not_load_are_not_checked(self):
+        self._change("README", "location / {\n")
+
+        self.assertTrue(self.tm.apply_new_config())
+
+        self.assertTrue(self.run_config_test.called)
+
+    def _change(self, name, contents):
+        self.change(os.path.join(self.source, name), contents)
+
+
+class TestStagePlan(ApplyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.scan = self.set_up_scan()
+        self.reloader()
+        self.tm.apply_new_config()
+        self.scan.reset_mock()
+        self.reset_apply_mocks()
+
+    def test_all_stages_without_changes(self):
+        self.assertEqual(self.tm.plan_stages(set()), list(APPLY_STAGES))
+
+    def test_magento2_flag_only_switches_magento_config(self):
+        self._create(self.tm.magento2_flag)
+
+        self.assertEqual(
+            self.tm.plan_stages(self.tm.changes.take()[1]),
+            [MAGENTO_STAGE, TEST_STAGE, RELOAD_STAGE],
+        )
+
+    def test_magento2_flag_is_applied_without_sync(self):
+        self._create(self.tm.magento2_flag)
+
+        self.assertTrue(self.tm.apply_new_config())
+
+        self.install_magento.assert_called_once_with()
+        self.assertTrue(self.run_config_test.called)
+        self.assertTrue(self.reload_nginx.called)
+        self.assertFalse(self.scan.called)
+        self.assertFalse(self.chmod.called)
+        self.assertFalse(self.install.called)
+
+    def test_new_directory_only_gets_permissions_fixed(self):
+        path = os.path.join(self.source, "sub")
+        os.mkdir(path)
+        self.tm.on_created(DirCreatedEvent(path))
+
+        self.assertEqual(
+            self.tm.plan_stages(set(self.tm.changes.entries)), [CHMOD_STAGE]
+        )
+        self.assertTrue(self.tm.apply_new_config())
+
+        self.chmod.assert_called_once_with()
+        self.assertFalse(self.install.called)
+        self.assertFalse(self.run_config_test.called)
+        self.assertFalse(self.reload_nginx.called)
+
+    def test_directory_moved_in_with_files_runs_all_stages(self):
+        path = os.path.join(self.source, "sub")
+        os.mkdir(path)
+        self._create(os.path.join(path, "server.rewrites"))
+        self.tm.changes.take()
+        self.tm.on_created(DirCreatedEvent(path))
+
+        self.assertEqual(
+            self.tm.plan_stages(set(self.tm.changes.entries)), list(APPLY_STAGES)
+        )
+
+    def test_other_changes_run_all_stages(self):
+        path = os.path.join(self.source, "server.rewrites")
+        self._create(self.tm.magento2_flag)
+        self._create(path)
+
+        self.assertEqual(
+            self.tm.plan_stages(set(self.tm.changes.entries)), list(APPLY_STAGES)
+        )
+
+    def test_all_stages_after_failed_apply(self):
+        self.tm.installed_config_tested = False
+        self._create(self.tm.magento2_flag)
+
+        self.assertEqual(
+            self.tm.plan_stages(set(self.tm.changes.entries)), list(APPLY_STAGES)
+        )
+
+    def test_full_apply_runs_all_stages(self):
+        self._create(self.tm.magento2_flag)
+
+        self.tm.apply_new_config(full=True)
+
+        self.assertTrue(self.scan.called)
+        self.assertTrue(self.install.called)
+        self.assertTrue(self.reload_nginx.called)
+
+    def _create(self, path):
+        with open(path, "w"):
+            pass
+        self.tm.changes.record(path, "created")
+
+
+class TestRunConfigTest(TestCase):
+    def setUp(self):
+        self.source = mkdtemp()
+        self.tm = nginx_config_reloader.NginxConfigReloader(
+            dir_to_watch=self.source, scan_cache_file=None
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.source, ignore_errors=True)
+
+    def test_failed_test_raises_with_output(self):
+        with self.assertRaises(subprocess.CalledProcessError) as e:
+            self.tm.run_config_test(["sh", "-c", "echo error; exit 1"])
+
+        self.assertEqual(e.exception.output, b"error\n")
+
+    def test_passed_test_returns(self):
+        self.tm.run_config_test(["true"])
+
+    def test_test_is_killed_when_apply_is_cancelled(self):
+        self.tm.apply_generation = self.tm.changes.generation
+        self.tm.changes.record(os.path.join(self.source, "a"), "modified")
+        start = time.monotonic()
+
+        with self.assertRaises(ApplyCancelled):
+            self.tm.run_config_test(["sleep", "10"])
+
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_test_outside_apply_is_not_cancelled(self):
+        self.tm.changes.record(os.path.join(self.source, "a"), "modified")
+
+        self.tm.run_config_test(["sh", "-c", "sleep 0.2"])
+
+
+class TestCancelledApply(ApplyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.scan = self.set_up_scan()
+        self.restore = self.set_up_patch(
+            "nginx_config_reloader.NginxConfigReloader.restore_old_custom_config_dir"
+        )
+        self.reloader()
+        self.first = os.path.join(self.source, "first.conf")
+        self.second = os.path.join(self.source, "second.conf")
+        self.change(self.first)
+
+    def test_newer_change_cancels_apply_at_next_stage(self):
+        self.scan.side_effect = lambda: self.change(self.second)
+
+        self.assertFalse(self.tm.apply_new_config())
+
+        self.assertFalse(self.install.called)
+        self.assertFalse(self.run_config_test.called)
+        self.assertFalse(self.reload_nginx.called)
+
+    def test_cancelled_changes_are_applied_with_newer_ones(self):
+        self.scan.side_effect = lambda: self.change(self.second)
+        self.tm.apply_new_config()
+
+        self.assertEqual(
+            self.tm.changes.take()[1],
+            {Change(self.first, "modified"), Change(self.second, "modified")},
+        )
+
+    def test_config_is_not_reloaded_if_changed_during_test(self):
+        self.run_config_test.side_effect = lambda args: self.change(self.second)
+
+        self.assertFalse(self.tm.apply_new_config())
+
+        self.assertTrue(self.install.called)
+        self.assertTrue(self.restore.called)
+        self.assertFalse(self.reload_nginx.called)
+
+    def test_cancelled_full_apply_is_done_in_full_again(self):
+        self.tm.changes.take()
+        self.scan.side_effect = lambda: self.change(self.second)
+
+        self.tm.apply_new_config(full=True)
+
+        self.assertIn(Change(self.source, "full"), self.tm.changes.take()[1])
+
+    def test_newer_change_does_not_cancel_apply_after_max_latency(self):
+        self.tm.pending_since = time.monotonic() - self.tm.scheduler.max_latency
+        self.scan.side_effect = lambda: self.change(self.second)
+
+        self.assertTrue(self.tm.apply_new_config())
+
+        self.assertTrue(self.reload_nginx.called)
+        self.assertIsNone(self.tm.pending_since)
+
+    def test_writer_that_never_stops_cancels_applies_up_to_max_latency(self):
+        self.set_up_patch(
+            "nginx_config_reloader.directory_is_unmounted", return_value=False
+        )
+        scheduler = self.tm.scheduler
+        scheduler.quiet_period, scheduler.max_latency = 0, 0.1
+        scheduler.notify()
+        first_change = scheduler.first_change
+
+        def write():
+            self.change(self.second)
+            scheduler.notify()
+
+        self.scan.side_effect = write
+
+        nginx_config_reloader.after_loop(self.tm)
+
+        self.assertFalse(self.reload_nginx.called)
+        self.assertEqual(self.tm.pending_since, first_change)
+
+        time.sleep(0.1)
+        nginx_config_reloader.after_loop(self.tm)
+
+        self.assertTrue(self.reload_nginx.called)
+        self.assertIsNone(self.tm.pending_since)
+
+    def test_apply_without_newer_changes_completes(self):
+        self.assertTrue(self.tm.apply_new_config())
+
+        self.assertTrue(self.reload_nginx.called)
+        self.assertIsNone(self.tm.apply_generation)
+
+
 class Event:
     def __init__(self, name):
         self.name = name
         self.event_type = "modified"
         self.src_path = name
+        self.dest_path = ""
         self.is_directory = False
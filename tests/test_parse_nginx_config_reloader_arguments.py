@@ -65,6 +65,71 @@ class TestParseNginxConfigReloaderArguments(TestCase):
                 help="File name for error output",
                 default=nginx_config_reloader.ERROR_FILE,
             ),
+            call(
+                "--scan-workers",
+                type=int,
+                help="Number of workers to scan large config trees for forbidden directives",
+                default=nginx_config_reloader.SCAN_WORKERS,
+            ),
+            call(
+                "--skip-unreferenced-reloads",
+                action="store_true",
+                help="Only sync, but don't test and reload nginx, if none of the changed "
+                "files is loaded by nginx",
+                default=False,
+            ),
+            call(
+                "--keep-generations",
+                type=int,
+                help="Number of installed custom configs to keep to roll back to",
+                default=nginx_config_reloader.KEEP_GENERATIONS,
+            ),
+            call(
+                "--generation-store-max-bytes",
+                type=int,
+                help="Most bytes of file contents to keep of installed custom configs, "
+                "0 for no limit",
+                default=nginx_config_reloader.GENERATION_STORE_MAX_BYTES,
+            ),
+            call(
+                "--check-staged-config",
+                action="store_true",
+                help="Test a new custom config before installing it, instead of "
+                "restoring the old one if it fails",
+                default=False,
+            ),
+            call(
+                "--quiet-period",
+                type=float,
+                help="Seconds without changes to wait for before applying them",
+                default=nginx_config_reloader.RELOAD_QUIET_PERIOD,
+            ),
+            call(
+                "--max-latency",
+                type=float,
+                help="Most seconds to wait after the first change before applying it, "
+                "even if changes keep coming in",
+                default=nginx_config_reloader.RELOAD_MAX_LATENCY,
+            ),
+            call(
+                "--watcher",
+                choices=nginx_config_reloader.WATCHERS,
+                help="How to watch the dir for changes: with watchdog, or with the "
+                "built-in inotify backend that uses less memory and CPU per event",
+                default="watchdog",
+            ),
+            call(
+                "--list-generations",
+                action="store_true",
+                help="List the installed custom configs that can be rolled back to",
+                default=False,
+            ),
+            call(
+                "--rollback",
+                metavar="GENERATION",
+                help="Install a previously installed custom config and reload nginx",
+                default=None,
+            ),
         ]
         self.assertEqual(
             self.parser.return_value.add_argument.mock_calls, expected_calls
@@ -14,7 +14,7 @@ class TestReloadNginx(TestCase):
         self.check_call = self.set_up_patch(
             "nginx_config_reloader.subprocess.check_call"
         )
-        self.reloader = NginxConfigReloader(use_systemd=False)
+        self.reloader = NginxConfigReloader(use_systemd=False, scan_cache_file=None)
 
     def test_reload_nginx_uses_signal_process(self) -> None:
         self.reloader.reload_nginx()
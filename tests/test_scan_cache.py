@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+import time
+from tempfile import mkdtemp
+from unittest.mock import ANY
+
+from nginx_config_reloader import scanner
+from nginx_config_reloader.scanner import ScanCache, find_forbidden_config
+from nginx_config_reloader.settings import FORBIDDEN_CONFIG_DIRECTIVES
+from tests.testcase import TestCase
+
+
+class TestScanCache(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.cache_dir = mkdtemp()
+        self.cache_file = os.path.join(self.cache_dir, "scan_cache.json")
+        self.scan_file = self.set_up_patch(
+            "nginx_config_reloader.scanner.scan_file", side_effect=scanner.scan_file
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_unchanged_files_are_not_scanned_again(self):
+        self._write("a.conf", "location / {}\n")
+        self._write("b.conf", "location /b {}\n")
+        cache = ScanCache()
+
+        find_forbidden_config(self.dir, cache=cache)
+        find_forbidden_config(self.dir, cache=cache)
+
+        self.assertEqual(self.scan_file.call_count, 2)
+
+    def test_only_changed_file_is_scanned_again(self):
+        self._write("a.conf", "location / {}\n")
+        path = self._write("b.conf", "location /b {}\n")
+        cache = ScanCache()
+        find_forbidden_config(self.dir, cache=cache)
+        self.scan_file.reset_mock()
+
+        self._write("b.conf", "client_body_temp_path /tmp;\n")
+        violation = find_forbidden_config(self.dir, cache=cache)
+
+        self.scan_file.assert_called_once_with(path, ANY)
+        self.assertEqual(violation.message, FORBIDDEN_CONFIG_DIRECTIVES[0][2])
+
+    def test_file_rewritten_with_its_old_mtime_is_scanned_again(self):
+        path = self._write("a.conf", "location /abcdefghij {}\n")
+        st = os.stat(path)
+        cache = ScanCache()
+        find_forbidden_config(self.dir, cache=cache)
+        # File times have the resolution of the kernel clock tick
+        time.sleep(0.02)
+
+        self._write("a.conf", "include /tmp/evil.conf;\n")
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(os.stat(path).st_size, st.st_size)
+        violation = find_forbidden_config(self.dir, cache=cache)
+
+        self.assertEqual(self.scan_file.call_count, 2)
+        self.assertIsNotNone(violation)
+
+    def test_cached_violation_is_reported_without_rescanning(self):
+        self._write("a.conf", "init_by_lua 'x';\n")
+        cache = ScanCache()
+        first = find_forbidden_config(self.dir, cache=cache)
+
+        second = find_forbidden_config(self.dir, cache=cache)
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.scan_file.call_count, 1)
+
+    def test_cache_survives_restart(self):
+        self._write("a.conf", "location / {}\n")
+        cache = ScanCache(self.cache_file)
+        find_forbidden_config(self.dir, cache=cache)
+        cache.save()
+
+        find_forbidden_config(self.dir, cache=ScanCache(self.cache_file))
+
+        self.assertEqual(self.scan_file.call_count, 1)
+
+    def test_cache_is_discarded_when_rules_change(self):
+        self._write("a.conf", "location / {}\n")
+        cache = ScanCache(self.cache_file)
+        find_forbidden_config(self.dir, cache=cache)
+        cache.save()
+        self.set_up_patch(
+            "nginx_config_reloader.scanner.FORBIDDEN_CONFIG_RULES_DIGEST", "other"
+        )
+
+        self.assertEqual(len(ScanCache(self.cache_file).entries), 0)
+
+    def test_cache_is_not_written_if_nothing_changed(self):
+        ScanCache(self.cache_file).save()
+
+        self.assertFalse(os.path.exists(self.cache_file))
+
+    def test_save_ignores_unwritable_cache_location(self):
+        cache = ScanCache(os.path.join(self.cache_dir, "missing", "cache.json"))
+        cache.set("key", None)
+
+        cache.save()
+
+        self.assertTrue(cache.changed)
+
+    def test_cache_evicts_least_recently_used_entries(self):
+        cache = ScanCache(max_entries=2)
+        cache.set("a", None)
+        cache.set("b", None)
+        cache.get("a")
+
+        cache.set("c", None)
+
+        self.assertEqual(list(cache.entries), ["a", "c"])
+
+    def test_load_keeps_newest_entries_within_bound(self):
+        with open(self.cache_file, "w") as f:
+            json.dump(
+                {
+                    "rules": scanner.FORBIDDEN_CONFIG_RULES_DIGEST,
+                    "entries": [["a", None], ["b", None], ["c", None]],
+                },
+                f,
+            )
+
+        cache = ScanCache(self.cache_file, max_entries=2)
+
+        self.assertEqual(list(cache.entries), ["b", "c"])
+
+    def _write(self, name, contents):
+        path = os.path.join(self.dir, name)
+        with open(path, "w") as f:
+            f.write(contents)
+        return path
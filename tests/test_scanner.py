@@ -0,0 +1,245 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkdtemp
+from unittest.mock import ANY
+
+from nginx_config_reloader.scanner import (
+    FORBIDDEN_CONFIG_KEYWORDS,
+    ScanCache,
+    _count_lines,
+    _find_last_keyword,
+    _literal_prefixes,
+    find_forbidden_config,
+    find_forbidden_directive,
+    scan_file,
+)
+from nginx_config_reloader.tokenizer import iter_directives
+from tests.testcase import TestCase
+
+
+class TestKeywordPrefilter(TestCase):
+    def setUp(self):
+        self.iter_directives = self.set_up_patch(
+            "nginx_config_reloader.scanner.iter_directives",
+            side_effect=iter_directives,
+        )
+
+    def test_keywords_are_derived_from_rules(self):
+        self.assertEqual(
+            FORBIDDEN_CONFIG_KEYWORDS,
+            (
+                b"client_body_temp_path",
+                b"access_log",
+                b"error_log",
+                b"include",
+                b"load_module",
+                b"init_by_lua",
+            ),
+        )
+
+    def test_literal_prefixes_handle_groups_and_optional_characters(self):
+        self.assertEqual(_literal_prefixes("ab(c|d)|efg?"), [b"ab", b"ef"])
+
+    def test_literal_prefixes_reject_rules_without_literal(self):
+        with self.assertRaises(ValueError):
+            _literal_prefixes(".*_log")
+
+    def test_file_without_keywords_is_not_tokenized(self):
+        data = b"location / {\n    proxy_pass http://backend;\n}\n" * 100
+
+        self.assertIsNone(find_forbidden_directive(data, "a.conf"))
+        self.assertFalse(self.iter_directives.called)
+
+    def test_tokenizing_stops_after_last_keyword(self):
+        consumed = []
+
+        def tracking_iter_directives(data, path, deadline):
+            for directive in iter_directives(data, path, deadline):
+                consumed.append(directive)
+                yield directive
+
+        self.iter_directives.side_effect = tracking_iter_directives
+        data = b"include fastcgi_params;\n" + b"listen 80;\n" * 100
+
+        self.assertIsNone(find_forbidden_directive(data, "a.conf"))
+        self.assertEqual(len(consumed), 2)
+
+    def test_keyword_in_argument_still_checks_directive(self):
+        violation = find_forbidden_directive(
+            b'add_header X "include";\ninclude /etc/passwd;\n', "a.conf"
+        )
+
+        self.assertEqual(violation.line, 2)
+
+    def test_keyword_list_is_used_for_prefilter(self):
+        self.set_up_patch(
+            "nginx_config_reloader.scanner.FORBIDDEN_CONFIG_KEYWORDS", (b"other",)
+        )
+
+        self.assertIsNone(find_forbidden_directive(b"include /etc/passwd;", "a"))
+        self.assertFalse(self.iter_directives.called)
+
+
+class TestParallelScan(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.set_up_patch("nginx_config_reloader.scanner.PARALLEL_SCAN_MIN_FILES", 4)
+        for index in range(10):
+            self._write(f"server.{index:02}", "location / {}\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_small_tree_is_scanned_without_pool(self):
+        thread_pool = self.set_up_patch(
+            "nginx_config_reloader.scanner.ThreadPoolExecutor"
+        )
+        self.set_up_patch("nginx_config_reloader.scanner.PARALLEL_SCAN_MIN_FILES", 11)
+
+        self.assertIsNone(find_forbidden_config(self.dir, workers=4))
+        self.assertFalse(thread_pool.called)
+
+    def test_single_worker_does_not_use_pool(self):
+        thread_pool = self.set_up_patch(
+            "nginx_config_reloader.scanner.ThreadPoolExecutor"
+        )
+
+        self.assertIsNone(find_forbidden_config(self.dir, workers=1))
+        self.assertFalse(thread_pool.called)
+
+    def test_small_files_are_scanned_in_threads(self):
+        thread_pool = self.set_up_patch(
+            "nginx_config_reloader.scanner.ThreadPoolExecutor",
+            side_effect=ThreadPoolExecutor,
+        )
+        process_pool = self.set_up_patch(
+            "nginx_config_reloader.scanner.ProcessPoolExecutor"
+        )
+
+        self.assertIsNone(find_forbidden_config(self.dir, workers=3))
+        thread_pool.assert_called_once_with(max_workers=3)
+        self.assertFalse(process_pool.called)
+
+    def test_large_files_are_scanned_in_processes(self):
+        self.set_up_patch(
+            "nginx_config_reloader.scanner.PARALLEL_SCAN_PROCESS_MIN_BYTES", 10
+        )
+        self._write("server.05", "init_by_lua 'x';\n")
+
+        violation = find_forbidden_config(self.dir, workers=2)
+
+        self.assertEqual(violation.path, os.path.join(self.dir, "server.05"))
+
+    def test_first_violation_in_walk_order_is_reported(self):
+        self._write("server.07", "init_by_lua 'x';\n")
+        self._write("server.03", "listen 80;\ninclude /etc/passwd;\n")
+
+        for _ in range(5):
+            violation = find_forbidden_config(self.dir, workers=4)
+
+            self.assertEqual(violation.path, os.path.join(self.dir, "server.03"))
+            self.assertEqual(violation.line, 2)
+
+    def test_only_reachable_files_are_scanned(self):
+        self._write("server.03", "include /etc/passwd;\n")
+
+        self.assertIsNone(
+            find_forbidden_config(
+                self.dir, reachable={os.path.join(self.dir, "server.04")}, workers=4
+            )
+        )
+
+    def test_reachable_file_walked_by_another_path_is_scanned(self):
+        os.mkdir(os.path.join(self.dir, "a"))
+        os.symlink(os.path.join(self.dir, "a"), os.path.join(self.dir, "b"))
+        self._write("a/evil.conf", "load_module /tmp/evil.so;\n")
+        st = os.stat(os.path.join(self.dir, "a", "evil.conf"))
+
+        violation = find_forbidden_config(
+            self.dir,
+            reachable={os.path.join(self.dir, "b", "evil.conf")},
+            reachable_inodes={(st.st_dev, st.st_ino)},
+        )
+
+        self.assertEqual(violation.path, os.path.join(self.dir, "a", "evil.conf"))
+
+    def test_only_cache_misses_are_scanned_in_pool(self):
+        cache = ScanCache()
+        find_forbidden_config(self.dir, cache=cache)
+        self._write("server.04", "client_body_temp_path /tmp;\n")
+        scan_in_pool = self.set_up_patch(
+            "nginx_config_reloader.scanner._scan_in_pool", return_value=None
+        )
+
+        violation = find_forbidden_config(self.dir, cache=cache, workers=4)
+
+        self.assertEqual(
+            [path for path, _ in scan_in_pool.call_args.args[0]],
+            [os.path.join(self.dir, "server.04")],
+        )
+        self.assertEqual(violation.path, os.path.join(self.dir, "server.04"))
+
+    def _write(self, name, contents):
+        with open(os.path.join(self.dir, name), "w") as f:
+            f.write(contents)
+
+
+class TestMappedScan(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.set_up_patch("nginx_config_reloader.scanner.SCAN_WINDOW_SIZE", 64)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_keyword_on_window_boundary_is_found(self):
+        for offset in range(40, 70):
+            data = b"#" * offset + b"load_module /tmp/x.so;\n" + b"#" * 100
+
+            self.assertEqual(_find_last_keyword(data), offset, offset)
+
+    def test_last_keyword_is_found_in_the_last_window(self):
+        data = b"include a;\n" + b"#" * 200 + b"include b;\n" + b"#" * 200
+
+        self.assertEqual(_find_last_keyword(data), 211)
+
+    def test_missing_keyword(self):
+        self.assertEqual(_find_last_keyword(b"listen 80;\n" * 100), -1)
+        self.assertEqual(_find_last_keyword(b""), -1)
+
+    def test_lines_are_counted_across_windows(self):
+        data = b"listen 80;\n" * 100
+
+        self.assertEqual(_count_lines(data, len(data)), 101)
+        self.assertEqual(_count_lines(data, 11 * 42 + 3), 43)
+
+    def test_large_file_is_scanned(self):
+        path = self._write(
+            "redirects.map",
+            b"map $uri $new {\n"
+            + b"".join(b"  /old/%d /new/%d;\n" % (i, i) for i in range(1000))
+            + b"}\ninclude /etc/passwd;\n",
+        )
+
+        violation = scan_file(path)
+
+        self.assertEqual(violation.line, 1003)
+        self.assertEqual(violation.text, "include /etc/passwd;")
+
+    def test_empty_file_is_allowed(self):
+        self.assertIsNone(scan_file(self._write("empty.conf", b"")))
+
+    def test_pages_are_released_after_scanning(self):
+        fadvise = self.set_up_patch("nginx_config_reloader.scanner.os.posix_fadvise")
+        path = self._write("a.conf", b"include /etc/passwd;\n")
+
+        scan_file(path)
+
+        fadvise.assert_called_once_with(ANY, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(contents)
+        return path
@@ -0,0 +1,142 @@
+import threading
+import time
+
+from nginx_config_reloader.scheduler import ReloadScheduler
+from tests.testcase import TestCase
+
+
+class TestReloadScheduler(TestCase):
+    def setUp(self):
+        self.monotonic = self.set_up_patch(
+            "nginx_config_reloader.scheduler.time.monotonic", return_value=100.0
+        )
+        self.scheduler = ReloadScheduler(
+            quiet_period=0.1, max_latency=2, write_timeout=10
+        )
+
+    def test_reload_without_changes_is_due(self):
+        self.assertIsNone(self.scheduler.delay())
+        self.assertTrue(self.scheduler.due())
+
+    def test_change_is_due_after_quiet_period(self):
+        self.scheduler.notify()
+
+        self.assertFalse(self.scheduler.due())
+        self.monotonic.return_value = 100.1
+        self.assertTrue(self.scheduler.due())
+
+    def test_every_change_restarts_quiet_period(self):
+        self.scheduler.notify()
+        self.monotonic.return_value = 100.05
+        self.scheduler.notify()
+
+        self.monotonic.return_value = 100.1
+        self.assertFalse(self.scheduler.due())
+        self.monotonic.return_value = 100.15
+        self.assertTrue(self.scheduler.due())
+
+    def test_continuous_changes_are_due_after_max_latency(self):
+        for step in range(50):
+            self.monotonic.return_value = 100 + step * 0.05
+            self.scheduler.notify()
+
+        self.assertTrue(self.scheduler.due())
+
+    def test_reset_forgets_pending_changes(self):
+        self.scheduler.notify()
+
+        self.scheduler.reset()
+
+        self.assertIsNone(self.scheduler.delay())
+
+    def test_reload_is_postponed_while_a_file_is_written(self):
+        self.scheduler.hold("/etc/nginx/app/server.conf")
+
+        self.monotonic.return_value = 105.0
+        self.assertFalse(self.scheduler.due())
+
+        self.scheduler.release("/etc/nginx/app/server.conf")
+        self.assertTrue(self.scheduler.due())
+
+    def test_file_that_is_written_is_applied_after_write_timeout(self):
+        self.scheduler.hold("/etc/nginx/app/server.conf")
+        self.monotonic.return_value = 109.0
+        self.scheduler.hold("/etc/nginx/app/server.conf")
+
+        self.assertFalse(self.scheduler.due())
+        self.monotonic.return_value = 110.0
+        self.assertTrue(self.scheduler.due())
+
+    def test_hold_starts_pending_changes_once(self):
+        self.scheduler.hold("/etc/nginx/app/server.conf")
+        self.monotonic.return_value = 101.0
+        self.scheduler.hold("/etc/nginx/app/server.conf")
+
+        self.assertEqual(self.scheduler.first_change, 100.0)
+        self.assertEqual(self.scheduler.last_change, 100.0)
+
+    def test_reset_keeps_files_that_are_still_written(self):
+        self.scheduler.hold("/etc/nginx/app/a.conf")
+        self.monotonic.return_value = 105.0
+        self.scheduler.hold("/etc/nginx/app/b.conf")
+        self.monotonic.return_value = 111.0
+
+        self.scheduler.reset()
+
+        self.assertEqual(self.scheduler.writing, {"/etc/nginx/app/b.conf": 105.0})
+
+    def test_changes_that_are_not_pending_anymore_are_forgotten(self):
+        pending = [True]
+        scheduler = ReloadScheduler(quiet_period=0.1, pending=lambda: pending[0])
+        scheduler.notify()
+        self.assertFalse(scheduler.due())
+
+        pending[0] = False
+
+        self.assertIsNone(scheduler.delay())
+        self.assertIsNone(scheduler.first_change)
+
+    def test_wait_returns_after_timeout_without_changes(self):
+        self.monotonic.side_effect = [100.0, 100.0, 100.5]
+
+        self.scheduler.wait(0.5)
+
+
+class TestReloadSchedulerWait(TestCase):
+    def test_wait_returns_when_change_is_due(self):
+        scheduler = ReloadScheduler(quiet_period=0.05, max_latency=1)
+        threading.Timer(0.01, scheduler.notify).start()
+        start = time.monotonic()
+
+        scheduler.wait(5)
+
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertTrue(scheduler.due())
+
+    def test_wait_without_timeout_returns_when_change_is_due(self):
+        scheduler = ReloadScheduler(quiet_period=0.05, max_latency=1)
+        threading.Timer(0.01, scheduler.notify).start()
+
+        scheduler.wait()
+
+        self.assertTrue(scheduler.due())
+
+    def test_wait_returns_when_written_file_is_closed(self):
+        scheduler = ReloadScheduler(quiet_period=0.05, max_latency=1)
+        scheduler.hold("/etc/nginx/app/server.conf")
+        threading.Timer(0.2, scheduler.release, ["/etc/nginx/app/server.conf"]).start()
+        start = time.monotonic()
+
+        scheduler.wait(5)
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_wait_blocks_while_nothing_is_pending(self):
+        scheduler = ReloadScheduler(quiet_period=0, pending=lambda: False)
+        scheduler.notify()
+        start = time.monotonic()
+
+        scheduler.wait(0.2)
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
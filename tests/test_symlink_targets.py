@@ -3,7 +3,15 @@ import shutil
 from tempfile import mkdtemp
 from unittest.mock import Mock
 
+from watchdog.events import (
+    DirCreatedEvent,
+    DirDeletedEvent,
+    FileModifiedEvent,
+    FileMovedEvent,
+)
+
 import nginx_config_reloader
+from nginx_config_reloader.journal import Change
 from tests.testcase import TestCase
 
 
@@ -12,127 +20,199 @@ class TestSymlinkTargets(TestCase):
         self.watch_dir = mkdtemp()
         self.target_a = mkdtemp()
         self.target_b = mkdtemp()
+        self.walk = self.set_up_patch(
+            "nginx_config_reloader.symlinks.os.walk", wraps=os.walk
+        )
 
     def tearDown(self):
         for d in (self.watch_dir, self.target_a, self.target_b):
             shutil.rmtree(d, ignore_errors=True)
 
     def _handler(self):
-        return nginx_config_reloader.NginxConfigReloader(dir_to_watch=self.watch_dir)
+        handler = nginx_config_reloader.NginxConfigReloader(
+            dir_to_watch=self.watch_dir, quiet_period=0, scan_cache_file=None
+        )
+        handler.symlink_index.build()
+        self.walk.reset_mock()
+        return handler
 
     def _symlink(self, name, target):
         path = os.path.join(self.watch_dir, name)
         os.symlink(target, path)
         return path
 
-    def test_plain_directories_are_not_recorded(self):
-        os.mkdir(os.path.join(self.watch_dir, "plain"))
-
-        targets = self._handler().get_symlink_targets()
+    def _repoint(self, link, target):
+        os.symlink(target, link + ".tmp")
+        os.replace(link + ".tmp", link)
+        return FileMovedEvent(link + ".tmp", link)
 
-        self.assertEqual(targets, {})
-
-    def test_symlinked_directory_is_recorded_with_target_identity(self):
+    def test_repointed_symlink_is_recorded_and_rearms_observer(self):
         link = self._symlink("example.com", self.target_a)
-        st = os.stat(self.target_a)
+        handler = self._handler()
 
-        targets = self._handler().get_symlink_targets()
+        handler.on_any_event(self._repoint(link, self.target_b))
 
-        self.assertEqual(
-            targets,
-            {
-                link: (
-                    os.path.realpath(self.target_a),
-                    st.st_dev,
-                    st.st_ino,
-                    st.st_ctime_ns,
-                )
-            },
-        )
+        self.assertEqual(handler.changes.take()[1], {Change(link, "symlink_changed")})
+        self.assertEqual(handler.rearm_links, {link})
+        self.assertTrue(handler.target_watches_stale)
 
-    def test_breaking_a_symlink_is_detected_as_a_change(self):
-        target = os.path.join(self.target_a, "release")
-        os.mkdir(target)
-        self._symlink("example.com", target)
+    def test_repointed_symlink_to_file_does_not_rearm_observer(self):
+        for target_dir in (self.target_a, self.target_b):
+            open(os.path.join(target_dir, "server.conf"), "w").close()
+        link = self._symlink("server.conf", os.path.join(self.target_a, "server.conf"))
         handler = self._handler()
-        handler.watched_symlink_targets = handler.get_symlink_targets()
 
-        shutil.rmtree(target)
+        handler.on_any_event(
+            self._repoint(link, os.path.join(self.target_b, "server.conf"))
+        )
 
-        self.assertEqual(handler.get_symlink_targets(), {})
-        self.assertTrue(handler.symlink_targets_changed())
+        self.assertTrue(handler.dirty)
+        self.assertEqual(handler.rearm_links, set())
+        self.assertTrue(handler.target_watches_stale)
 
-    def test_nested_symlink_below_followed_symlink_is_recorded(self):
-        self._symlink("example.com", self.target_a)
-        os.symlink(self.target_b, os.path.join(self.target_a, "inner"))
+    def test_new_symlink_below_created_dir_is_recorded(self):
+        handler = self._handler()
+        subdir = os.path.join(self.watch_dir, "sites")
+        os.mkdir(subdir)
+        link = os.path.join(subdir, "example.com")
+        os.symlink(self.target_a, link)
 
-        targets = self._handler().get_symlink_targets()
+        handler.on_any_event(DirCreatedEvent(subdir))
 
-        self.assertIn(os.path.join(self.watch_dir, "example.com"), targets)
-        self.assertIn(os.path.join(self.watch_dir, "example.com", "inner"), targets)
+        self.assertEqual(handler.changes.take()[1], {Change(link, "symlink_changed")})
+        self.assertEqual(handler.rearm_links, {link})
 
-    def test_changed_is_false_when_targets_are_stable(self):
-        self._symlink("example.com", self.target_a)
+    def test_replaced_target_outside_watched_dir_is_recorded(self):
+        target = os.path.join(self.target_a, "release")
+        os.mkdir(target)
+        link = self._symlink("example.com", target)
         handler = self._handler()
-        handler.watched_symlink_targets = handler.get_symlink_targets()
 
-        self.assertFalse(handler.symlink_targets_changed())
+        shutil.rmtree(target)
+        handler.symlink_target_handler.on_any_event(DirDeletedEvent(target))
+        os.mkdir(target)
+        handler.symlink_target_handler.on_any_event(DirCreatedEvent(target))
+
+        self.assertEqual(handler.changes.take()[1], {Change(link, "symlink_changed")})
+        self.assertEqual(handler.rearm_links, {link})
 
-    def test_changed_is_true_when_symlink_is_repointed(self):
-        link = self._symlink("example.com", self.target_a)
+    def test_changed_target_file_is_recorded(self):
+        target = os.path.join(self.target_a, "server.conf")
+        open(target, "w").close()
+        link = self._symlink("server.conf", target)
         handler = self._handler()
-        handler.watched_symlink_targets = handler.get_symlink_targets()
 
-        os.unlink(link)
-        os.symlink(self.target_b, link)
+        with open(target, "w") as f:
+            f.write("rewrite ^/a /b;\n")
+        os.chmod(target, 0o600)
+        handler.symlink_target_handler.on_any_event(
+            FileModifiedEvent(os.path.realpath(target))
+        )
 
-        self.assertTrue(handler.symlink_targets_changed())
+        self.assertEqual(handler.changes.take()[1], {Change(link, "symlink_changed")})
+        self.assertEqual(handler.rearm_links, set())
 
-    def test_changed_is_true_when_target_inode_is_replaced(self):
-        target = os.path.join(self.target_a, "release")
-        os.mkdir(target)
-        self._symlink("example.com", target)
+    def test_events_of_symlinked_dir_are_handled_below_the_symlink(self):
+        link = self._symlink("example.com", self.target_a)
         handler = self._handler()
-        handler.watched_symlink_targets = handler.get_symlink_targets()
+        dir_handler = nginx_config_reloader.SymlinkedDirHandler(
+            handler, link, os.path.realpath(self.target_a)
+        )
 
-        shutil.rmtree(target)
-        os.mkdir(target)
+        dir_handler.dispatch(
+            FileModifiedEvent(os.path.join(os.path.realpath(self.target_a), "a.conf"))
+        )
 
-        self.assertTrue(handler.symlink_targets_changed())
+        self.assertEqual(
+            handler.changes.take()[1],
+            {Change(os.path.join(link, "a.conf"), "modified")},
+        )
 
-    def test_changed_is_true_when_target_metadata_changes(self):
-        self._symlink("example.com", self.target_a)
+    def test_file_changes_do_not_walk_the_tree(self):
+        link = self._symlink("example.com", self.target_a)
         handler = self._handler()
-        handler.watched_symlink_targets = handler.get_symlink_targets()
 
-        os.chmod(self.target_a, 0o700)
+        handler.on_any_event(FileModifiedEvent(os.path.join(link, "server.conf")))
 
-        self.assertTrue(handler.symlink_targets_changed())
+        self.walk.assert_not_called()
+        self.assertFalse(handler.dirty)
+        self.assertEqual(handler.rearm_links, set())
 
-    def test_changed_is_true_when_a_new_symlink_appears(self):
+    def test_target_watches_follow_the_target_parents(self):
         handler = self._handler()
-        handler.watched_symlink_targets = handler.get_symlink_targets()
+        handler.observer = Mock()
+        handler.target_watches = {"/srv/old": "old watch"}
 
-        self._symlink("example.com", self.target_a)
+        link = self._symlink("example.com", self.target_a)
+        handler.on_any_event(DirCreatedEvent(link))
+        handler.sync_target_watches()
 
-        self.assertTrue(handler.symlink_targets_changed())
+        parent = os.path.dirname(os.path.realpath(self.target_a))
+        handler.observer.unschedule.assert_called_once_with("old watch")
+        handler.observer.schedule.assert_called_once_with(
+            handler.symlink_target_handler, parent, recursive=False
+        )
+        self.assertEqual(
+            handler.target_watches, {parent: handler.observer.schedule.return_value}
+        )
 
-    def test_after_loop_restarts_and_reloads_when_symlink_is_repointed(self):
+    def test_after_loop_rearms_and_reloads_when_symlink_is_repointed(self):
         link = self._symlink("example.com", self.target_a)
         handler = self._handler()
-        handler.watched_symlink_targets = handler.get_symlink_targets()
-        self.assertFalse(handler.symlink_targets_changed())
-
-        os.unlink(link)
-        os.symlink(self.target_b, link)
         self.assertFalse(handler.dirty)
 
-        self.assertTrue(handler.symlink_targets_changed())
+        handler.on_any_event(self._repoint(link, self.target_b))
 
-        handler.restart_observer = Mock()
+        handler.rearm_watches = Mock()
         handler.reload = Mock()
         nginx_config_reloader.after_loop(handler)
 
-        handler.restart_observer.assert_called_once_with()
+        handler.rearm_watches.assert_called_once_with({link})
         handler.reload.assert_called_once_with()
         self.assertFalse(handler.dirty)
+
+    def test_only_watches_below_repointed_symlink_are_replaced(self):
+        link = self._symlink("a", self.target_a)
+        self._symlink("b", self.target_b)
+        target_c = mkdtemp()
+        self.addCleanup(shutil.rmtree, target_c, ignore_errors=True)
+        observer = self.set_up_patch("nginx_config_reloader.Observer").return_value
+        handler = self._handler()
+        handler.start_observer()
+        watches = dict(handler.link_watches)
+        observer.reset_mock()
+
+        handler.on_any_event(self._repoint(link, target_c))
+        handler.rearm_watches(handler.rearm_links)
+
+        observer.stop.assert_not_called()
+        observer.unschedule.assert_called_once_with(watches[link])
+        scheduled = [c.args[1] for c in observer.schedule.call_args_list]
+        self.assertEqual(scheduled, [os.path.realpath(target_c)])
+        self.assertEqual(
+            handler.link_watches[os.path.join(self.watch_dir, "b")],
+            watches[os.path.join(self.watch_dir, "b")],
+        )
+
+    def test_every_symlinked_dir_is_watched_once(self):
+        self._symlink("a", self.target_a)
+        self._symlink("b", self.target_a)
+        os.symlink(self.watch_dir, os.path.join(self.target_a, "loop"))
+        observer = self.set_up_patch("nginx_config_reloader.Observer").return_value
+        handler = self._handler()
+
+        handler.start_observer()
+
+        scheduled = [c.args[1] for c in observer.schedule.call_args_list]
+        self.assertEqual(
+            scheduled,
+            [
+                self.watch_dir,
+                os.path.realpath(self.target_a),
+                os.path.dirname(os.path.realpath(self.target_a)),
+            ],
+        )
+        self.assertEqual(
+            list(handler.link_watches), [os.path.join(self.watch_dir, "a")]
+        )
+        self.assertEqual(handler.watch_count(), 3)
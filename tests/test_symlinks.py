@@ -0,0 +1,254 @@
+import os
+import shutil
+from tempfile import mkdtemp
+
+from nginx_config_reloader.symlinks import SymlinkIndex, read_symlink_target
+from tests.testcase import TestCase
+
+
+class TestSymlinkIndex(TestCase):
+    def setUp(self):
+        self.watch_dir = mkdtemp()
+        self.target_a = mkdtemp()
+        self.target_b = mkdtemp()
+        self.index = SymlinkIndex(self.watch_dir)
+
+    def tearDown(self):
+        for d in (self.watch_dir, self.target_a, self.target_b):
+            shutil.rmtree(d, ignore_errors=True)
+
+    def _symlink(self, name, target):
+        path = os.path.join(self.watch_dir, name)
+        os.symlink(target, path)
+        return path
+
+    def test_plain_directories_are_not_indexed(self):
+        os.mkdir(os.path.join(self.watch_dir, "plain"))
+
+        self.index.build()
+
+        self.assertEqual(self.index.links, {})
+
+    def test_symlink_is_indexed_with_target_identity(self):
+        link = self._symlink("example.com", self.target_a)
+        st = os.stat(self.target_a)
+
+        self.index.build()
+
+        self.assertEqual(
+            self.index.links,
+            {
+                link: (
+                    os.path.realpath(self.target_a),
+                    st.st_dev,
+                    st.st_ino,
+                    None,
+                )
+            },
+        )
+
+    def test_symlinks_to_files_and_dangling_symlinks_are_indexed(self):
+        target = os.path.join(self.target_a, "server.conf")
+        open(target, "w").close()
+        file_link = self._symlink("server.conf", target)
+        dangling = self._symlink("gone.conf", os.path.join(self.target_a, "gone"))
+
+        self.index.build()
+
+        self.assertEqual(self.index.links[file_link], read_symlink_target(file_link))
+        self.assertEqual(self.index.links[dangling][1:], (None, None, None))
+
+    def test_nested_symlink_below_followed_symlink_is_indexed(self):
+        self._symlink("example.com", self.target_a)
+        os.symlink(self.target_b, os.path.join(self.target_a, "inner"))
+
+        self.index.build()
+
+        self.assertIn(os.path.join(self.watch_dir, "example.com"), self.index.links)
+        self.assertIn(
+            os.path.join(self.watch_dir, "example.com", "inner"), self.index.links
+        )
+
+    def test_update_returns_nothing_when_symlinks_are_stable(self):
+        link = self._symlink("example.com", self.target_a)
+        self.index.build()
+
+        self.assertEqual(self.index.update(link, recursive=False), {})
+        self.assertEqual(self.index.update(self.watch_dir, recursive=True), {})
+
+    def test_update_returns_repointed_symlink(self):
+        link = self._symlink("example.com", self.target_a)
+        self.index.build()
+
+        os.unlink(link)
+        os.symlink(self.target_b, link)
+
+        self.assertEqual(self.index.update(link, recursive=True), {link: True})
+        self.assertEqual(self.index.links[link][0], os.path.realpath(self.target_b))
+
+    def test_update_returns_new_symlinks_below_created_dir(self):
+        self.index.build()
+        subdir = os.path.join(self.watch_dir, "sites")
+        os.mkdir(subdir)
+        link = os.path.join(subdir, "example.com")
+        os.symlink(self.target_a, link)
+
+        self.assertEqual(self.index.update(subdir, recursive=True), {link: True})
+
+    def test_update_returns_removed_symlink(self):
+        target = os.path.join(self.target_a, "server.conf")
+        open(target, "w").close()
+        link = self._symlink("server.conf", target)
+        self.index.build()
+
+        os.unlink(link)
+
+        self.assertEqual(self.index.update(link, recursive=True), {link: False})
+        self.assertEqual(self.index.links, {})
+
+    def test_update_of_modified_path_does_not_walk(self):
+        link = self._symlink("example.com", self.target_a)
+        self.index.build()
+        walk = self.set_up_patch("nginx_config_reloader.symlinks.os.walk")
+
+        self.index.update(os.path.join(link, "server.conf"), recursive=False)
+
+        walk.assert_not_called()
+
+    def test_refresh_targets_returns_symlinks_of_replaced_target(self):
+        target = os.path.join(self.target_a, "release")
+        os.mkdir(target)
+        link = self._symlink("example.com", target)
+        self.index.build()
+
+        shutil.rmtree(target)
+        os.mkdir(target)
+
+        self.assertEqual(
+            self.index.refresh_targets(target, replaced=True), {link: True}
+        )
+        self.assertEqual(self.index.refresh_targets(target), {})
+
+    def test_refresh_targets_returns_symlinks_of_changed_target_file(self):
+        target = os.path.join(self.target_a, "server.conf")
+        open(target, "w").close()
+        link = self._symlink("server.conf", target)
+        self.index.build()
+
+        os.chmod(target, 0o600)
+
+        self.assertEqual(
+            self.index.refresh_targets(os.path.realpath(target)), {link: False}
+        )
+
+    def test_refresh_targets_ignores_new_files_in_target_dir(self):
+        link = self._symlink("example.com", self.target_a)
+        self.index.build()
+
+        open(os.path.join(self.target_a, "server.conf"), "w").close()
+
+        self.assertEqual(
+            self.index.refresh_targets(os.path.realpath(self.target_a)), {}
+        )
+        self.assertEqual(self.index.update(link, recursive=False), {})
+
+    def test_refresh_targets_ignores_other_paths(self):
+        target = os.path.join(self.target_a, "server.conf")
+        open(target, "w").close()
+        self._symlink("server.conf", target)
+        self.index.build()
+
+        os.chmod(target, 0o600)
+
+        self.assertEqual(self.index.refresh_targets(self.target_b), {})
+
+    def test_target_parents_are_the_dirs_outside_the_watched_dir(self):
+        self._symlink("example.com", self.target_a)
+        os.mkdir(os.path.join(self.watch_dir, "real"))
+        self._symlink("alias", os.path.join(self.watch_dir, "real"))
+        self.index.build()
+
+        self.assertEqual(
+            self.index.target_parents(),
+            {os.path.dirname(os.path.realpath(self.target_a))},
+        )
+
+    def test_directory_linked_to_twice_is_walked_and_watched_once(self):
+        first = self._symlink("a", self.target_a)
+        self._symlink("b", self.target_a)
+        os.mkdir(os.path.join(self.target_a, "sub"))
+        scandir = self.set_up_patch(
+            "nginx_config_reloader.symlinks.os.scandir", wraps=os.scandir
+        )
+
+        self.index.build()
+
+        self.assertEqual(scandir.call_count, 3)
+        self.assertEqual(self.index.watched_dirs, 3)
+        self.assertEqual(self.index.watch_roots, [first])
+
+    def test_symlink_loop_is_walked_once(self):
+        os.mkdir(os.path.join(self.watch_dir, "sub"))
+        loop = os.path.join(self.watch_dir, "sub", "loop")
+        os.symlink(self.watch_dir, loop)
+        os.symlink(self.target_a, os.path.join(self.target_a, "self"))
+        self._symlink("example.com", self.target_a)
+
+        self.index.build()
+
+        self.assertIn(loop, self.index.links)
+        self.assertEqual(self.index.watched_dirs, 3)
+        self.assertEqual(
+            self.index.watch_roots, [os.path.join(self.watch_dir, "example.com")]
+        )
+
+    def test_symlink_into_symlinked_dir_is_not_watched_again(self):
+        sub = os.path.join(self.target_a, "sub")
+        os.mkdir(sub)
+        self._symlink("a", sub)
+        self._symlink("b", self.target_a)
+
+        self.index.build()
+
+        self.assertEqual(self.index.watch_roots, [os.path.join(self.watch_dir, "b")])
+
+    def test_rearm_walks_only_below_the_changed_symlink(self):
+        link = self._symlink("a", self.target_a)
+        other = self._symlink("b", self.target_b)
+        self.index.build()
+        target_c = mkdtemp()
+        self.addCleanup(shutil.rmtree, target_c, ignore_errors=True)
+        os.unlink(link)
+        os.symlink(target_c, link)
+        scandir = self.set_up_patch(
+            "nginx_config_reloader.symlinks.os.scandir", wraps=os.scandir
+        )
+
+        self.assertEqual(self.index.rearm([link]), ([link], [link]))
+
+        scandir.assert_called_once_with(link)
+        self.assertCountEqual(self.index.watch_roots, [link, other])
+        self.assertEqual(self.index.watched_dirs, 3)
+
+    def test_rearm_watches_other_symlink_to_the_old_target(self):
+        first = self._symlink("a", self.target_a)
+        second = self._symlink("b", self.target_a)
+        self.index.build()
+        os.unlink(first)
+        os.symlink(self.target_b, first)
+        self.index.update(first, recursive=True)
+
+        removed, added = self.index.rearm([first])
+
+        self.assertEqual(removed, [first])
+        self.assertCountEqual(added, [first, second])
+        self.assertCountEqual(self.index.watch_roots, [first, second])
+
+    def test_rearm_stops_watching_removed_symlink(self):
+        link = self._symlink("a", self.target_a)
+        self.index.build()
+        os.unlink(link)
+        self.index.update(link, recursive=True)
+
+        self.assertEqual(self.index.rearm([link]), ([link], []))
+        self.assertEqual(self.index.watched_dirs, 1)
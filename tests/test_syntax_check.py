@@ -0,0 +1,65 @@
+import os
+import shutil
+from tempfile import mkdtemp
+
+from nginx_config_reloader.syntax_check import find_syntax_errors
+from nginx_config_reloader.tokenizer import DeadlineExceeded
+from tests.testcase import TestCase
+
+
+class TestFindSyntaxErrors(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_valid_files_have_no_errors(self):
+        path = self._write(
+            "server.conf",
+            'location / {\n    return 200 "a;b";\n}\n'
+            "content_by_lua_block { ngx.say('}') }\n",
+        )
+
+        self.assertEqual(find_syntax_errors([path]), [])
+
+    def test_first_error_of_each_file_is_returned(self):
+        a = self._write("a.conf", "location / {\n    return 200;\n")
+        b = self._write("b.conf", "rewrite ^/a /b\n}\n}\n")
+        c = self._write("c.conf", "listen 80;\n")
+
+        errors = find_syntax_errors([a, b, c])
+
+        self.assertEqual(
+            [(e.file, e.line, e.message) for e in errors],
+            [
+                (a, 2, 'unexpected end of file, expecting "}"'),
+                (b, 2, 'unexpected "}"'),
+            ],
+        )
+
+    def test_unterminated_quote_is_an_error(self):
+        path = self._write("a.conf", 'return 200 "a;\n')
+
+        (error,) = find_syntax_errors([path])
+
+        self.assertEqual(error.message, 'unexpected end of file, expecting ";" or "}"')
+
+    def test_missing_files_are_skipped(self):
+        self.assertEqual(find_syntax_errors([os.path.join(self.dir, "x")]), [])
+
+    def test_files_after_deadline_are_left_to_nginx(self):
+        a = self._write("a.conf", "listen 80;\n")
+        b = self._write("b.conf", "}\n")
+        self.set_up_patch(
+            "nginx_config_reloader.syntax_check.check_syntax",
+            side_effect=DeadlineExceeded(a, 1),
+        )
+
+        self.assertEqual(find_syntax_errors([a, b]), [])
+
+    def _write(self, name, contents):
+        path = os.path.join(self.dir, name)
+        with open(path, "w") as f:
+            f.write(contents)
+        return path
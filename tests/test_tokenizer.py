@@ -0,0 +1,200 @@
+import time
+
+from nginx_config_reloader.tokenizer import (
+    MAX_TOKEN_LENGTH,
+    ConfigSyntaxError,
+    DeadlineExceeded,
+    Directive,
+    iter_directives,
+    tokenize,
+)
+from tests.testcase import TestCase
+
+
+class TestTokenizer(TestCase):
+    def test_directives_are_yielded_with_arguments_file_line_and_offsets(self):
+        data = b"server {\n    listen 80;\n    root /data/web/public;\n}\n"
+
+        directives = list(iter_directives(data, "server.conf"))
+
+        self.assertEqual(
+            directives,
+            [
+                Directive("server", (), "server.conf", 1, 0, 6),
+                Directive("listen", ("80",), "server.conf", 2, 13, 22),
+                Directive("root", ("/data/web/public",), "server.conf", 3, 28, 49),
+            ],
+        )
+
+    def test_directive_split_over_lines_is_one_directive(self):
+        data = b"access_log\n    /var/log/nginx/access.log\n    main;\n"
+
+        directives = list(iter_directives(data))
+
+        self.assertEqual(
+            directives,
+            [
+                Directive(
+                    "access_log",
+                    ("/var/log/nginx/access.log", "main"),
+                    "<string>",
+                    1,
+                    0,
+                    49,
+                )
+            ],
+        )
+
+    def test_multiple_directives_on_one_line(self):
+        data = b"listen 80; server_name example.com; root /data;"
+
+        names = [d.name for d in iter_directives(data)]
+
+        self.assertEqual(names, ["listen", "server_name", "root"])
+
+    def test_hash_inside_quotes_is_not_a_comment(self):
+        data = b'add_header X-Test "a # b"; # comment ; include /etc/passwd;\n'
+
+        directives = list(iter_directives(data))
+
+        self.assertEqual(
+            directives,
+            [Directive("add_header", ("X-Test", "a # b"), "<string>", 1, 0, 25)],
+        )
+
+    def test_hash_inside_a_word_is_not_a_comment(self):
+        directives = list(iter_directives(b"return 200 foo#bar;"))
+
+        self.assertEqual(directives[0].args, ("200", "foo#bar"))
+
+    def test_quoted_arguments_are_unquoted_and_unescaped(self):
+        data = b'return 200 \'it\\\'s\' "say \\"hi\\"\\n" a\\;b;'
+
+        directives = list(iter_directives(data))
+
+        # Like nginx, only quotes, backslashes and \t, \r and \n are unescaped
+        self.assertEqual(directives[0].args, ("200", "it's", 'say "hi"\n', "a\\;b"))
+
+    def test_quoted_directive_name(self):
+        directives = list(iter_directives(b'"include" /etc/passwd;'))
+
+        self.assertEqual(directives[0].name, "include")
+
+    def test_variable_with_braces_does_not_open_a_block(self):
+        directives = list(iter_directives(b"set $a ${b}c;\nlocation / {}\n"))
+
+        self.assertEqual(
+            directives,
+            [
+                Directive("set", ("$a", "${b}c"), "<string>", 1, 0, 12),
+                Directive("location", ("/",), "<string>", 2, 14, 24),
+            ],
+        )
+
+    def test_line_numbers_count_newlines_in_quoted_strings(self):
+        data = b'return 200 "a\nb\nc";\nlisten 80;'
+
+        directives = list(iter_directives(data))
+
+        self.assertEqual(directives[1].line, 4)
+
+    def test_lua_block_contents_are_skipped(self):
+        data = (
+            b"content_by_lua_block {\n"
+            b"    -- don't { parse this\n"
+            b"    ngx.say('}', \"{\", [[ } ]])\n"
+            b"    if true then local t = {} end\n"
+            b"}\n"
+            b"listen 80;\n"
+        )
+
+        directives = list(iter_directives(data))
+
+        self.assertEqual(
+            directives,
+            [
+                Directive("content_by_lua_block", (), "<string>", 1, 0, 20),
+                Directive("listen", ("80",), "<string>", 6, 116, 125),
+            ],
+        )
+
+    def test_tokens_include_block_delimiters(self):
+        kinds = [token.kind for token in tokenize(b"events { worker_connections 1; }")]
+
+        self.assertEqual(kinds, ["word", "{", "word", "word", ";", "}"])
+
+    def test_unterminated_statement_is_yielded_before_error(self):
+        directives = []
+
+        with self.assertRaises(ConfigSyntaxError) as cm:
+            for directive in iter_directives(b"listen 80;\ninclude /etc/passwd", "a"):
+                directives.append(directive)
+
+        self.assertEqual(
+            directives[-1], Directive("include", ("/etc/passwd",), "a", 2, 11, 30)
+        )
+        self.assertEqual(cm.exception.line, 2)
+
+    def test_unbalanced_braces_are_syntax_errors(self):
+        for data in (b"server {\nlisten 80;\n", b"listen 80;\n}\n", b"listen 80 }"):
+            with self.assertRaises(ConfigSyntaxError, msg=data):
+                list(iter_directives(data))
+
+    def test_unterminated_quote_is_a_syntax_error(self):
+        with self.assertRaises(ConfigSyntaxError) as cm:
+            list(iter_directives(b'listen 80;\nreturn 200 "oops;\n', "a.conf"))
+
+        self.assertEqual(cm.exception.file, "a.conf")
+        self.assertEqual(cm.exception.line, 2)
+
+    def test_quote_must_be_followed_by_a_separator(self):
+        with self.assertRaises(ConfigSyntaxError) as cm:
+            list(iter_directives(b'return 200 "a"b;'))
+
+        self.assertEqual(cm.exception.message, 'unexpected "b"')
+
+    def test_empty_statement_is_a_syntax_error(self):
+        with self.assertRaises(ConfigSyntaxError):
+            list(iter_directives(b"listen 80;;"))
+
+    def test_too_long_parameter_is_a_syntax_error(self):
+        list(iter_directives(b"return 200 " + b"a" * MAX_TOKEN_LENGTH + b";"))
+
+        for data in (
+            b"a" * (MAX_TOKEN_LENGTH + 1),
+            b'"' + b"a" * MAX_TOKEN_LENGTH + b'"',
+        ):
+            with self.assertRaises(ConfigSyntaxError) as cm:
+                list(iter_directives(b"return 200\n" + data + b";"))
+
+            self.assertEqual(cm.exception.line, 2)
+            self.assertTrue(cm.exception.message.startswith("too long parameter"))
+
+    def test_unterminated_lua_string_is_a_syntax_error(self):
+        for data in (b'"a\n', b"'a\\'", b"--[==[ a ]=]", b"[[ a"):
+            with self.assertRaises(ConfigSyntaxError, msg=data):
+                list(iter_directives(b"content_by_lua_block {\n" + data + b"\n}\n"))
+
+    def test_lua_long_brackets_of_any_level(self):
+        data = b"content_by_lua_block {\n--[==[ ]] } ]==] a = [=[ } ]=]\n}\nlisten 80;"
+
+        directives = list(iter_directives(data))
+
+        self.assertEqual(
+            directives[-1], Directive("listen", ("80",), "<string>", 4, 56, 65)
+        )
+
+    def test_deadline_exceeded(self):
+        data = b"listen 80;\n" * 1000
+
+        with self.assertRaises(DeadlineExceeded) as cm:
+            list(iter_directives(data, "a.conf", deadline=time.monotonic() - 1))
+
+        self.assertEqual(cm.exception.file, "a.conf")
+        self.assertGreater(cm.exception.line, 1)
+
+    def test_deadline_exceeded_in_lua_block(self):
+        data = b"content_by_lua_block {\n" + b"{}" * 1000 + b"\n}\n"
+
+        with self.assertRaises(DeadlineExceeded):
+            list(iter_directives(data, deadline=time.monotonic() - 1))
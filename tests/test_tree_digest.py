@@ -0,0 +1,120 @@
+import os
+import shutil
+from tempfile import mkdtemp
+
+from nginx_config_reloader.tree_digest import TreeDigest
+from tests.testcase import TestCase
+
+
+class TestTreeDigest(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.other = mkdtemp()
+        self.tree_digest = TreeDigest(ignore_files=[".*", "*.flag"])
+        self._write("server.rewrites", "rewrite ^/a /b;\n")
+        self._write("sub/http.maps", "map $a $b {}\n")
+        self.digest = self.tree_digest.digest(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+        shutil.rmtree(self.other, ignore_errors=True)
+
+    def test_touch_and_chmod_do_not_change_digest(self):
+        path = os.path.join(self.dir, "server.rewrites")
+        os.utime(path, ns=(0, 0))
+        os.chmod(path, 0o600)
+
+        self.assertEqual(self.tree_digest.digest(self.dir), self.digest)
+
+    def test_rewrite_with_same_contents_does_not_change_digest(self):
+        self._write("server.rewrites", "rewrite ^/a /b;\n")
+
+        self.assertEqual(self.tree_digest.digest(self.dir), self.digest)
+
+    def test_changed_contents_change_digest(self):
+        self._write("sub/http.maps", "map $a $c {}\n")
+
+        self.assertNotEqual(self.tree_digest.digest(self.dir), self.digest)
+
+    def test_moved_file_changes_digest(self):
+        os.rename(
+            os.path.join(self.dir, "server.rewrites"),
+            os.path.join(self.dir, "sub", "server.rewrites"),
+        )
+
+        self.assertNotEqual(self.tree_digest.digest(self.dir), self.digest)
+
+    def test_new_and_deleted_files_change_digest(self):
+        self._write("sub/empty", "")
+        digest = self.tree_digest.digest(self.dir)
+        os.unlink(os.path.join(self.dir, "sub", "empty"))
+
+        self.assertNotEqual(digest, self.digest)
+        self.assertEqual(self.tree_digest.digest(self.dir), self.digest)
+
+    def test_ignored_files_do_not_change_digest(self):
+        self._write(".server.rewrites.swp", "x")
+        self._write("magento2.flag", "")
+        self._write(".git/config", "x")
+
+        self.assertEqual(self.tree_digest.digest(self.dir), self.digest)
+
+    def test_symlink_targets_change_digest(self):
+        target = os.path.join(self.other, "a.conf")
+        with open(target, "w") as f:
+            f.write("rewrite ^/a /b;\n")
+        os.unlink(os.path.join(self.dir, "server.rewrites"))
+        os.symlink(target, os.path.join(self.dir, "server.rewrites"))
+
+        self.assertNotEqual(self.tree_digest.digest(self.dir), self.digest)
+
+    def test_contents_of_symlinked_directory_are_included(self):
+        os.symlink(self.other, os.path.join(self.dir, "linked"))
+        digest = self.tree_digest.digest(self.dir)
+
+        with open(os.path.join(self.other, "a.conf"), "w") as f:
+            f.write("x")
+
+        self.assertNotEqual(self.tree_digest.digest(self.dir), digest)
+
+    def test_symlink_loop_is_not_followed(self):
+        os.symlink(self.dir, os.path.join(self.dir, "sub", "loop"))
+
+        self.tree_digest.digest(self.dir)
+
+    def test_directory_linked_to_twice_is_hashed_once(self):
+        os.symlink(self.other, os.path.join(self.dir, "a"))
+        os.symlink(self.other, os.path.join(self.dir, "b"))
+        scandir = self.set_up_patch(
+            "nginx_config_reloader.tree_digest.os.scandir", wraps=os.scandir
+        )
+
+        digest = self.tree_digest.digest(self.dir)
+
+        self.assertEqual(scandir.call_count, 3)
+        os.unlink(os.path.join(self.dir, "b"))
+        self.assertNotEqual(self.tree_digest.digest(self.dir), digest)
+
+    def test_unchanged_files_are_not_read_again(self):
+        self.set_up_patch("builtins.open", side_effect=AssertionError)
+
+        self.assertEqual(self.tree_digest.digest(self.dir), self.digest)
+
+    def test_extra_state_changes_digest(self):
+        self.assertNotEqual(self.tree_digest.digest(self.dir, [b"x"]), self.digest)
+
+    def test_hashes_of_removed_files_are_forgotten(self):
+        os.unlink(os.path.join(self.dir, "server.rewrites"))
+
+        self.tree_digest.digest(self.dir)
+
+        self.assertEqual(
+            list(self.tree_digest.file_hashes),
+            [os.path.join(self.dir, "sub/http.maps")],
+        )
+
+    def _write(self, name, contents):
+        path = os.path.join(self.dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(contents)
@@ -37,6 +37,14 @@ class TestWaitLoop(TestCase):
             dir_to_watch=self.source,
             use_systemd=False,
             error_file=nginx_config_reloader.ERROR_FILE,
+            scan_workers=nginx_config_reloader.SCAN_WORKERS,
+            skip_unreferenced_reloads=False,
+            keep_generations=nginx_config_reloader.KEEP_GENERATIONS,
+            generation_store_max_bytes=nginx_config_reloader.GENERATION_STORE_MAX_BYTES,
+            check_staged_config=False,
+            quiet_period=nginx_config_reloader.RELOAD_QUIET_PERIOD,
+            max_latency=nginx_config_reloader.RELOAD_MAX_LATENCY,
+            watcher="watchdog",
         )
 
     def test_wait_loop_creates_handler_with_custom_arguments(self):
@@ -45,6 +53,14 @@ class TestWaitLoop(TestCase):
             no_custom_config=True,
             use_systemd=True,
             error_file=self.custom_error_file,
+            scan_workers=4,
+            skip_unreferenced_reloads=True,
+            keep_generations=3,
+            generation_store_max_bytes=1024,
+            check_staged_config=True,
+            quiet_period=0.5,
+            max_latency=5,
+            watcher="inotify",
         )
 
         self.nginx_config_reloader.assert_called_once_with(
@@ -54,6 +70,14 @@ class TestWaitLoop(TestCase):
             dir_to_watch=self.source,
             use_systemd=True,
             error_file=self.custom_error_file,
+            scan_workers=4,
+            skip_unreferenced_reloads=True,
+            keep_generations=3,
+            generation_store_max_bytes=1024,
+            check_staged_config=True,
+            quiet_period=0.5,
+            max_latency=5,
+            watcher="inotify",
         )
 
     def test_wait_loop_sets_up_dbus_when_no_dbus_is_false(self):
@@ -112,10 +136,10 @@ class TestWaitLoop(TestCase):
             f"Configuration dir {self.source} not found, waiting..."
         )
 
-    def test_wait_loop_calls_reload_with_send_signal_false(self):
+    def test_wait_loop_applies_config_in_full_with_send_signal_false(self):
         self._run_wait_loop_with_keyboard_interrupt()
 
-        self.mock_handler.reload.assert_called_once_with(send_signal=False)
+        self.mock_handler.reload.assert_called_once_with(send_signal=False, full=True)
 
     def test_wait_loop_starts_observer(self):
         self._run_wait_loop_with_keyboard_interrupt()
@@ -141,16 +165,8 @@ class TestWaitLoop(TestCase):
         self.assertEqual(self.after_loop.call_count, 3)
         self.after_loop.assert_called_with(self.mock_handler)
 
-    def test_wait_loop_sleeps_one_second_between_after_loop_calls(self):
-        loop_count = [0]
-
-        def mock_sleep(seconds):
-            if seconds == 1:
-                loop_count[0] += 1
-                if loop_count[0] >= 2:
-                    raise KeyboardInterrupt
-
-        self.time_sleep.side_effect = mock_sleep
+    def test_wait_loop_waits_for_scheduler_between_after_loop_calls(self):
+        self.after_loop.side_effect = [None, KeyboardInterrupt]
 
         wait_loop(
             logger=self.mock_logger,
@@ -158,7 +174,11 @@ class TestWaitLoop(TestCase):
             no_dbus=True,
         )
 
-        self.assertGreaterEqual(loop_count[0], 2)
+        self.assertEqual(
+            self.mock_handler.scheduler.wait.mock_calls,
+            [call()] * 2,
+        )
+        self.assertNotIn(call(1), self.time_sleep.mock_calls)
 
     def test_wait_loop_handles_listen_target_terminated(self):
         call_count = [0]
@@ -4,9 +4,16 @@ import unittest
 from tempfile import NamedTemporaryFile, mkdtemp
 from unittest import mock
 
-from watchdog.events import DirCreatedEvent, FileDeletedEvent, FileMovedEvent
+from watchdog.events import (
+    DirCreatedEvent,
+    FileClosedEvent,
+    FileDeletedEvent,
+    FileModifiedEvent,
+    FileMovedEvent,
+)
 
 import nginx_config_reloader
+from nginx_config_reloader.journal import Change
 
 
 class TestWatchdogCallbacks(unittest.TestCase):
@@ -20,7 +27,9 @@ class TestWatchdogCallbacks(unittest.TestCase):
             f.write("blablabla")
 
         self.observer = mock.Mock()
-        self.handler = nginx_config_reloader.NginxConfigReloader(dir_to_watch=self.dir)
+        self.handler = nginx_config_reloader.NginxConfigReloader(
+            dir_to_watch=self.dir, scan_cache_file=None
+        )
         self.handler.observer = self.observer
 
     def tearDown(self):
@@ -82,8 +91,81 @@ class TestWatchdogRecursiveCallbacks(TestWatchdogCallbacks):
             f.write("blablabla")
 
         self.observer = mock.Mock()
-        self.handler = nginx_config_reloader.NginxConfigReloader(dir_to_watch=self.dir)
+        self.handler = nginx_config_reloader.NginxConfigReloader(
+            dir_to_watch=self.dir, scan_cache_file=None
+        )
         self.handler.observer = self.observer
 
     def tearDown(self):
         shutil.rmtree(self.rootdir, ignore_errors=True)
+
+
+class TestWatchdogWriteCallbacks(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.path = os.path.join(self.dir, "server.conf")
+        self.handler = nginx_config_reloader.NginxConfigReloader(
+            dir_to_watch=self.dir, scan_cache_file=None
+        )
+        self.scheduler = self.handler.scheduler = mock.Mock(
+            wraps=self.handler.scheduler
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _write(self, path):
+        with open(path, "w") as f:
+            f.write("rewrite ^/a /b;\n")
+
+    def test_written_file_is_recorded_once_and_applied_when_closed(self):
+        self._write(self.path)
+
+        for _ in range(3):
+            self.handler.on_modified(FileModifiedEvent(self.path))
+
+        self.assertEqual(
+            self.handler.changes.take()[1], {Change(self.path, "modified")}
+        )
+        self.scheduler.hold.assert_called_once_with(self.path)
+        self.scheduler.notify.assert_not_called()
+        self.assertTrue(self.handler.scheduler.is_held(self.path))
+
+        self.handler.on_closed(FileClosedEvent(self.path))
+
+        self.assertEqual(self.handler.changes.take()[1], {Change(self.path, "closed")})
+        self.assertFalse(self.handler.scheduler.is_held(self.path))
+        self.scheduler.notify.assert_called_once_with()
+
+    def test_changed_attributes_are_applied_without_waiting_for_close(self):
+        self._write(self.path)
+        os.utime(self.path, ns=(0, 0))
+
+        self.handler.on_modified(FileModifiedEvent(self.path))
+
+        self.scheduler.hold.assert_not_called()
+        self.scheduler.notify.assert_called_once_with()
+        self.assertTrue(self.handler.dirty)
+
+    def test_writes_to_ignored_files_do_not_postpone_reload(self):
+        path = os.path.join(self.dir, ".server.conf.swp")
+        self._write(path)
+
+        self.handler.on_modified(FileModifiedEvent(path))
+
+        self.scheduler.hold.assert_not_called()
+        self.assertFalse(self.handler.dirty)
+
+    def test_file_renamed_into_place_is_no_longer_written(self):
+        tmp = os.path.join(self.dir, "server.conf.tmp")
+        self._write(tmp)
+        self.handler.on_modified(FileModifiedEvent(tmp))
+
+        os.rename(tmp, self.path)
+        self.handler.on_moved(FileMovedEvent(tmp, self.path))
+
+        self.assertFalse(self.handler.scheduler.is_held(tmp))
+        self.assertEqual(
+            self.handler.changes.take()[1],
+            {Change(tmp, "modified"), Change(tmp, "moved"), Change(self.path, "moved")},
+        )
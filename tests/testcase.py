@@ -1,7 +1,13 @@
+import os
+import shutil
 import sys
 import unittest
+from tempfile import mkdtemp
 from unittest.mock import Mock, mock_open, patch
 
+import nginx_config_reloader
+from nginx_config_reloader.include_graph import IncludeGraph
+
 
 class TestCase(unittest.TestCase):
     def set_up_patch(self, patch_target, mock_target=None, **kwargs):
@@ -24,3 +30,88 @@ class TestCase(unittest.TestCase):
             )
         else:
             return self.set_up_patch("builtins.open", mock_open(read_data=read_value))
+
+
+class ApplyTestCase(TestCase):
+    """Applies the config in a temporary watched dir, with the steps that need
+    nginx or root patched out"""
+
+    def setUp(self):
+        self.source = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source, ignore_errors=True)
+        self.run_config_test = self.set_up_patch(
+            "nginx_config_reloader.NginxConfigReloader.run_config_test"
+        )
+        self.install = self.set_up_patch(
+            "nginx_config_reloader.NginxConfigReloader.install_new_custom_config_dir"
+        )
+        self.install_magento = self.set_up_patch(
+            "nginx_config_reloader.NginxConfigReloader.install_magento_config"
+        )
+        self.chmod = self.set_up_patch(
+            "nginx_config_reloader.NginxConfigReloader.fix_custom_config_dir_permissions"
+        )
+        self.set_up_patch(
+            "nginx_config_reloader.NginxConfigReloader.check_can_write_to_main_config_dir",
+            return_value=True,
+        )
+        self.reload_nginx = self.set_up_patch(
+            "nginx_config_reloader.NginxConfigReloader.reload_nginx"
+        )
+        self.main_config = None
+
+    def set_up_scan(self):
+        """Patch out the scan for forbidden config, which finds nothing"""
+        return self.set_up_patch(
+            "nginx_config_reloader.NginxConfigReloader.check_no_forbidden_config_directives_are_present",
+            return_value=False,
+        )
+
+    def set_up_main_config(self, contents):
+        """Write a main config for the include graph, in which the custom
+        config dir is /etc/nginx/app"""
+        self.main = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.main, ignore_errors=True)
+        self.set_up_patch(
+            "nginx_config_reloader.include_graph.MAIN_CONFIG_DIR", self.main
+        )
+        self.set_up_patch(
+            "nginx_config_reloader.include_graph.CUSTOM_CONFIG_DIR", "/etc/nginx/app"
+        )
+        self.main_config = self.write(self.main, "nginx.conf", contents)
+
+    def reloader(self, **kwargs):
+        """Create the reloader of the watched dir as self.tm"""
+        self.tm = nginx_config_reloader.NginxConfigReloader(
+            dir_to_watch=self.source, scan_cache_file=None, **kwargs
+        )
+        if self.main_config:
+            self.tm.include_graph = IncludeGraph(self.source, roots=[self.main_config])
+        return self.tm
+
+    def reset_apply_mocks(self):
+        for mock in (
+            self.run_config_test,
+            self.install,
+            self.install_magento,
+            self.chmod,
+            self.reload_nginx,
+        ):
+            mock.reset_mock()
+
+    def change(self, path, contents=None):
+        """Write contents to path, or append to it, and record the change"""
+        if contents is None:
+            with open(path, "a") as f:
+                f.write("# changed\n")
+        else:
+            self.write(os.path.dirname(path), os.path.basename(path), contents)
+        self.tm.changes.record(path, "modified")
+
+    @staticmethod
+    def write(directory, name, contents):
+        path = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(contents)
+        return path